@@ -0,0 +1,76 @@
+"""
+Per-process LRU cache for annotation analytics (counts and agreement statistics).
+
+Entries are keyed by (dataset, task, split, annotation version, split version, statistic). Since the
+annotation version of a task is incremented whenever its annotations change (see `Dataset.setannos`) and
+the split version of a dataset whenever split membership changes (see `Dataset.split_version`), a changed
+version never matches a stale entry in any worker process, and stale entries are eventually evicted as
+least recently used. Hit and miss counters are logged every `STATUS_LOG_INTERVAL` lookups
+and exposed through the API (`/api/1.0/status/analyticscache`).
+"""
+import copy
+import logging
+from collections import OrderedDict, defaultdict
+
+# number of cached results kept per process
+MAX_ENTRIES = 256
+# number of lookups after which the cache status is logged
+STATUS_LOG_INTERVAL = 1000
+
+_ENTRIES = OrderedDict()
+_COUNTERS = defaultdict(int)
+
+
+def cache_key(dataset_id, task_id, split, annotation_version, split_version, statistic):
+    return (int(dataset_id), int(task_id), split, annotation_version, split_version, statistic)
+
+
+def get(key, compute):
+    """
+    Returns a copy of the cached result for `key`, calling `compute()` and caching its result on a miss.
+    Callers may modify the returned result without affecting the cache.
+    """
+    if (_COUNTERS["hits"] + _COUNTERS["misses"]) % STATUS_LOG_INTERVAL == STATUS_LOG_INTERVAL - 1:
+        logging.info("analytics cache status %s", status())
+
+    if key in _ENTRIES:
+        _COUNTERS["hits"] += 1
+        _ENTRIES.move_to_end(key)
+        return copy.deepcopy(_ENTRIES[key])
+
+    _COUNTERS["misses"] += 1
+    logging.debug("analytics cache miss %s", key)
+    result = compute()
+    _ENTRIES[key] = result
+
+    while len(_ENTRIES) > MAX_ENTRIES:
+        evicted_key, _ = _ENTRIES.popitem(last=False)
+        _COUNTERS["evictions"] += 1
+        logging.debug("analytics cache evicted %s", evicted_key)
+    return copy.deepcopy(result)
+
+
+def invalidate(dataset_id, task_id=None):
+    """
+    Drops all cached results of a dataset (or a single task of it).
+    """
+    for key in list(_ENTRIES.keys()):
+        if key[0] != dataset_id:
+            continue
+        if task_id is not None and key[1] != task_id:
+            continue
+        del _ENTRIES[key]
+        _COUNTERS["invalidations"] += 1
+
+
+def status():
+    statusinfo = {}
+
+    for counter_name in ["hits", "misses", "evictions", "invalidations"]:
+        statusinfo[counter_name] = _COUNTERS[counter_name]
+
+    statusinfo["entries"] = len(_ENTRIES)
+    lookups = statusinfo["hits"] + statusinfo["misses"]
+    statusinfo["hit_ratio"] = statusinfo["hits"] / lookups if lookups > 0 else None
+
+    return statusinfo
@@ -0,0 +1,314 @@
+"""
+In-memory bitmaps of the samples a user has annotated, kept per (dataset, task, user).
+
+Bitmaps are loaded lazily from the annotations table, updated once annotations stored through
+`Dataset.setannos` are committed and dropped on bulk changes. Since every worker process holds its own
+copy, bitmaps expire after `BITMAP_MAX_AGE` seconds and any sample a bitmap reports as unannotated
+is confirmed against the database before it is served. Bitmaps are therefore only used as a hint to
+navigate to unannotated samples, progress is counted in the database (see `Dataset.annocount`).
+"""
+import logging
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import sql
+
+from app.lib.database_internals import after_commit
+from app.lib.models.splitsummary import SplitSummary
+
+# number of (dataset, task, user) bitmaps kept per process
+MAX_BITMAPS = 512
+# number of datasets whose sample indices and splits are kept per process
+MAX_DATASETS = 64
+# seconds after which a bitmap is reloaded to pick up changes made by other worker processes
+BITMAP_MAX_AGE = 300
+# number of candidate samples checked at once when looking for unannotated samples
+CANDIDATE_CHUNK_SIZE = 4096
+
+_BITMAPS = OrderedDict()
+_DATASET_SAMPLES = OrderedDict()
+
+
+class SampleBitmap:
+    """
+    Growable bit array over sample indices, starting at `offset`.
+    """
+
+    def __init__(self, offset=0, size=0):
+        self.offset = offset
+        self.bits = np.zeros((size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+        self.loaded = time.monotonic()
+
+    def _ensure(self, sample_index):
+        if sample_index < self.offset:
+            shift_bytes = (self.offset - sample_index + 7) // 8
+            self.bits = np.concatenate([np.zeros(shift_bytes, dtype=np.uint8), self.bits])
+            self.offset -= shift_bytes * 8
+        position = sample_index - self.offset
+        if position // 8 >= self.bits.shape[0]:
+            grow_to = max(position // 8 + 1, self.bits.shape[0] * 2)
+            self.bits = np.concatenate([self.bits, np.zeros(grow_to - self.bits.shape[0], dtype=np.uint8)])
+        return position
+
+    def add(self, sample_index):
+        position = self._ensure(int(sample_index))
+        byte_idx, bit = position >> 3, np.uint8(1 << (position & 7))
+        if not self.bits[byte_idx] & bit:
+            self.bits[byte_idx] |= bit
+            self.count += 1
+
+    def update(self, sample_indices):
+        sample_indices = np.asarray(sample_indices, dtype=np.int64)
+        if sample_indices.shape[0] == 0:
+            return
+        self._ensure(int(sample_indices.min()))
+        self._ensure(int(sample_indices.max()))
+        positions = sample_indices - self.offset
+        np.bitwise_or.at(self.bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+        self.count = int(np.unpackbits(self.bits).sum())
+
+    def mask(self, sample_indices):
+        """
+        Vectorized membership test, returns a boolean array.
+        """
+        positions = np.asarray(sample_indices, dtype=np.int64) - self.offset
+        valid = (positions >= 0) & (positions < self.bits.shape[0] * 8)
+        result = np.zeros(positions.shape[0], dtype=bool)
+        valid_positions = positions[valid]
+        result[valid] = (self.bits[valid_positions >> 3] >> (valid_positions & 7).astype(np.uint8)) & 1
+        return result
+
+    def __contains__(self, sample_index):
+        return bool(self.mask([sample_index])[0])
+
+    def expired(self):
+        return time.monotonic() - self.loaded > BITMAP_MAX_AGE
+
+
+class DatasetSamples:
+    """
+    Sorted sample indices of a dataset along with the split each sample belongs to, as of `split_version`
+    (see `Dataset.split_version`).
+    """
+
+    def __init__(self, sample_indices, split_ids, split_version=None):
+        self.sample_indices = np.asarray(sample_indices, dtype=np.int64)
+        split_names, split_codes = np.unique(np.asarray(split_ids, dtype=object).astype(str), return_inverse=True)
+        self.split_codes = {}
+        for code, split_name in enumerate(split_names):
+            self.split_codes[split_name] = code
+        self.sample_splits = split_codes.astype(np.int32)
+        self.split_version = split_version
+
+    def split_mask(self, splits, start=0, end=None):
+        if splits is None or len(splits) == 0:
+            return None
+        codes = [self.split_codes[split_id] for split_id in splits if split_id in self.split_codes]
+        return np.isin(self.sample_splits[start:end], codes)
+
+
+def _bitmap_key(dataset_id, owner_id, task_id):
+    return (int(dataset_id), int(owner_id), int(task_id) if task_id is not None else None)
+
+
+def dataset_samples(dbsession, dataset_id):
+    """
+    Returns the sample indices and splits of a dataset, reloaded if the split version of the dataset
+    changed (e.g. through split edits or imports in another worker process).
+    """
+    split_version = SplitSummary.version(dbsession, dataset_id)
+
+    samples = _DATASET_SAMPLES.get(dataset_id, None)
+    if samples is not None and samples.split_version == split_version:
+        _DATASET_SAMPLES.move_to_end(dataset_id)
+        return samples
+
+    sql_raw = """
+    SELECT dc.sample_index, COALESCE(dc.split_id, '') AS split_id FROM datasetcontent AS dc
+    WHERE dc.dataset_id = :dataset_id
+    ORDER BY dc.sample_index
+    """
+    rows = dbsession.execute(sql.text(sql_raw), params={"dataset_id": dataset_id}).fetchall()
+    samples = DatasetSamples([row[0] for row in rows], [row[1] for row in rows], split_version)
+    _DATASET_SAMPLES[dataset_id] = samples
+    while len(_DATASET_SAMPLES) > MAX_DATASETS:
+        _DATASET_SAMPLES.popitem(last=False)
+    return samples
+
+
+def annotated(dbsession, dataset_id, owner_id, task_id=None):
+    """
+    Returns the bitmap of samples annotated by a user, for `task_id` or any task if not specified.
+    """
+    key = _bitmap_key(dataset_id, owner_id, task_id)
+    bitmap = _BITMAPS.get(key, None)
+    if bitmap is not None and not bitmap.expired():
+        _BITMAPS.move_to_end(key)
+        return bitmap
+
+    params = {"dataset_id": dataset_id, "owner_id": owner_id}
+    task_where = ""
+    if task_id is not None:
+        task_where = "AND anno.task_id = :task_id"
+        params["task_id"] = task_id
+
+    sql_raw = """
+    SELECT DISTINCT anno.sample_index FROM annotations AS anno
+    WHERE anno.dataset_id = :dataset_id
+        AND anno.owner_id = :owner_id
+        {task_where}
+    """.format(task_where=task_where)
+    sample_indices = [row[0] for row in dbsession.execute(sql.text(sql_raw), params=params)]
+
+    samples = dataset_samples(dbsession, dataset_id)
+    offset = int(samples.sample_indices[0]) if samples.sample_indices.shape[0] > 0 else 0
+    bitmap = SampleBitmap(offset, samples.sample_indices.shape[0])
+    bitmap.update(sample_indices)
+
+    logging.debug("loaded annotation bitmap %s (%s annotated samples)", key, bitmap.count)
+
+    _BITMAPS[key] = bitmap
+    while len(_BITMAPS) > MAX_BITMAPS:
+        _BITMAPS.popitem(last=False)
+    return bitmap
+
+
+def record(dataset_id, owner_id, task_id, sample_index):
+    """
+    Marks a sample as annotated in all loaded bitmaps it affects.
+    """
+    for key in [_bitmap_key(dataset_id, owner_id, task_id), _bitmap_key(dataset_id, owner_id, None)]:
+        bitmap = _BITMAPS.get(key, None)
+        if bitmap is not None:
+            bitmap.add(sample_index)
+
+
+def record_on_commit(dbsession, dataset_id, owner_id, annotated_items):
+    """
+    Marks the `(task_id, sample_index)` items as annotated once the current transaction is committed.
+    If it is rolled back instead, the user's bitmaps are dropped since they may have been loaded with
+    the uncommitted annotations.
+    """
+    def on_commit():
+        for task_id, sample_index in annotated_items:
+            record(dataset_id, owner_id, task_id, sample_index)
+
+    after_commit(dbsession, on_commit, lambda: invalidate(dataset_id, owner_id))
+
+
+def invalidate(dataset_id, owner_id=None, samples=False):
+    """
+    Drops the bitmaps of a dataset (or a single user), and the cached list of samples if `samples` is set.
+    """
+    for key in list(_BITMAPS.keys()):
+        if key[0] != dataset_id:
+            continue
+        if owner_id is not None and key[1] != owner_id:
+            continue
+        del _BITMAPS[key]
+
+    if samples and dataset_id in _DATASET_SAMPLES:
+        del _DATASET_SAMPLES[dataset_id]
+
+
+def _unannotated_sample(dbsession, dataset_id, owner_id, sample_index, task_id):
+    """
+    Confirms that a sample is not annotated by the user with a single primary key lookup.
+    Returns the sample id or None if it was annotated in the meantime (or removed).
+    """
+    params = {"dataset_id": dataset_id, "owner_id": owner_id, "sample_index": int(sample_index)}
+    task_where = ""
+    if task_id is not None:
+        task_where = "AND anno.task_id = :task_id"
+        params["task_id"] = task_id
+
+    sql_raw = """
+    SELECT dc.sample FROM datasetcontent AS dc
+    WHERE dc.dataset_id = :dataset_id
+        AND dc.sample_index = :sample_index
+        AND NOT EXISTS (
+            SELECT 1 FROM annotations AS anno
+            WHERE anno.dataset_id = dc.dataset_id
+                AND anno.sample_index = dc.sample_index
+                AND anno.owner_id = :owner_id
+                {task_where}
+        )
+    """.format(task_where=task_where)
+    row = dbsession.execute(sql.text(sql_raw), params=params).first()
+    return row[0] if row is not None else None
+
+
+def first_unannotated(dbsession, dataset_id, owner_id, candidate_chunks, task_id=None, exclude=None):
+    """
+    Returns the position, sample index and sample id of the first candidate in `candidate_chunks`
+    (an iterable of arrays of sample indices, positions are counted across all chunks) that the user
+    has not annotated.
+    """
+    bitmap = annotated(dbsession, dataset_id, owner_id, task_id)
+    chunk_offset = 0
+    for chunk in candidate_chunks:
+        for chunk_position in np.flatnonzero(~bitmap.mask(chunk)):
+            sample_index = int(chunk[chunk_position])
+            if exclude is not None and sample_index == exclude:
+                continue
+            sample = _unannotated_sample(dbsession, dataset_id, owner_id, sample_index, task_id)
+            if sample is not None:
+                return chunk_offset + int(chunk_position), sample_index, sample
+            # annotated through another worker process
+            bitmap.add(sample_index)
+        chunk_offset += len(chunk)
+    return None, None, None
+
+
+def sample_chunks(samples, sample_index, splits, direction):
+    """
+    Yields the sample indices of `samples` before or after `sample_index` (direction -1 or 1) within the given
+    splits in chunks, ordered by their distance to `sample_index`.
+    """
+    if direction > 0:
+        start = int(np.searchsorted(samples.sample_indices, sample_index, side="right"))
+        for chunk_start in range(start, samples.sample_indices.shape[0], CANDIDATE_CHUNK_SIZE):
+            chunk_end = chunk_start + CANDIDATE_CHUNK_SIZE
+            chunk = samples.sample_indices[chunk_start:chunk_end]
+            split_mask = samples.split_mask(splits, chunk_start, chunk_end)
+            yield chunk if split_mask is None else chunk[split_mask]
+    else:
+        end = int(np.searchsorted(samples.sample_indices, sample_index, side="left"))
+        for chunk_end in range(end, 0, -CANDIDATE_CHUNK_SIZE):
+            chunk_start = max(0, chunk_end - CANDIDATE_CHUNK_SIZE)
+            chunk = samples.sample_indices[chunk_start:chunk_end]
+            split_mask = samples.split_mask(splits, chunk_start, chunk_end)
+            chunk = chunk if split_mask is None else chunk[split_mask]
+            yield chunk[::-1]
+
+
+def adjacent_unannotated(dbsession, dataset_id, owner_id, sample_index, splits, direction, task_id=None):
+    """
+    Returns the closest sample before or after `sample_index` (direction -1 or 1) within the given
+    splits that the user has not annotated yet, as a tuple of sample index and sample id.
+    """
+    samples = dataset_samples(dbsession, dataset_id)
+    candidate_chunks = sample_chunks(samples, sample_index, splits, direction)
+    _, adjacent_index, adjacent_sample = first_unannotated(dbsession, dataset_id, owner_id,
+                                                           candidate_chunks, task_id)
+    return adjacent_index, adjacent_sample
+
+
+def unannotated_candidates(dbsession, dataset_id, owner_id, candidate_chunks, limit, exclude=None):
+    """
+    Returns up to `limit` sample indices from `candidate_chunks` that are unannotated according to the
+    user's bitmap. Unlike `first_unannotated`, candidates are not confirmed against the database.
+    """
+    bitmap = annotated(dbsession, dataset_id, owner_id)
+    candidates = []
+    for chunk in candidate_chunks:
+        if len(candidates) >= limit:
+            break
+        for sample_index in chunk[~bitmap.mask(chunk)][:limit - len(candidates) + 1]:
+            if exclude is not None and int(sample_index) == exclude:
+                continue
+            candidates.append(int(sample_index))
+    return candidates[:limit]
+
@@ -70,3 +70,35 @@ class AnnotationTask(ma.Schema):
         converted.work_packages = list(task.splits) if task.splits is not None else []
         converted.size = task.size
         return converted
+
+
+class AnnotationItem(ma.Schema):
+    sample_index = ma.fields.Integer(required=True)
+    task_id = ma.fields.Integer(required=True)
+    value = ma.fields.Raw(required=True, allow_none=True)
+
+
+class AnnotationBatch(ma.Schema):
+    annotations = ma.fields.List(ma.fields.Nested(AnnotationItem), required=True)
+
+
+class AnnotationItemStatus(ma.Schema):
+    sample_index = ma.fields.Integer(required=True)
+    task_id = ma.fields.Integer(required=True)
+    status = ma.fields.String(required=True)
+    message = ma.fields.String()
+
+
+class AnnotationBatchResult(ma.Schema):
+    dataset = ma.fields.Integer(required=True)
+    stored = ma.fields.Integer(required=True)
+    items = ma.fields.List(ma.fields.Nested(AnnotationItemStatus))
+
+
+class AnalyticsCacheStatus(ma.Schema):
+    hits = ma.fields.Integer(required=True)
+    misses = ma.fields.Integer(required=True)
+    evictions = ma.fields.Integer(required=True)
+    invalidations = ma.fields.Integer(required=True)
+    entries = ma.fields.Integer(required=True)
+    hit_ratio = ma.fields.Float(allow_none=True)
@@ -7,11 +7,13 @@ import logging
 
 from app.lib import config
 import app.lib.database as db
+import app.lib.iaa as iaa
 
 _HANDLERS = {}
 _MANAGED_JOBS = []
 _COUNTERS = defaultdict(int)
 batch_pool = None
+background_executor = None
 
 
 # class Job(Base):
@@ -52,7 +54,20 @@ def startup():
     batch_pool = futures.ProcessPoolExecutor(max_workers=max_workers)
 
 
+def background_thread():
+    """
+    Returns an executor with a single background thread of this process. Used for computations triggered by
+    requests in processes that do not hold the batch pool, which should not block the request.
+    """
+    global background_executor
+    if background_executor is None:
+        background_executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="background")
+    return background_executor
+
+
 def teardown(reason=None):
+    if background_executor is not None:
+        background_executor.shutdown(wait=False)
     if batch_pool is None:
         return
     logging.debug("received shutdown signal (reason: %s)" % (reason if reason is not None else "none"))
@@ -82,7 +97,7 @@ class BatchJob:
 
         fn = _HANDLERS[fn_name]
         logging.debug("submitting function %s args: %s kwargs: %s" % (fn, args, kwargs))
-        future = batch_pool.submit(fn, *args, *kwargs)
+        future = batch_pool.submit(fn, *args, **kwargs)
         logging.debug("submitted function %s" % (fn))
         self.set_future(future)
         _COUNTERS["jobs_enqueued"] += 1
@@ -132,9 +147,7 @@ def status():
 
 
 def register(fn_name, fn):
-    if batch_pool is None:
-        return
-
+    # handlers are registered on import, before the pool is created in `startup`
     if fn_name in _HANDLERS:
         raise BatchJobException(f"handler for function <{fn_name}> was previously registered")
     if fn is None:
@@ -152,6 +165,7 @@ def test_hello_batchjob(name_param):
 
 
 register("hello_batchjob", test_hello_batchjob)
+register("iaa_bootstrap", iaa.bootstrap_fleiss_kappa)
 
 
 def schedule_test():
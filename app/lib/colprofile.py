@@ -0,0 +1,233 @@
+"""
+Streaming profiles of the additional fields stored in `datasetcontent.data`.
+
+The dataset is read in chunks through a server-side cursor, one row per sample and field, and each chunk
+is folded into mergeable per-field sketches: value type counts, null counts, the number of distinct values
+(counted exactly up to `EXACT_DISTINCT_LIMIT`, estimated with HyperLogLog above) and the range of numeric
+values. Memory use is bounded by the chunk size and the number of fields, independent of the dataset size.
+"""
+import logging
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import sql
+
+# number of (sample, field) rows fetched from the server-side cursor at once
+PROFILE_CHUNK_SIZE = 100000
+# HyperLogLog registers per field are 2^precision bytes, the standard error is about 1.04 / sqrt(2^precision)
+HLL_PRECISION = 12
+# distinct values per field that are counted exactly before only the HyperLogLog estimate is kept
+EXACT_DISTINCT_LIMIT = 1024
+
+
+def _bit_length(values):
+    """
+    Number of bits required to represent each of the uint64 `values` (0 for 0), computed exactly
+    on the 32 bit halves which float64 represents without rounding.
+    """
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    high_bits = np.frexp(high)[1]
+    low_bits = np.frexp(low)[1]
+    return np.where(high_bits > 0, high_bits + 32, low_bits)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct value estimator over 64 bit hashes.
+    """
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if hashes.shape[0] == 0:
+            return
+        value_bits = 64 - self.precision
+        register_idx = (hashes >> np.uint64(value_bits)).astype(np.int64)
+        remainder = hashes & np.uint64((1 << value_bits) - 1)
+        # position of the leftmost 1-bit within the remaining bits
+        rank = (value_bits - _bit_length(remainder) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, register_idx, rank)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise Exception("cannot merge HyperLogLog sketches of different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        register_count = self.registers.shape[0]
+        alpha = 0.7213 / (1.0 + 1.079 / register_count)
+        raw_estimate = alpha * register_count ** 2 / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+
+        empty_registers = int((self.registers == 0).sum())
+        if raw_estimate <= 2.5 * register_count and empty_registers > 0:
+            # linear counting is more accurate for small cardinalities
+            return int(round(register_count * np.log(register_count / empty_registers)))
+        return int(round(raw_estimate))
+
+
+class ColumnProfile:
+    """
+    Mergeable profile of a single field.
+    """
+
+    def __init__(self):
+        self.type_counts = Counter()
+        self.distinct = HyperLogLog()
+        # hashes of the distinct values, None once there are more than EXACT_DISTINCT_LIMIT
+        self.distinct_exact = set()
+        self.integral = True
+        self.minval = None
+        self.maxval = None
+
+    def update(self, value_types, value_texts):
+        """
+        Adds the values of one chunk, given as the JSON types (`jsonb_typeof`) and text representations
+        of the field's values. Empty strings are treated as missing values.
+        """
+        value_types = value_types.where(~((value_types == "string") & (value_texts == "")), "null")
+        self.type_counts.update(value_types.value_counts().to_dict())
+
+        present = (value_types != "null").to_numpy()
+        if present.any():
+            value_keys = (value_types[present] + ":" + value_texts[present]).to_numpy(dtype=object)
+            value_hashes = pd.util.hash_array(value_keys, categorize=True)
+            self.distinct.add(value_hashes)
+            if self.distinct_exact is not None:
+                self._update_exact(np.unique(value_hashes).tolist())
+
+        numbers = (value_types == "number").to_numpy()
+        if numbers.any():
+            number_texts = value_texts[numbers]
+            number_values = pd.to_numeric(number_texts).to_numpy(dtype=np.float64)
+            self._update_range(number_values.min(), number_values.max())
+            if self.integral and number_texts.str.contains("[.eE]", regex=True).any():
+                self.integral = False
+
+    def _update_exact(self, value_hashes):
+        if value_hashes is None:
+            self.distinct_exact = None
+            return
+        self.distinct_exact.update(value_hashes)
+        if len(self.distinct_exact) > EXACT_DISTINCT_LIMIT:
+            self.distinct_exact = None
+
+    def _update_range(self, minval, maxval):
+        if minval is None:
+            return
+        self.minval = minval if self.minval is None else min(self.minval, minval)
+        self.maxval = maxval if self.maxval is None else max(self.maxval, maxval)
+
+    def merge(self, other):
+        self.type_counts.update(other.type_counts)
+        self.distinct.merge(other.distinct)
+        if self.distinct_exact is not None:
+            self._update_exact(other.distinct_exact)
+        self.integral = self.integral and other.integral
+        self._update_range(other.minval, other.maxval)
+
+    def summary(self, row_count):
+        """
+        Summarizes the profile in the format of `Dataset.get_overview_statistics`. `dtype` follows the
+        dtype pandas would infer for the column.
+        """
+        value_types = {value_type: count for value_type, count in self.type_counts.items()
+                       if value_type != "null" and count > 0}
+        present_count = sum(value_types.values())
+        null_count = max(0, row_count - present_count)
+
+        dtype = "object"
+        if set(value_types.keys()) == {"number"}:
+            dtype = "int64" if self.integral and null_count == 0 else "float64"
+        elif set(value_types.keys()) == {"boolean"} and null_count == 0:
+            dtype = "bool"
+
+        numeric = dtype in ["int64", "float64"]
+        nunique_exact = self.distinct_exact is not None
+        return {
+                "dtype": dtype,
+                "numeric": numeric,
+                "nunique": len(self.distinct_exact) if nunique_exact else min(self.distinct.estimate(), present_count),
+                "nunique_exact": nunique_exact,
+                "nulls": null_count,
+                "types": value_types,
+                "min": float(self.minval) if numeric and self.minval is not None else None,
+                "max": float(self.maxval) if numeric and self.maxval is not None else None,
+                }
+
+
+def profile_chunk(profiles, chunk):
+    """
+    Folds a chunk of `(field, value_type, value_text)` rows into the profiles by field.
+    """
+    chunk = pd.DataFrame(chunk, columns=["field", "value_type", "value_text"])
+    chunk["value_text"] = chunk["value_text"].fillna("")
+    for field_name, field_values in chunk.groupby("field", sort=False):
+        if field_name not in profiles:
+            profiles[field_name] = ColumnProfile()
+        profiles[field_name].update(field_values["value_type"], field_values["value_text"])
+
+
+def profile_dataset(dbsession, dataset_id, chunk_size=PROFILE_CHUNK_SIZE):
+    """
+    Profiles all additional fields of a dataset in one streaming pass.
+    Returns the number of samples and the `ColumnProfile`s by field.
+    """
+    params = {"dataset_id": dataset_id}
+    sql_raw = """
+    SELECT field.key, jsonb_typeof(field.value), field.value #>> '{}'
+    FROM datasetcontent AS dc
+    CROSS JOIN jsonb_each(
+        CASE WHEN json_typeof(dc.data) = 'object' THEN dc.data::jsonb ELSE '{}'::jsonb END
+    ) AS field
+    WHERE dc.dataset_id = :dataset_id
+    """
+    logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+
+    profiles = {}
+    connection = dbsession.connection().execution_options(stream_results=True)
+    result = connection.execute(sql.text(sql_raw), params)
+    try:
+        while True:
+            chunk = result.fetchmany(chunk_size)
+            if len(chunk) == 0:
+                break
+            profile_chunk(profiles, [tuple(row) for row in chunk])
+    finally:
+        result.close()
+
+    count_raw = "SELECT COUNT(*) FROM datasetcontent AS dc WHERE dc.dataset_id = :dataset_id"
+    row_count = dbsession.execute(sql.text(count_raw), params=params).scalar()
+
+    return row_count, profiles
+
+
+def dataset_overview(dbsession, dataset_id):
+    """
+    Profiles a dataset (see `profile_dataset`) and returns the number of samples (`size`)
+    and the summary of each field (`columns`, see `ColumnProfile.summary`).
+    """
+    row_count, profiles = profile_dataset(dbsession, dataset_id)
+
+    overview = {"columns": {}}
+    for colname, profile in profiles.items():
+        overview['columns'][colname] = profile.summary(row_count)
+
+    overview['size'] = row_count
+    return overview
+
+
+def histogram_quantiles(edges, counts, probabilities):
+    """
+    Approximate quantiles of a fixed-bin histogram, interpolating linearly within bins.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return [None for _ in probabilities]
+    cumulative = np.concatenate([[0.0], np.cumsum(counts)])
+    return [float(value) for value in np.interp(np.asarray(probabilities) * total, cumulative, edges)]
@@ -15,6 +15,10 @@ from flask_migrate import Migrate
 # include entities in order to satisfy the ORM
 from app.lib.models.datasetcontent import DatasetContent
 from app.lib.models.annotation import Annotation
+from app.lib.models.sampleorder import SampleOrder
+from app.lib.models.samplelease import SampleLease
+from app.lib.models.annotationcursor import AnnotationCursor
+from app.lib.models.splitsummary import SplitSummary
 from app.lib.models.dataset import Dataset
 import app.lib.models.datasets as datasets
 from app.lib.models.activity import Activity
@@ -3,6 +3,37 @@ This module stores the declarative base instance for SQLAlchemy
 in order not to introduce cyclic imports between the main
 database module and model implementations.
 """
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
 
 Base = declarative_base()
+
+# callbacks registered with `after_commit`, kept in the session's info dictionary
+_TRANSACTION_CALLBACKS = "transaction_callbacks"
+
+
+def after_commit(dbsession, on_commit, on_rollback=None):
+    """
+    Runs `on_commit` once the current transaction of `dbsession` is committed. If the transaction ends
+    otherwise (rollback or closed session), `on_rollback` is run instead.
+
+    Used to keep per-process caches in line with changes made by raw SQL statements, which must not
+    become visible to other requests before they are committed.
+    """
+    dbsession.info.setdefault(_TRANSACTION_CALLBACKS, []).append((on_commit, on_rollback))
+
+
+@event.listens_for(Session, "after_commit")
+def _run_commit_callbacks(dbsession):
+    for on_commit, _ in dbsession.info.pop(_TRANSACTION_CALLBACKS, []):
+        on_commit()
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _run_rollback_callbacks(dbsession, transaction):
+    if transaction.parent is not None:
+        return
+    for _, on_rollback in dbsession.info.pop(_TRANSACTION_CALLBACKS, []):
+        if on_rollback is not None:
+            on_rollback()
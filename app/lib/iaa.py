@@ -3,8 +3,10 @@ Inter-Annotator Agreement calculations
 """
 
 import logging
+from collections import Counter
 
 import numpy as np
+import pandas as pd
 
 # pylint: disable=too-many-return-statements
 def get_kappa_interpretation(kappa):
@@ -25,7 +27,265 @@ def get_kappa_interpretation(kappa):
     return "Almost perfect"
 
 
+def count_matrix(df):
+    """
+    Builds the (samples x categories) annotation count matrix from a DataFrame with the columns
+    `sample_index`, `anno_tag` and `cnt` (one row per sample and category).
+
+    Returns the sample indices (rows), the categories (columns) and the int32 count matrix.
+    Missing tags (NULL values) form a category of their own.
+    """
+    sample_codes, sample_indices = pd.factorize(df["sample_index"], sort=True)
+    tag_codes, categories = pd.factorize(df["anno_tag"], sort=True)
+    categories = list(categories)
+
+    # factorize marks missing values with -1, collect them in an additional column
+    if (tag_codes < 0).any():
+        tag_codes = np.where(tag_codes < 0, len(categories), tag_codes)
+        categories.append(None)
+
+    counts = np.zeros((len(sample_indices), len(categories)), dtype=np.int32)
+    np.add.at(counts, (sample_codes, tag_codes), df["cnt"].to_numpy(dtype=np.int32))
+    return np.asarray(sample_indices), categories, counts
+
+
+def get_alpha_interpretation(alpha):
+    if alpha is None or np.isnan(alpha):
+        return "Invalid Value"
+
+    if alpha >= 0.8:
+        return "Reliable"
+    if alpha >= 0.667:
+        return "Tentative"
+    return "Unreliable"
+
+
+def fleiss_components(counts, exclude_insufficient=False):
+    """
+    Computes the quantities Fleiss' kappa is based on from a (samples x categories) count matrix.
+
+    Unless `exclude_insufficient` is set, rows are normalized to the maximum number of annotations per sample `n`,
+    as if all annotators had annotated every sample. Otherwise rows with a single annotation are dropped.
+    Returns a dict with the number of samples `N`, `n`, the mean observed agreement `p_avg`
+    and the category proportions `p_j`, or None if there are no samples.
+    """
+    if counts.shape[0] == 0:
+        return None
+
+    row_total = counts.sum(axis=1)
+    n = row_total.max()
+
+    if exclude_insufficient:
+        keep = row_total > 1
+        counts = counts[keep].astype(np.float64)
+        row_total = row_total[keep].astype(np.float64)
+    else:
+        counts = counts / (row_total / n)[:, np.newaxis]
+        row_total = counts.sum(axis=1)
+
+    if counts.shape[0] == 0:
+        return None
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_i = np.where(row_total <= 1,
+                       1.0,
+                       (1.0 / (row_total * (row_total - 1))) * ((counts ** 2).sum(axis=1) - row_total))
+
+    return {
+            "N": counts.shape[0],
+            "n": n,
+            "p_avg": (1.0 / counts.shape[0]) * p_i.sum(),
+            "p_j": (1.0 / (counts.shape[0] * n)) * counts.sum(axis=0),
+            }
+
+
+def kappa_result(kappa, sample_count):
+    kappa = np.round(kappa, 4)
+    kappa_text = get_kappa_interpretation(kappa)
+
+    logging.debug("Fleiss' Kappa %s (%s), n=%s", kappa, kappa_text, sample_count)
+
+    if np.isnan(kappa):
+        kappa = None
+        kappa_text = "Unknown"
+
+    return {"type": "fleiss", "kappa": kappa, "interpretation": kappa_text, "n": sample_count}
+
+
+def fleiss_kappa_components(components):
+    """
+    Fleiss' kappa from the quantities returned by `fleiss_components` (or computed in the database,
+    see `DatasetTask.fleiss_components`).
+    """
+    if components is None:
+        return {"type": "fleiss", "kappa": None, "interpretation": "Insufficient data"}
+
+    p_avg_e = (np.asarray(components["p_j"], dtype=np.float64) ** 2).sum()
+
+    logging.debug("N=%s, n=%s, k=%s", components["N"], components["n"], len(components["p_j"]))
+    logging.debug("p_avg=%s, p_avg_e=%s", components["p_avg"], p_avg_e)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f_kappa = np.float64(components["p_avg"] - p_avg_e) / np.float64(1 - p_avg_e)
+
+    return kappa_result(f_kappa, components["N"])
+
+
+def fleiss_kappa_counts(counts, exclude_insufficient=False):
+    """
+    Fleiss' kappa of a (samples x categories) count matrix, see `fleiss_components`.
+    """
+    return fleiss_kappa_components(fleiss_components(counts, exclude_insufficient=exclude_insufficient))
+
+
+def fleiss_kappa_one_vs_rest(counts, categories, tags):
+    """
+    Per-tag Fleiss' kappa of a (samples x categories) count matrix in a single vectorized pass.
+
+    For each tag, all other categories are merged into one "rest" category and only samples with at least
+    one annotation of the tag are considered, which is equivalent to calling `fleiss_kappa` with
+    `filter_target=tag` on the counts of `tag` and `!tag`. Returns a dict of results by tag.
+    """
+    tag_counts = np.zeros((counts.shape[0], len(tags)), dtype=np.float64)
+    for tag_idx, tag in enumerate(tags):
+        if tag in categories:
+            tag_counts[:, tag_idx] = counts[:, categories.index(tag)]
+
+    row_total = counts.sum(axis=1).astype(np.float64)[:, np.newaxis]
+    rest_counts = row_total - tag_counts
+    # samples considered per tag
+    mask = tag_counts > 0
+    sample_counts = mask.sum(axis=0)
+
+    # normalize each sample to the maximum number of annotations per sample among the samples of each tag
+    n = np.where(mask, row_total, 0.0).max(axis=0, initial=0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = row_total / n
+        tag_counts = np.where(mask, tag_counts / scale, 0.0)
+        rest_counts = np.where(mask, rest_counts / scale, 0.0)
+        normalized_total = tag_counts + rest_counts
+
+        p_i = np.where(normalized_total <= 1,
+                       1.0,
+                       (1.0 / (normalized_total * (normalized_total - 1))) *
+                       (tag_counts ** 2 + rest_counts ** 2 - normalized_total))
+        p_avg = (1.0 / sample_counts) * np.where(mask, p_i, 0.0).sum(axis=0)
+
+        p_j_tag = (1.0 / (sample_counts * n)) * tag_counts.sum(axis=0)
+        p_j_rest = (1.0 / (sample_counts * n)) * rest_counts.sum(axis=0)
+        p_avg_e = p_j_tag ** 2 + p_j_rest ** 2
+        kappas = (p_avg - p_avg_e) / (1 - p_avg_e)
+
+    results = {}
+    for tag_idx, tag in enumerate(tags):
+        if sample_counts[tag_idx] == 0:
+            results[tag] = {"type": "fleiss", "kappa": None, "interpretation": "Insufficient data"}
+            continue
+        results[tag] = kappa_result(kappas[tag_idx], int(sample_counts[tag_idx]))
+    return results
+
+
+class FleissAggregate:
+    """
+    Incrementally maintained Fleiss' kappa (with rows normalized to the maximum number of annotations
+    per sample `n`, as in `fleiss_kappa`).
+
+    For a row with counts x_ij and total r_i, the normalized row contributes n^2 * S_i / r_i^2 (with S_i the sum
+    of squared counts) to the observed agreement and x_ij / r_i to the category proportions. Keeping these sums,
+    the per-sample counts and a histogram of row totals allows updating kappa in O(1) per annotation change.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.row_totals = Counter()
+        self.sum_squares_ratio = 0.0
+        self.category_ratios = Counter()
+
+    def _contribute(self, row, sign):
+        row_total = sum(row.values())
+        if row_total == 0:
+            return
+        self.row_totals[row_total] += sign
+        if self.row_totals[row_total] == 0:
+            del self.row_totals[row_total]
+        self.sum_squares_ratio += sign * sum(count ** 2 for count in row.values()) / row_total ** 2
+        for category, count in row.items():
+            self.category_ratios[category] += sign * count / row_total
+
+    def update(self, sample_index, removed_category=None, added_category=None, removed=False, added=False):
+        """
+        Applies one annotation change on a sample. `removed`/`added` signal whether an annotation
+        with `removed_category`/`added_category` was removed from or added to the sample.
+        """
+        row = self.rows.get(sample_index, None)
+        if row is None:
+            row = {}
+            self.rows[sample_index] = row
+        self._contribute(row, -1)
+
+        if removed and row.get(removed_category, 0) > 0:
+            row[removed_category] -= 1
+            if row[removed_category] == 0:
+                del row[removed_category]
+        if added:
+            row[added_category] = row.get(added_category, 0) + 1
+
+        self._contribute(row, 1)
+        if len(row) == 0:
+            del self.rows[sample_index]
+
+    def add_counts(self, sample_index, category, count):
+        """
+        Adds `count` annotations of a category on a sample, used when building the aggregate.
+        """
+        row = self.rows.get(sample_index, {})
+        self._contribute(row, -1)
+        row[category] = row.get(category, 0) + count
+        self.rows[sample_index] = row
+        self._contribute(row, 1)
+
+    def kappa(self):
+        sample_count = len(self.rows)
+        if sample_count == 0:
+            return {"type": "fleiss", "kappa": None, "interpretation": "Insufficient data"}
+
+        n = max(self.row_totals.keys())
+        if n <= 1:
+            p_avg = 1.0
+        else:
+            p_avg = (n ** 2 * self.sum_squares_ratio - sample_count * n) / (n * (n - 1)) / sample_count
+
+        p_avg_e = sum((category_ratio / sample_count) ** 2 for category_ratio in self.category_ratios.values())
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f_kappa = np.float64(p_avg - p_avg_e) / np.float64(1 - p_avg_e)
+        return kappa_result(f_kappa, sample_count)
+
+
 def fleiss_kappa(df, tags, exclude_insufficient=False, filter_target=None):
+    """
+    Fleiss' kappa of the annotation counts in `df` (columns `sample_index`, `anno_tag` and `cnt`).
+
+    If `filter_target` is given, only samples with at least one annotation of that tag are considered.
+    """
+    if df.shape[0] == 0:
+        return {"type": "fleiss", "kappa": None, "interpretation": "Insufficient data"}
+
+    _, categories, counts = count_matrix(df)
+
+    if filter_target is not None:
+        if filter_target not in categories:
+            return {"type": "fleiss", "kappa": None, "interpretation": "Insufficient data"}
+        counts = counts[counts[:, categories.index(filter_target)] > 0]
+
+    return fleiss_kappa_counts(counts, exclude_insufficient=exclude_insufficient)
+
+
+def fleiss_kappa_pandas(df, tags, exclude_insufficient=False, filter_target=None):
+    """
+    Reference implementation of `fleiss_kappa` based on a pivoted DataFrame,
+    kept to verify and benchmark the count matrix based implementation.
+    """
 
     if df.shape[0] == 0:
         return {"type": "fleiss", "kappa": None, "interpretation": "Insufficient data"}
@@ -92,3 +352,220 @@ def fleiss_kappa(df, tags, exclude_insufficient=False, filter_target=None):
         f_kappa_text = "Unknown"
 
     return {"type": "fleiss", "kappa": f_kappa, "interpretation": f_kappa_text, "n": df.shape[0]}
+
+
+# upper bound of weight matrix elements (replicates x samples) processed at once during bootstrapping
+BOOTSTRAP_BLOCK_ELEMENTS = 1 << 22
+
+
+def _weighted_max(weights, values):
+    """
+    Maximum of `values` among the entries with a positive weight, for each row of `weights`.
+    """
+    order = np.argsort(-values, kind="stable")
+    first = (weights[:, order] > 0).argmax(axis=1)
+    return np.where((weights > 0).any(axis=1), values[order][first], np.nan)
+
+
+def _weighted_kappa(weights, agreement, proportions, sample_counts, n):
+    """
+    Fleiss' kappa for each row of `weights` (resampled sample multiplicities), given the per-sample
+    agreement terms S_i / r_i^2, the per-sample category proportions x_ij / r_i and the
+    number of resampled samples and maximum row total per replicate.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_agreement = (weights @ agreement) / sample_counts
+        p_avg = np.where(n <= 1, 1.0, (n * mean_agreement - 1.0) / (n - 1.0))
+        p_j = (weights @ proportions) / sample_counts[:, np.newaxis]
+        p_avg_e = (p_j ** 2).sum(axis=1)
+        return (p_avg - p_avg_e) / (1 - p_avg_e)
+
+
+def bootstrap_fleiss_kappa(counts, categories, tags, replicates, seed=None):
+    """
+    Bootstrap replicates of the overall and per-tag (one-vs-rest) Fleiss' kappa of a (samples x categories)
+    count matrix, matching `fleiss_kappa_counts` and `fleiss_kappa_one_vs_rest`.
+
+    Samples are resampled with replacement and only their multiplicities are kept, so each block of
+    replicates is evaluated with a few matrix products instead of materializing the resampled matrices.
+    Returns a (replicates x (1 + len(tags))) array, the first column holds the overall kappa.
+    Replicates without any sample of a tag are NaN.
+    """
+    rng = np.random.default_rng(seed)
+    result = np.full((replicates, 1 + len(tags)), np.nan)
+    sample_count = counts.shape[0]
+    if sample_count == 0 or replicates == 0:
+        return result
+
+    counts = counts.astype(np.float64)
+    row_total = counts.sum(axis=1)
+    agreement = (counts ** 2).sum(axis=1) / row_total ** 2
+    proportions = counts / row_total[:, np.newaxis]
+
+    tag_ratio = np.zeros((sample_count, len(tags)), dtype=np.float64)
+    for tag_idx, tag in enumerate(tags):
+        if tag in categories:
+            tag_ratio[:, tag_idx] = proportions[:, categories.index(tag)]
+    tag_mask = (tag_ratio > 0).astype(np.float64)
+    tag_agreement = tag_mask * (tag_ratio ** 2 + (1.0 - tag_ratio) ** 2)
+
+    block_size = max(1, BOOTSTRAP_BLOCK_ELEMENTS // sample_count)
+    for block_start in range(0, replicates, block_size):
+        block_end = min(replicates, block_start + block_size)
+        # multiplicity of each sample in each replicate of the block
+        draws = rng.integers(0, sample_count, size=(block_end - block_start, sample_count))
+        draws += np.arange(block_end - block_start)[:, np.newaxis] * sample_count
+        weights = np.bincount(draws.ravel(), minlength=draws.size).reshape(draws.shape).astype(np.float64)
+
+        result[block_start:block_end, 0] = _weighted_kappa(weights, agreement, proportions,
+                                                           np.full(block_end - block_start, float(sample_count)),
+                                                           _weighted_max(weights, row_total))
+
+        tag_sample_counts = weights @ tag_mask
+        for tag_idx in range(len(tags)):
+            tag_weights = weights * tag_mask[:, tag_idx]
+            tag_proportions = np.stack([tag_ratio[:, tag_idx], tag_mask[:, tag_idx] - tag_ratio[:, tag_idx]], axis=1)
+            result[block_start:block_end, 1 + tag_idx] = _weighted_kappa(tag_weights,
+                                                                         tag_agreement[:, tag_idx],
+                                                                         tag_proportions,
+                                                                         tag_sample_counts[:, tag_idx],
+                                                                         _weighted_max(tag_weights, row_total))
+    return result
+
+
+def bootstrap_interval(replicate_kappas, confidence=0.95):
+    """
+    Percentile confidence interval of bootstrapped kappa values, ignoring undefined replicates.
+    """
+    replicate_kappas = np.asarray(replicate_kappas, dtype=np.float64)
+    replicate_kappas = replicate_kappas[~np.isnan(replicate_kappas)]
+    if replicate_kappas.shape[0] == 0:
+        return {"confidence": confidence, "lower": None, "upper": None, "replicates": 0}
+
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.quantile(replicate_kappas, [alpha, 1.0 - alpha])
+    return {"confidence": confidence,
+            "lower": float(np.round(lower, 4)),
+            "upper": float(np.round(upper, 4)),
+            "replicates": int(replicate_kappas.shape[0])}
+
+
+def _ranges(starts, sizes):
+    """
+    Concatenation of `arange(start, start + size)` for all pairs of `starts` and `sizes`.
+    """
+    return np.repeat(starts, sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+
+def coannotation_pairs(sample_codes, annotator_codes, value_codes):
+    """
+    Lists all ordered pairs of annotations by different annotators on the same sample.
+
+    Inputs are equally long integer arrays with one entry per annotation. Only samples with at least two
+    annotations produce pairs, so the cost scales with the number of overlapping annotations.
+    Returns the annotator and value codes of both sides and the number of annotations of the sample.
+    """
+    order = np.argsort(sample_codes, kind="stable")
+    annotator_codes, value_codes = annotator_codes[order], value_codes[order]
+
+    _, group_start, group_size = np.unique(sample_codes[order], return_index=True, return_counts=True)
+    multiple = group_size > 1
+    group_start, group_size = group_start[multiple], group_size[multiple]
+
+    # every annotation on a sample with multiple annotations is paired with all annotations on that sample
+    members = _ranges(group_start, group_size)
+    member_group_size = np.repeat(group_size, group_size)
+    left = np.repeat(members, member_group_size)
+    right = _ranges(np.repeat(group_start, group_size), member_group_size)
+    sample_size = np.repeat(member_group_size, member_group_size)
+
+    distinct = annotator_codes[left] != annotator_codes[right]
+    left, right, sample_size = left[distinct], right[distinct], sample_size[distinct]
+
+    return annotator_codes[left], value_codes[left], annotator_codes[right], value_codes[right], sample_size
+
+
+def cohen_kappa_matrix(sample_codes, annotator_codes, value_codes, annotator_count, value_count):
+    """
+    Cohen's kappa for every pair of annotators, based on the samples both of them annotated.
+
+    Returns two (annotators x annotators) matrices: kappa (NaN where annotators do not overlap or
+    kappa is undefined) and the number of shared samples.
+    """
+    annotator_a, value_a, annotator_b, value_b, _ = coannotation_pairs(sample_codes, annotator_codes, value_codes)
+    pair_codes = annotator_a * annotator_count + annotator_b
+    pair_count = annotator_count * annotator_count
+
+    shared = np.bincount(pair_codes, minlength=pair_count).astype(np.float64)
+    agreeing = np.bincount(pair_codes, weights=(value_a == value_b).astype(np.float64), minlength=pair_count)
+    marginal_a = np.bincount(pair_codes * value_count + value_a,
+                             minlength=pair_count * value_count).reshape(pair_count, value_count)
+    marginal_b = np.bincount(pair_codes * value_count + value_b,
+                             minlength=pair_count * value_count).reshape(pair_count, value_count)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_observed = agreeing / shared
+        p_expected = (marginal_a * marginal_b).sum(axis=1) / (shared ** 2)
+        kappa = (p_observed - p_expected) / (1 - p_expected)
+
+    # identical (single category) ratings of both annotators
+    kappa = np.where((shared > 0) & (p_expected == 1) & (p_observed == 1), 1.0, kappa)
+
+    return kappa.reshape(annotator_count, annotator_count), shared.reshape(annotator_count, annotator_count)
+
+
+def nominal_distance(value_count):
+    return 1.0 - np.eye(value_count)
+
+
+def jaccard_distance(value_sets):
+    """
+    Jaccard distance between set-valued annotations (e.g. of multiselect tasks), given as a list of sets.
+    """
+    elements = sorted(set().union(*value_sets)) if len(value_sets) > 0 else []
+    element_codes = {element: element_idx for element_idx, element in enumerate(elements)}
+
+    membership = np.zeros((len(value_sets), len(elements)), dtype=np.float64)
+    for value_idx, value_set in enumerate(value_sets):
+        membership[value_idx, [element_codes[element] for element in value_set]] = 1.0
+
+    intersection = membership @ membership.T
+    set_sizes = membership.sum(axis=1)
+    union = set_sizes[:, np.newaxis] + set_sizes[np.newaxis, :] - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, 1.0 - intersection / union, 0.0)
+
+
+def krippendorff_alpha(sample_codes, annotator_codes, value_codes, distance):
+    """
+    Krippendorff's alpha from the coincidence matrix of pairable annotations.
+
+    `distance` is a (values x values) matrix of squared distances between value codes,
+    see `nominal_distance` and `jaccard_distance`. Returns a dict with alpha and the number of pairable values.
+    """
+    value_count = distance.shape[0]
+    annotator_a, value_a, _, value_b, sample_size = coannotation_pairs(sample_codes, annotator_codes, value_codes)
+
+    if annotator_a.shape[0] == 0:
+        return {"type": "krippendorff", "alpha": None, "interpretation": "Insufficient data", "n": 0}
+
+    coincidences = np.bincount(value_a * value_count + value_b,
+                               weights=1.0 / (sample_size - 1),
+                               minlength=value_count * value_count).reshape(value_count, value_count)
+    value_totals = coincidences.sum(axis=1)
+    pairable = value_totals.sum()
+
+    observed = (coincidences * distance).sum()
+    expected = (np.outer(value_totals, value_totals) * distance).sum() / (pairable - 1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = 1.0 - observed / expected
+
+    alpha = np.round(alpha, 4)
+    if np.isnan(alpha):
+        return {"type": "krippendorff", "alpha": None, "interpretation": "Unknown", "n": int(round(pairable))}
+
+    return {"type": "krippendorff",
+            "alpha": float(alpha),
+            "interpretation": get_alpha_interpretation(alpha),
+            "n": int(round(pairable))}
@@ -3,12 +3,15 @@ Model for generic activities (e.g. change events, comments).
 """
 import logging
 import json
+from collections import defaultdict
 
-from sqlalchemy import Column, Integer, String, desc, func, ForeignKey, and_, or_, not_
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Index, desc, func, ForeignKey, and_, or_, not_
+from sqlalchemy.orm import relationship, joinedload, lazyload
 from sqlalchemy.types import DateTime
 
 from app.lib.database_internals import Base
+from app.lib.models.datasetcontent import DatasetContent
+from app.lib.models.task import DatasetTask
 import app.lib.database as db
 
 
@@ -25,21 +28,107 @@ class Activity(Base):
 
     # the target column encodes which item (dataset, sample, ...) this activity event refers to
     target = Column(String, nullable=False)
+    # structured form of the target (e.g. "DATASET" and 42 for "DATASET:42") used to filter activities,
+    # null for targets that do not follow the "<TYPE>:<ID>" format
+    target_type = Column(String, nullable=True)
+    target_id = Column(Integer, nullable=True)
     # the scope may be used to restrict an activitiy, e.g. to switch a comment
     # between public/curator-only visibility
     scope = Column(String, nullable=False, default="")
 
     content = Column(String, nullable=False)
 
+    __table_args__ = (
+        # serves the home feed and comment threads, i.e. the latest events of given scopes for a target
+        Index("ix_activity_target_scope_event", target_type, target_id, scope, event_id.desc()),
+        {},
+    )
+
     def load_target(self, dbsession):
         if self.target is None:
             return None
+        return Activity.load_targets(dbsession, [self]).get(self.target)
+
+    @staticmethod
+    def parse_target(target):
+        """
+        Splits an activity target (e.g. "DATASET:42") into its type ("DATASET") and integer ID.
+        Returns `(None, None)` for targets that do not follow this format.
+        """
+        if target is None or ":" not in target:
+            return None, None
+
+        target_type, target_id = target.split(":", 1)
+        if target_type == "" or not target_id.isdigit():
+            return None, None
+        return target_type, int(target_id)
+
+    @staticmethod
+    def target_filter(target):
+        """
+        Filter criterion for activities that refer to `target` (an entity or activity target string).
+        """
+        target = Activity.to_activity_target(target)
+        target_type, target_id = Activity.parse_target(target)
+        if target_type is None:
+            return Activity.target == target
+        return and_(Activity.target_type == target_type, Activity.target_id == target_id)
+
+    @staticmethod
+    def _target_queries(dbsession):
+        """
+        Queries and ID columns by target type for `load_targets`. Dataset owners are not required to
+        display targets, so they are not eagerly joined.
+        """
+        target_queries = {
+            db.User.activity_prefix(): (dbsession.query(db.User), db.User.uid),
+            db.Dataset.activity_prefix(): (
+                dbsession.query(db.Dataset).options(lazyload(db.Dataset.owner)),
+                db.Dataset.dataset_id,
+            ),
+            DatasetContent.activity_prefix(): (
+                dbsession.query(DatasetContent).options(
+                    joinedload(DatasetContent.dataset).lazyload(db.Dataset.owner)
+                ),
+                DatasetContent.sample_index,
+            ),
+            DatasetTask.activity_prefix(): (
+                dbsession.query(DatasetTask).options(joinedload(DatasetTask.dataset).lazyload(db.Dataset.owner)),
+                DatasetTask.task_id,
+            ),
+        }
+        return {prefix.rstrip(":"): target_query for prefix, target_query in target_queries.items()}
+
+    @staticmethod
+    def load_targets(dbsession, activities):
+        """
+        Resolves the targets of multiple activities with a single query per target type.
+        Returns a dictionary from target string to the target entity (None if it no longer exists).
+        """
+        target_ids = defaultdict(set)
+        resolved_targets = {}
+
+        for activity in activities:
+            if activity.target is None or activity.target in resolved_targets:
+                continue
+            target_type, target_id = Activity.parse_target(activity.target)
+            target_ids[target_type].add(target_id)
+            resolved_targets[activity.target] = None
+
+        target_queries = Activity._target_queries(dbsession)
+        for target_type, ids in target_ids.items():
+            if target_type not in target_queries:
+                continue
+            qry, id_column = target_queries[target_type]
+            for entity in qry.filter(id_column.in_(ids)).all():
+                resolved_targets[entity.activity_target()] = entity
+
+        for target in resolved_targets:
+            target_type, _ = Activity.parse_target(target)
+            if target_type not in target_queries:
+                resolved_targets[target] = "unknown target %s" % target
 
-        if self.target.startswith(db.User.activity_prefix()):
-            return db.User.by_id(dbsession, int(self.target[len(db.User.activity_prefix()) :]), no_error=True)
-        if self.target.startswith(db.Dataset.activity_prefix()):
-            return db.Dataset.by_id(dbsession, int(self.target[len(db.Dataset.activity_prefix()) :]), no_error=True)
-        return "unknown target %s" % self.target
+        return resolved_targets
 
     @staticmethod
     def user_history(dbsession, owner, scope_in=None, limit=None):
@@ -51,19 +140,20 @@ class Activity(Base):
         if isinstance(owner, int):
             owner = db.User.by_id(dbsession, owner)
 
-        user_target_filter = owner.activity_target()
         other_accessible_datasets = db.datasets.accessible_datasets(
             dbsession, owner, include_owned=False, has_role=["curator", "owner"]
         )
-        other_accessible_datasets = [dataset.activity_target() for dsid, dataset in other_accessible_datasets.items()]
+        other_accessible_datasets = [dataset.dataset_id for dsid, dataset in other_accessible_datasets.items()]
+        dataset_target_type = db.Dataset.activity_prefix().rstrip(":")
         excluded_scopes = ["event", "upload_file"]
 
         if isinstance(owner, db.User):
             qry = qry.filter(
                 or_(
-                    Activity.target == user_target_filter,
+                    Activity.target_filter(owner),
                     Activity.owner == owner,
-                    and_(Activity.target.in_(other_accessible_datasets),
+                    and_(Activity.target_type == dataset_target_type,
+                        Activity.target_id.in_(other_accessible_datasets),
                         not_(Activity.scope == "comment_note"),
                         not_(Activity.scope == "rename_tag")),
                 )
@@ -122,7 +212,8 @@ class Activity(Base):
                 continue
             result_history.append(activity)
 
-        result_history = [[activity, activity.load_target(dbsession)] for activity in result_history]
+        targets = Activity.load_targets(dbsession, result_history)
+        result_history = [[activity, targets.get(activity.target)] for activity in result_history]
 
         return result_history
 
@@ -154,10 +245,13 @@ class Activity(Base):
     def by_target(dbsession, target, scope_in=None, like_target=False):
         qry = dbsession.query(Activity)
 
-        if like_target:
+        if like_target and target.endswith(":%") and "%" not in target[:-1]:
+            # all targets of a type, e.g. "DATASET:%"
+            qry = qry.filter(Activity.target_type == target[:-2])
+        elif like_target:
             qry = qry.filter(Activity.target.like(target))
         else:
-            qry = qry.filter_by(target=target)
+            qry = qry.filter(Activity.target_filter(target))
 
         if scope_in is not None and len(scope_in) > 0:
             qry = qry.filter(Activity.scope.in_(scope_in))
@@ -187,6 +281,7 @@ class Activity(Base):
         log_activity = Activity()
         log_activity.owner = owner
         log_activity.target = target
+        log_activity.target_type, log_activity.target_id = Activity.parse_target(target)
         log_activity.scope = scope
         log_activity.content = content
 
@@ -1,7 +1,7 @@
 """
 Single annotation entity.
 """
-from sqlalchemy import Column, Integer, String, JSON, ForeignKey, and_, ForeignKeyConstraint
+from sqlalchemy import Column, Integer, String, JSON, ForeignKey, and_, ForeignKeyConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.attributes import flag_dirty, flag_modified
 
@@ -31,6 +31,8 @@ class Annotation(Base):
             [dataset_id, sample, sample_index],
             [DatasetContent.dataset_id, DatasetContent.sample, DatasetContent.sample_index],
         ),
+        # lookups of a user's own annotations by sample, e.g. anti-joins during sample navigation
+        Index("ix_annotations_dataset_owner_sample", dataset_id, owner_id, sample_index, task_id),
         {},
     )
 
@@ -0,0 +1,49 @@
+"""
+Annotation cursor entity.
+
+Keeps track of the furthest sample (by `sample_index`) a user annotated per dataset and task, so that sequential
+annotation resumes from there instead of scanning the dataset from its first sample.
+The cursor is moved forward by `Dataset.setannos`, which also increments its revision. The revisions of all
+cursors of a task make up the task's annotation version, see `DatasetTask.current_annotation_version`.
+"""
+from sqlalchemy import Column, Integer, ForeignKey, Index, func
+
+from app.lib.database_internals import Base
+
+
+class AnnotationCursor(Base):
+    __tablename__ = "annotationcursor"
+
+    owner_id = Column(Integer, ForeignKey("users.uid"), primary_key=True)
+    dataset_id = Column(Integer, ForeignKey("datasets.dataset_id"), primary_key=True)
+    task_id = Column(Integer, primary_key=True)
+
+    sample_index = Column(Integer, nullable=False)
+    # number of annotation writes through this cursor
+    revision = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        # sums up the annotation version of a task
+        Index("ix_annotationcursor_task_revision", task_id, revision),
+        {},
+    )
+
+    def __repr__(self):
+        return "<AnnotationCursor (dataset: %s, task: %s, owner: %s, sample_index: %s)>" % (
+            self.dataset_id,
+            self.task_id,
+            self.owner_id,
+            self.sample_index,
+        )
+
+    @staticmethod
+    def position(dbsession, dataset_id, owner_id, task_id=None):
+        """
+        Returns the furthest sample index the user annotated in the given task (or any task), None if there is none.
+        """
+        query = dbsession.query(func.max(AnnotationCursor.sample_index)).filter(
+                AnnotationCursor.dataset_id == dataset_id,
+                AnnotationCursor.owner_id == owner_id)
+        if task_id is not None:
+            query = query.filter(AnnotationCursor.task_id == int(task_id))
+        return query.scalar()
@@ -4,7 +4,7 @@ Main dataset entity
 from datetime import datetime
 import json
 import logging
-import random
+import secrets
 import os
 import os.path
 import re
@@ -12,36 +12,60 @@ from dataclasses import dataclass, field
 from typing import List
 from urllib.parse import urlparse
 
-from sqlalchemy import Column, Integer, JSON, ForeignKey, func, sql, or_, and_, inspect
+from sqlalchemy import Column, Integer, JSON, ForeignKey, sql, and_, inspect
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.orm.attributes import flag_dirty, flag_modified
 from flask import flash
 
 import pandas as pd
-from pandas.api.types import is_numeric_dtype
 import numpy as np
 
 import app.lib.config as config
+import app.lib.annobitmap as annobitmap
+import app.lib.analyticscache as analyticscache
+import app.lib.colprofile as colprofile
 from app.lib.database_internals import Base
 from app.lib.models.datasetcontent import DatasetContent
 from app.lib.models.task import DatasetTask
 from app.lib.models.user import User
 from app.lib.models.activity import Activity
 from app.lib.models.annotation import Annotation
+from app.lib.models.sampleorder import SampleOrder
+from app.lib.models.samplelease import SampleLease
+from app.lib.models.annotationcursor import AnnotationCursor
+from app.lib.models.splitsummary import SplitSummary
 from app.lib.npencoder import NpEncoder
 
 DATASET_CONTENT_CACHE = {}
 
 
-def pd_expand_json_column(df, json_column):
+def expand_json_records(records, exclude_columns=None):
     """
-    https://stackoverflow.com/a/25512372
+    Expands the additional fields of samples (dicts, or None for samples without data) into a `pandas.DataFrame`
+    with one column per field, in order of first appearance.
+
+    Each column is allocated once and filled in a single pass over the fields of all records, missing fields
+    are None. Columns holding only values of a single primitive type are converted to typed columns.
     """
-    df = pd.concat(
-            [df, json_column.apply(lambda content: pd.Series(list(content.values()), index=list(content.keys())))],
-            axis=1
-            )
-    return df.drop(columns=['data'])
+    if exclude_columns is None:
+        exclude_columns = []
+
+    record_count = len(records)
+    columns = {}
+    for row_idx, record in enumerate(records):
+        if not record:
+            continue
+        for key, value in record.items():
+            column = columns.get(key, None)
+            if column is None:
+                if key in exclude_columns:
+                    continue
+                column = np.full(record_count, None, dtype=object)
+                columns[key] = column
+            column[row_idx] = value
+
+    return pd.DataFrame(columns, index=pd.RangeIndex(record_count)).infer_objects()
 
 
 def calculate_row_state(row, additional_user_columns):
@@ -67,6 +91,21 @@ def calculate_row_state(row, additional_user_columns):
     return row_state
 
 
+def parse_anno_value(value):
+    """
+    Normalizes annotation values as submitted by clients.
+    Strings are stripped and JSON lists (e.g. for multiselect tasks) are decoded.
+    """
+    if value is not None and isinstance(value, str):
+        value = value.strip()
+        if value.startswith("[") and value.endswith("]"):
+            try:
+                value = json.loads(value)
+            except ValueError as ve:
+                raise ValueError(f"could not decode {value}: {ve}")
+    return value
+
+
 def restore_anno_values(v):
     if v is not None and isinstance(v, str):
         try:
@@ -87,6 +126,10 @@ class Dataset(Base):
     dsannotations = relationship("Annotation", cascade="all, delete-orphan")
     dscontent = relationship("DatasetContent", cascade="all, delete-orphan")
     dstasks = relationship("DatasetTask", cascade="all, delete-orphan", order_by="DatasetTask.taskorder")
+    dssampleorders = relationship("SampleOrder", cascade="all, delete-orphan")
+    dssampleleases = relationship("SampleLease", cascade="all, delete-orphan")
+    dsannotationcursors = relationship("AnnotationCursor", cascade="all, delete-orphan")
+    dssplitsummary = relationship("SplitSummary", cascade="all, delete-orphan")
 
     dsmetadata = Column(JSON, nullable=False)
 
@@ -94,14 +137,30 @@ class Dataset(Base):
     _cached_df = None
     valid_option_keys = set(["annotators_can_comment", "allow_restart_annotation", "additional_column"])
 
+    def split_version(self, dbsession):
+        """
+        Version that changes whenever samples are added to, moved between or removed from splits,
+        see `SplitSummary.version`.
+        """
+        return SplitSummary.version(dbsession, self.dataset_id)
+
+    def refresh_split_sizes(self, dbsession):
+        """
+        Counts the samples per split after samples were added or removed, see `SplitSummary.refresh`.
+        Split edits record the samples they move themselves.
+        """
+        SplitSummary.refresh(dbsession, self.dataset_id)
+
     def defined_splits(self, dbsession):
-        split_content_counts = dbsession.query(DatasetContent.split_id, func.count(DatasetContent.sample))
-        split_content_counts = split_content_counts.filter_by(dataset_id=self.dataset_id)
-        split_content_counts = split_content_counts.group_by(DatasetContent.split_id).all()
+        """
+        Returns the metadata and size of each split. Sizes are read from the split summary, which is maintained
+        by the statements that change splits (see `SplitSummary`).
+        """
+        split_sizes = SplitSummary.sizes(dbsession, self.dataset_id)
 
         split_info = {}
         split_metadata = self.dsmetadata.get("splitdetails", {})
-        for ds_split, ds_split_count in split_content_counts:
+        for ds_split, ds_split_count in split_sizes:
             split_info[ds_split] = split_metadata.get(ds_split, {}) or {}
             split_info[ds_split]['size'] = ds_split_count
         return split_info
@@ -189,13 +248,18 @@ class Dataset(Base):
 
         # update dataset content to new split
 
-        statement = sql.text("""
+        update_raw = prep_sql("""
         UPDATE datasetcontent AS dc
             SET split_id = :targetnew
+        FROM datasetcontent AS previous
         WHERE
             dc.dataset_id = :datasetid
+            AND previous.dataset_id = dc.dataset_id
+            AND previous.sample_index = dc.sample_index
+            AND previous.sample = dc.sample
             AND
         """ + self._split_target(target_old) + """
+        RETURNING dc.split_id, previous.split_id AS previous_split_id
         """)
 
         params = {
@@ -205,14 +269,14 @@ class Dataset(Base):
         if target_old != "" and target_old is not None:
             params["targetold"] = target_old
 
-        sqlres = dbsession.execute(statement, params=params)
-        affected = sqlres.rowcount
+        affected = SplitSummary.tracked_update(dbsession, self.dataset_id, update_raw, params)
 
         # create an activity to track this change
         Activity.create(dbsession, session_user, self, "split_edit",
                         "renamed split '%s' to '%s' (affected: %s)" %
                         (target_old, target_new, affected))
 
+        self.invalidate()
         self.dirty(dbsession)
         return affected
 
@@ -245,6 +309,97 @@ class Dataset(Base):
 
         return minval, maxval
 
+    def field_histogram(self, dbsession, fieldid, bins=20, parts=2, targetsplit=None):
+        """
+        Fixed-bin histogram of a numeric additional field, computed with a single aggregate query
+        over the value range stored in the field profiles (see `field_profiles`).
+
+        If `targetsplit` is given (None for all samples), only samples in that split are counted.
+        Returns the bin edges and counts, approximate quartiles and the `parts - 1` values that
+        split the samples into parts of (approximately) equal size, or None if the field is not numeric.
+        """
+        field_profile = self.field_profiles(dbsession)["columns"].get(fieldid, None)
+        if field_profile is None or not field_profile.get("numeric", False) or field_profile.get("min", None) is None:
+            return None
+
+        minval, maxval = field_profile["min"], field_profile["max"]
+        bins = max(1, int(bins))
+        if maxval <= minval:
+            bins = 1
+
+        params = {
+                "datasetid": self.dataset_id,
+                "targetcolumn": fieldid,
+                "minval": minval,
+                "maxval": maxval if maxval > minval else minval + 1.0,
+                "bins": bins,
+                }
+        split_where = ""
+        if targetsplit is not None:
+            split_where = "AND " + self._split_target(targetsplit)
+            params["targetold"] = targetsplit
+
+        # width_bucket places values outside of [minval, maxval) in buckets 0 and bins + 1
+        sql_raw = prep_sql("""
+            SELECT GREATEST(1, LEAST(:bins, width_bucket((dc.data->>:targetcolumn)::float, :minval, :maxval, :bins)))
+                AS bucket, COUNT(*) AS cnt
+            FROM datasetcontent AS dc
+            WHERE
+                dc.dataset_id = :datasetid
+                AND jsonb_typeof(dc.data::jsonb -> :targetcolumn) = 'number'
+                {split_where}
+            GROUP BY 1
+        """.format(split_where=split_where))
+
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+        counts = np.zeros(bins, dtype=np.int64)
+        for row in dbsession.execute(sql.text(sql_raw), params=params):
+            counts[row["bucket"] - 1] += row["cnt"]
+
+        edges = np.linspace(minval, params["maxval"], bins + 1)
+        parts = max(2, int(parts))
+        quartiles = colprofile.histogram_quantiles(edges, counts, [0.25, 0.5, 0.75])
+
+        return {
+                "field": fieldid,
+                "min": minval,
+                "max": maxval,
+                "count": int(counts.sum()),
+                "edges": [float(edge) for edge in edges],
+                "counts": counts.tolist(),
+                "quartiles": quartiles,
+                "suggested_splits": colprofile.histogram_quantiles(edges, counts,
+                                                                   [part / parts for part in range(1, parts)]),
+                }
+
+    def _split_stratum(self, session_user, splitoptions, params):
+        """
+        SQL expression and join determining the stratum of a sample for stratified splits. Strata are the values of
+        the additional field `splitcolumn` or, if `splittask` is given, the labels the user assigned in that task.
+        Samples without a value form a stratum of their own.
+        """
+        splittask = splitoptions.get("splittask", None) or None
+        if splittask is not None:
+            _, stratum_task = self.task_by_id(splittask)
+            if stratum_task is None:
+                raise Exception("task %s not found for stratified split" % splittask)
+            params["stratum_task"] = stratum_task.task_id
+            params["stratum_owner"] = session_user.uid
+            stratum_join = """
+            LEFT JOIN annotations AS stratum_anno
+                ON stratum_anno.dataset_id = dc.dataset_id
+                AND stratum_anno.sample_index = dc.sample_index
+                AND stratum_anno.task_id = :stratum_task
+                AND stratum_anno.owner_id = :stratum_owner
+            """
+            return "stratum_anno.data->'value' #>> '{}'", stratum_join, " task:'%s'" % stratum_task.task_id
+
+        splitcolumn = splitoptions.get("splitcolumn", None) or None
+        if splitcolumn is None:
+            raise Exception("no column or task specified for stratified split")
+        params["stratum_column"] = splitcolumn
+        return "dc.data->>:stratum_column", "", " column:'%s'" % splitcolumn
+
     def split_dataset(self, dbsession, session_user, targetsplit, splitoptions):
         splitmethod = splitoptions.get("splitmethod", "")
         if splitmethod == "" or splitmethod is None:
@@ -270,11 +425,16 @@ class Dataset(Base):
 
             sql_raw = """
             UPDATE datasetcontent AS dc
-                SET split_id = TRIM(BOTH FROM (split_id || ' / ' || :trimtargetcolumn || '=' || (TRIM(both ' "' FROM data->>:targetcolumn))::TEXT))
+                SET split_id = TRIM(BOTH FROM (dc.split_id || ' / ' || :trimtargetcolumn || '=' || (TRIM(both ' "' FROM dc.data->>:targetcolumn))::TEXT))
+            FROM datasetcontent AS previous
             WHERE
                 dc.dataset_id = :datasetid
+                AND previous.dataset_id = dc.dataset_id
+                AND previous.sample_index = dc.sample_index
+                AND previous.sample = dc.sample
                 AND
             """ + target_criterion + """
+            RETURNING dc.split_id, previous.split_id AS previous_split_id
             """
         elif splitmethod == "value":
             splitcolumn = splitoptions.get("splitcolumn", None) or None
@@ -291,78 +451,96 @@ class Dataset(Base):
 
             sql_raw = """
             UPDATE datasetcontent AS dc
-                SET split_id = CASE WHEN (data->>:targetcolumn)::float < :splitvalue
-                    THEN TRIM(BOTH FROM (split_id || ' / ' || :trimtargetcolumn || '<' || :splitvalue))
-                    ELSE TRIM(BOTH FROM (split_id || ' / ' || :trimtargetcolumn || '>=' || :splitvalue))
+                SET split_id = CASE WHEN (dc.data->>:targetcolumn)::float < :splitvalue
+                    THEN TRIM(BOTH FROM (dc.split_id || ' / ' || :trimtargetcolumn || '<' || :splitvalue))
+                    ELSE TRIM(BOTH FROM (dc.split_id || ' / ' || :trimtargetcolumn || '>=' || :splitvalue))
                     END
+            FROM datasetcontent AS previous
             WHERE
                 dc.dataset_id = :datasetid
+                AND previous.dataset_id = dc.dataset_id
+                AND previous.sample_index = dc.sample_index
+                AND previous.sample = dc.sample
                 AND
             """ + target_criterion + """
+            RETURNING dc.split_id, previous.split_id AS previous_split_id
             """
-        elif splitmethod in ["ratio", "evenly"]:
-
-            # gather target IDs
-            id_query = dbsession.query(DatasetContent.sample_index).filter_by(dataset_id=self.dataset_id)
-            if targetsplit is None or targetsplit == "":
-                # pylint: disable=singleton-comparison
-                id_query = id_query.filter(or_(DatasetContent.split_id == "", DatasetContent.split_id == None))
+        elif splitmethod in ["ratio", "evenly", "stratified"]:
+            # samples are ordered by a hash of a seed and their index, which is a reproducible shuffle
+            # that is computed and applied in a single statement
+            seed = str(splitoptions.get("seed", None) or secrets.token_hex(8))
+            params["seed"] = seed
+
+            # stratified splits shuffle and partition the samples within each value of an attribute or curated label
+            stratum_join = ""
+            stratum_partition = ""
+            stratum_order = ""
+            stratum_description = ""
+            if splitmethod == "stratified":
+                stratum, stratum_join, stratum_description = self._split_stratum(session_user, splitoptions, params)
+                stratum_partition = "PARTITION BY %s" % stratum
+                stratum_order = "%s, " % stratum
+
+            if splitmethod == "ratio" or (splitmethod == "stratified" and splitoptions.get("splitratio", None)):
+                new_ratio = (splitoptions.get("splitratio", "") or "").strip()
+                if new_ratio == "" or '-' not in new_ratio:
+                    raise Exception('missing valid ratio argument')
+                params["ratio_a"] = int(new_ratio.split("-")[0])
+                split_count = 2
+                # the first part takes the samples in the first ratio_a percent of the shuffled order (of each stratum),
+                # the second part all others
+                label_position = "CASE WHEN (shuffled.position + 0.5) / shuffled.total < :ratio_a / 100.0" \
+                                 " THEN 1 ELSE 2 END"
             else:
-                id_query = id_query.filter_by(split_id=targetsplit)
-
-            all_affected_ids = [t[0] for t in id_query.all()]
-
-            # shuffle affected ID list
-            random.shuffle(all_affected_ids)
+                split_count = int(splitoptions.get("splitcount", "2") or "2")
+                if split_count < 1:
+                    raise Exception("splitcount needs to be positive")
+                params["split_count"] = split_count
+                # samples are dealt round-robin in shuffled order, stratum by stratum, continuing across strata
+                # so that remainders of small strata do not all end up in the first parts
+                label_position = "(shuffled.global_position % :split_count) + 1"
+
+            params["labels"] = [("%s / %s" % (targetsplit, chr(ord('A') + idx))).strip(" /")
+                                for idx in range(split_count)]
+
+            split_raw = prep_sql("""
+            WITH shuffled AS (
+                SELECT dc.sample_index, dc.split_id AS previous_split_id,
+                    ROW_NUMBER() OVER (
+                        {stratum_partition}
+                        ORDER BY md5(:seed || ':' || dc.sample_index::text), dc.sample_index
+                    ) - 1 AS position,
+                    ROW_NUMBER() OVER (
+                        ORDER BY {stratum_order}md5(:seed || ':' || dc.sample_index::text), dc.sample_index
+                    ) - 1 AS global_position,
+                    COUNT(*) OVER ({stratum_partition}) AS total
+                FROM datasetcontent AS dc
+                {stratum_join}
+                WHERE
+                    dc.dataset_id = :datasetid
+                    AND {target_criterion}
+            )
+            UPDATE datasetcontent AS dc
+                SET split_id = (CAST(:labels AS TEXT[]))[{label_position}]
+            FROM shuffled
+            WHERE
+                dc.dataset_id = :datasetid
+                AND dc.sample_index = shuffled.sample_index
+            RETURNING dc.split_id, shuffled.previous_split_id
+            """.format(target_criterion=target_criterion, label_position=label_position,
+                       stratum_partition=stratum_partition, stratum_order=stratum_order, stratum_join=stratum_join))
 
-            newsplits = []
+            affected = SplitSummary.tracked_update(dbsession, self.dataset_id, split_raw, params)
 
-            if splitmethod == "ratio":
-                new_ratio = splitoptions.get("splitratio", "").strip()
-                if new_ratio == "" or '-' not in new_ratio:
-                    raise Exception('missing valid ratio argument')
-                new_ratio_a = int(new_ratio.split("-")[0])
-
-                # since the IDs were shuffled, we can just take N elements for the first ratio
-                # and treat the rest as the second one
-
-                new_ratio_a_size = max(1, int(len(all_affected_ids) * (new_ratio_a/100.0)))
-                newsplits = [
-                        all_affected_ids[:new_ratio_a_size],
-                        all_affected_ids[new_ratio_a_size:]
-                        ]
-            elif splitmethod == "evenly":
-                num_chunks = int(splitoptions.get("splitcount", "2"))
-                newsplits = [[] for _ in range(num_chunks)]
-                for idx, sample_id in enumerate(all_affected_ids):
-                    target_bucket = newsplits[idx % num_chunks]
-                    target_bucket.append(sample_id)
-
-            if len(newsplits) > 0:
-                newsplit_identifiers = [("%s / %s" % (targetsplit, chr(ord('A') + idx))).strip(" /") for idx in range(len(newsplits))]
-                for newsplit_index, newsplit_ids in enumerate(newsplits):
-                    newsplit_label = newsplit_identifiers[newsplit_index]
-
-                    update_query = dbsession.query(DatasetContent).filter_by(dataset_id=self.dataset_id)
-                    if targetsplit is None or targetsplit == "":
-                        update_query = update_query.filter(or_(DatasetContent.split_id == "", DatasetContent.split_id == None))
-                    else:
-                        update_query = update_query.filter_by(split_id=targetsplit)
-                    update_query = update_query.filter(DatasetContent.sample_index.in_(newsplit_ids))
-                    affected += update_query.update({"split_id": newsplit_label}, synchronize_session='fetch')
-
-                Activity.create(dbsession, session_user, self, "split_edit",
-                                "forked split '%s' method:'%s' (affected: %s, new splits: %s)" %
-                                (targetsplit, splitmethod, affected, len(newsplits)))
+            Activity.create(dbsession, session_user, self, "split_edit",
+                            "forked split '%s' method:'%s'%s (affected: %s, new splits: %s, seed: %s)" %
+                            (targetsplit, splitmethod, stratum_description, affected, split_count, seed))
+            self.dirty(dbsession)
         else:
             raise Exception("no implementation found for split method %s" % (splitmethod))
 
         if sql_raw is not None:
-            sql_raw = prep_sql(sql_raw)
-            logging.debug("DB_SQL_LOG %s %s", sql, params)
-            statement = sql.text(sql_raw)
-            sqlres = dbsession.execute(statement, params=params)
-            affected = sqlres.rowcount
+            affected = SplitSummary.tracked_update(dbsession, self.dataset_id, prep_sql(sql_raw), params)
 
             Activity.create(dbsession, session_user, self, "split_edit",
                             "forked split '%s' method:'%s' (affected: %s)" %
@@ -370,6 +548,7 @@ class Dataset(Base):
 
             self.dirty(dbsession)
 
+        self.invalidate()
         return affected
 
     @staticmethod
@@ -653,6 +832,18 @@ class Dataset(Base):
             return False
         return True
 
+    def get_annotation_splits(self, dbsession, for_user):
+        """
+        Returns the set of splits the user may annotate, or None if the user can annotate the whole dataset.
+        """
+        if "annotator" in self.get_roles(dbsession, for_user, splitroles=False):
+            return None
+
+        annotation_splits = self.get_annotator_splits(dbsession, for_user)
+        if annotation_splits is not None and len(annotation_splits) == 0:
+            return None
+        return annotation_splits
+
     def get_task(self, dbsession, for_user):
         if not self.accessible_by(dbsession, for_user):
             return None
@@ -667,21 +858,15 @@ class Dataset(Base):
 
         task_size = self.get_size()
 
-        global_roles = self.get_roles(dbsession, for_user, splitroles=False)
-
-        annotation_splits = None
-        if "annotator" not in global_roles:
-            annotation_splits = self.get_annotator_splits(dbsession, for_user)
-            if annotation_splits is not None and len(annotation_splits) == 0:
-                annotation_splits = None
-            if annotation_splits is not None:
-                dataset_splits = self.defined_splits(dbsession)
-                task_size = 0
+        annotation_splits = self.get_annotation_splits(dbsession, for_user)
+        if annotation_splits is not None:
+            dataset_splits = self.defined_splits(dbsession)
+            task_size = 0
 
-                for split_id in annotation_splits:
-                    if split_id not in dataset_splits:
-                        continue
-                    task_size += dataset_splits[split_id].get("size", 0)
+            for split_id in annotation_splits:
+                if split_id not in dataset_splits:
+                    continue
+                task_size += dataset_splits[split_id].get("size", 0)
 
         task = AnnotationTask(id=self.dataset_id,
                               name=self.get_name(),
@@ -725,6 +910,8 @@ class Dataset(Base):
             migrated_annotations += 1
 
         dbsession.flush()
+        if migrated_annotations > 0:
+            update_taskdef.bump_annotation_version(dbsession)
 
         return migrated_annotations
 
@@ -744,7 +931,12 @@ class Dataset(Base):
                     user_column=None, restrict_view=None, only_user=False, with_content=True,
                     query=None, order_by=None, min_sample_index=None,
                     splits=None,
-                    tags_include=None, tags_exclude=None):
+                    tags_include=None, tags_exclude=None, with_data=False):
+        """
+        Returns a page of samples along with annotation columns, the list of annotation columns and the
+        total number of matching samples. If `with_data` is set, the additional fields of each sample
+        are included as columns after the sample content.
+        """
 
         if restrict_view is not None and not isinstance(restrict_view, list):
             restrict_view = [restrict_view]
@@ -765,6 +957,8 @@ class Dataset(Base):
         field_list = ["dc.sample_index AS sample_index", "dc.sample AS sample_id"]
         if with_content:
             field_list.append("dc.content AS sample_content")
+        if with_data:
+            field_list.append("dc.data AS sample_data")
 
         params = {
                 "dataset_id": self.dataset_id
@@ -959,6 +1153,13 @@ class Dataset(Base):
         for col in annotation_columns:
             df[col] = df[col].apply(restore_anno_values)
 
+        if with_data:
+            data_position = df.columns.get_loc("sample_data")
+            data_df = expand_json_records(df["sample_data"].tolist(), exclude_columns=list(df.columns))
+            df = df.drop(columns=["sample_data"])
+            for column_offset, data_column in enumerate(data_df.columns):
+                df.insert(data_position + column_offset, data_column, data_df[data_column].to_numpy())
+
         return df, annotation_columns, df_count
 
     def task_by_id(self, task_id):
@@ -1060,268 +1261,438 @@ class Dataset(Base):
         qry = self.content_query(dbsession).filter_by(sample_index=int(sample_index))
         return qry.one_or_none()
 
-    def get_next_sample(self, dbsession, sample_index, user_obj, splits, exclude_annotated=True):
-        if sample_index is None:
-            return None, None
+    def _adjacent_sample(self, dbsession, sample_index, user_obj, splits, direction, exclude_annotated, task_id=None):
+        """
+        Look up the closest sample before or after `sample_index` (direction -1 or 1).
 
+        When `exclude_annotated` is set, samples that the given user already annotated (for `task_id`,
+        or any task if not specified) are skipped based on the user's annotation bitmap, see `annobitmap`.
+        """
         sample_index = int(sample_index)
-
-        sql_raw = ""
-        split_where = ""
-        if splits is not None and len(splits) > 0:
-            split_where += "\nAND dc.split_id = ANY(%(splitlist)s)"
+        owner_id = user_obj.uid if isinstance(user_obj, User) else int(user_obj)
 
         if exclude_annotated:
-            sql_raw = """
-            SELECT
-                dc.sample_index, dc.sample, COUNT(anno.owner_id) AS annocount
-            FROM
-                datasetcontent AS dc
-            LEFT JOIN annotations AS anno
-                ON anno.sample_index = dc.sample_index AND anno.dataset_id = dc.dataset_id
-            WHERE 1=1
-                AND dc.dataset_id = %(dsid)s
-                AND (anno.owner_id != %(uid)s
-                OR anno.owner_id IS NULL)
-                AND dc.sample_index > %(req_sample_idx)s
-                {split_where}
-            GROUP BY dc.sample_index, dc.sample
-            ORDER BY dc.sample_index ASC
-            LIMIT 1
-            """.format(split_where=split_where).strip()
-        else:
-            sql_raw = """
-            SELECT
-                dc.sample_index, dc.sample, COUNT(anno.owner_id) AS annocount
-            FROM
-                datasetcontent AS dc
-            LEFT JOIN annotations AS anno
-                ON anno.sample_index = dc.sample_index AND anno.dataset_id = dc.dataset_id
-            WHERE 1=1
-                AND dc.dataset_id = %(dsid)s
-                AND dc.sample_index > %(req_sample_idx)s
-                {split_where}
-            GROUP BY dc.sample_index, dc.sample
-            ORDER BY dc.sample_index ASC
-            LIMIT 1
-            """.format(split_where=split_where).strip()
+            return annobitmap.adjacent_unannotated(dbsession, self.dataset_id, owner_id, sample_index, splits,
+                                                   direction, int(task_id) if task_id is not None else None)
 
         params = {
-                "uid": user_obj.uid,
                 "dsid": self.dataset_id,
                 "req_sample_idx": sample_index
                 }
+
+        sql_where = ""
         if splits is not None and len(splits) > 0:
+            sql_where += "\nAND dc.split_id = ANY(:splitlist)"
             params["splitlist"] = list(splits)
 
-        logging.debug("DF_SQL_LOG %s\n%s\n%s", "get_next_sample(excl=%s)" % exclude_annotated, sql_raw, params)
-        df = pd.read_sql(sql_raw,
-                         dbsession.bind,
-                         params=params)
+        sql_raw = """
+        SELECT
+            dc.sample_index, dc.sample
+        FROM
+            datasetcontent AS dc
+        WHERE
+            dc.dataset_id = :dsid
+            AND dc.sample_index {comparison} :req_sample_idx
+            {sql_where}
+        ORDER BY dc.sample_index {sort_order}
+        LIMIT 1
+        """.format(comparison=">" if direction > 0 else "<",
+                   sort_order="ASC" if direction > 0 else "DESC",
+                   sql_where=sql_where)
 
-        if df.shape[0] == 0 and exclude_annotated and self.dsmetadata.get("allow_restart_annotation", False):
-            return self.get_next_sample(dbsession, sample_index, user_obj, splits, exclude_annotated=False)
+        sql_raw = prep_sql(sql_raw)
+        logging.debug("DB_SQL_LOG %s\n%s\n%s", "adjacent_sample(dir=%s)" % direction, sql_raw, params)
+        row = dbsession.execute(sql.text(sql_raw), params=params).first()
 
-        if df.shape[0] > 0:
-            first_row = df.iloc[df.index[0]]
-            return first_row["sample_index"], first_row["sample"]
-        # empty dataset
-        return None, None
+        if row is None:
+            return None, None
+        return row["sample_index"], row["sample"]
 
-    def _update_overview_statistics(self, overview, df):
-        if df is None:
-            return
+    def sample_order(self, dbsession, user_obj, splits):
+        """
+        Returns the persisted random sample order of a user, see `SampleOrder`.
+        """
+        owner_id = user_obj.uid if isinstance(user_obj, User) else int(user_obj)
+        return SampleOrder.for_user(dbsession, self, owner_id, splits)
 
-        # drop split, ID, and text columns
-        ignore_columns = []
-        if 'split' in df.columns:
-            ignore_columns.append("split")
-        if self.get_id_column() is not None and self.get_id_column() in df.columns:
-            ignore_columns.append(self.get_id_column())
-        if self.get_text_column() is not None and self.get_text_column() in df.columns:
-            ignore_columns.append(self.get_text_column())
-        df.drop(columns=ignore_columns)
-
-        cur_dtypes = dict(df.dtypes)
-        overview['columns'] = {}
-
-        for colname, coldtype in cur_dtypes.items():
-            overview['columns'][colname] = {}
-            colinfo = overview['columns'][colname]
-            colinfo['dtype'] = coldtype
-            colinfo['numeric'] = is_numeric_dtype(coldtype) and not str(coldtype) == 'bool'
-            colinfo['nunique'] = df[colname].nunique(dropna=True)
+    def target_redundancy(self):
+        """
+        Number of annotations per sample that sequential annotation aims for, 0 if samples are not leased.
+        """
+        try:
+            return max(0, int(self.dsmetadata.get("target_redundancy", 0) or 0))
+        except ValueError:
+            return 0
 
-    def get_overview_statistics(self, dbsession):
-        overview = {}
+    def uses_sample_leases(self):
+        return self.target_redundancy() > 0 and self.dsmetadata.get("annoorder", "sequential") != "random"
 
-        sql_raw = """
-        SELECT
-            dc.sample_index, dc.sample, dc.data
-        FROM
-            datasetcontent AS dc
-        WHERE 1=1
-            AND dc.dataset_id = %(dsid)s
-        ORDER BY dc.sample_index DESC
-        LIMIT %(page_size)s
-        OFFSET %(page_offset)s
-        """.format().strip()
+    def lease_sample(self, dbsession, user_obj, splits, exclude=None):
+        """
+        Leases the next sample below the target redundancy to the user, see `SampleLease.dispense`.
+        """
+        owner_id = user_obj.uid if isinstance(user_obj, User) else int(user_obj)
+        return SampleLease.dispense(dbsession, self.dataset_id, owner_id, self.target_redundancy(),
+                                    splits=splits, exclude=exclude)
 
-        params = {
-                "dsid": self.dataset_id,
-                }
+    def renew_lease(self, dbsession, user_obj, sample_index):
+        owner_id = user_obj.uid if isinstance(user_obj, User) else int(user_obj)
+        SampleLease.renew(dbsession, self.dataset_id, owner_id, sample_index)
 
-        result_count = 0
-        page_size = 10000
-        page_offset = 0
-        while result_count > 0 or page_offset == 0:
-            logging.debug("DF_SQL_LOG %s\n%s\n%s", "get_overview_statistics()", sql_raw, params)
-            params["page_size"] = page_size
-            params["page_offset"] = page_offset
+    def resume_sample(self, dbsession, user_obj, splits):
+        """
+        Returns the next unannotated sample in sequential order, continuing after the furthest sample the user
+        annotated (see `AnnotationCursor`). Samples skipped before that position are revisited once no
+        unannotated sample is left after it.
+        """
+        owner_id = user_obj.uid if isinstance(user_obj, User) else int(user_obj)
 
-            df = pd.read_sql(sql_raw,
-                             dbsession.bind,
-                             params=params)
+        cursor = AnnotationCursor.position(dbsession, self.dataset_id, owner_id)
+        if cursor is not None:
+            sample_index, sample = annobitmap.adjacent_unannotated(dbsession, self.dataset_id, owner_id, cursor,
+                                                                   splits, 1)
+            if sample_index is not None:
+                return sample_index, sample
 
-            result_count = df.shape[0] if df is not None else 0
+        return annobitmap.adjacent_unannotated(dbsession, self.dataset_id, owner_id, -1, splits, 1)
 
-            # expand JSON
-            df = pd_expand_json_column(df, df['data'])
+    def annotation_queue(self, dbsession, user_obj, splits, sample_index=None, size=5, move_cursor=True):
+        """
+        Returns the samples a user annotates next: `sample_index` (or the next unannotated sample if not given)
+        followed by up to `size` upcoming unannotated samples in the dataset's annotation order.
+        Unless `move_cursor` is set, the cursor of a random sample order is left where it is.
 
-            page_offset += page_size
+        Content, split, additional data and the user's annotations (by task id) of all samples
+        are loaded with a single query.
+        """
+        owner_id = user_obj.uid if isinstance(user_obj, User) else int(user_obj)
+        random_order = self.dsmetadata.get("annoorder", "sequential") == "random"
+        # candidates are not confirmed against the database, fetch some spare ones in case a bitmap is outdated
+        candidate_count = size * 2 + 1
+
+        if random_order:
+            sample_order = self.sample_order(dbsession, owner_id, splits)
+            position = None
+            if sample_index is None:
+                sample_index = sample_order.next_sample(dbsession, move_cursor=move_cursor)
+            else:
+                position = sample_order.position_of(sample_index)
+                if move_cursor and position is not None:
+                    sample_order.position = position
+            upcoming = sample_order.upcoming(dbsession, candidate_count,
+                                             exclude=int(sample_index) if sample_index is not None else None,
+                                             position=position)
+        else:
+            if sample_index is None:
+                sample_index, _ = self.resume_sample(dbsession, owner_id, splits)
+            candidate_chunks = annobitmap.sample_chunks(annobitmap.dataset_samples(dbsession, self.dataset_id),
+                                                        sample_index if sample_index is not None else -1, splits, 1)
+            upcoming = annobitmap.unannotated_candidates(dbsession, self.dataset_id, owner_id,
+                                                         candidate_chunks, candidate_count)
 
-            self._update_overview_statistics(overview, df)
+        if sample_index is None:
+            return []
+        sample_index = int(sample_index)
 
-            # pagination is currently disabled for improved performance
-            # until we figure out if using the first N=10000
-            # samples is good enough for most use cases or not
-            break
+        sql_raw = prep_sql("""
+        SELECT
+            dc.sample_index, dc.sample, dc.content, dc.split_id, dc.data,
+            COALESCE(json_object_agg(anno.task_id, anno.data) FILTER (WHERE anno.task_id IS NOT NULL), '{}')
+                AS annotations
+        FROM datasetcontent AS dc
+        LEFT JOIN annotations AS anno
+            ON anno.dataset_id = dc.dataset_id
+            AND anno.sample_index = dc.sample_index
+            AND anno.owner_id = :owner_id
+        WHERE dc.dataset_id = :dataset_id
+            AND dc.sample_index = ANY(:sample_indices)
+        GROUP BY dc.sample_index, dc.dataset_id, dc.sample
+        """)
+        params = {"owner_id": owner_id,
+                  "dataset_id": self.dataset_id,
+                  "sample_indices": [sample_index] + upcoming}
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+        rows = {row["sample_index"]: row for row in dbsession.execute(sql.text(sql_raw), params=params)}
 
-        overview['size'] = self.size(dbsession)
-        return overview
+        queue = []
+        for queue_index in params["sample_indices"]:
+            row = rows.get(queue_index, None)
+            if row is None:
+                continue
+            if queue_index != sample_index:
+                if len(queue) > size:
+                    break
+                if len(row["annotations"]) > 0:
+                    # annotated through another worker process
+                    annobitmap.record(self.dataset_id, owner_id, None, queue_index)
+                    continue
 
-    def get_prev_sample(self, dbsession, sample_index, user_obj, splits, exclude_annotated=True):
+            queue.append({
+                "sample_index": row["sample_index"],
+                "sample": row["sample"],
+                "content": row["content"],
+                "split_id": row["split_id"],
+                "data": row["data"] or {},
+                "annotations": {int(task_id): anno_data for task_id, anno_data in row["annotations"].items()},
+                })
+        return queue
+
+    def get_next_sample(self, dbsession, sample_index, user_obj, splits, exclude_annotated=True, task_id=None):
         if sample_index is None:
             return None, None
 
-        sample_index = int(sample_index)
+        next_idx, next_sample = self._adjacent_sample(dbsession, sample_index, user_obj, splits, 1,
+                                                      exclude_annotated, task_id)
 
-        sql_raw = ""
-        split_where = ""
-        if splits is not None and len(splits) > 0:
-            split_where += "\nAND dc.split_id = ANY(%(splitlist)s)"
-        if exclude_annotated:
-            sql_raw = """
-            SELECT
-                dc.sample_index, dc.sample, COUNT(anno.owner_id) AS annocount
-            FROM
-                datasetcontent AS dc
-            LEFT JOIN annotations AS anno
-                ON anno.sample_index = dc.sample_index AND anno.dataset_id = dc.dataset_id
-            WHERE 1=1
-                AND dc.dataset_id = %(dsid)s
-                AND (anno.owner_id != %(uid)s
-                OR anno.owner_id IS NULL)
-                AND dc.sample_index < %(req_sample_idx)s
-                {split_where}
-            GROUP BY dc.sample_index, dc.sample
-            ORDER BY dc.sample_index DESC
-            LIMIT 1
-            """.format(split_where=split_where).strip()
-        else:
-            sql_raw = """
-            SELECT
-                dc.sample_index, dc.sample, COUNT(anno.owner_id) AS annocount
-            FROM
-                datasetcontent AS dc
-            LEFT JOIN annotations AS anno
-                ON anno.sample_index = dc.sample_index AND anno.dataset_id = dc.dataset_id
-            WHERE 1=1
-                AND dc.dataset_id = %(dsid)s
-                AND dc.sample_index < %(req_sample_idx)s
-                {split_where}
-            GROUP BY dc.sample_index, dc.sample
-            ORDER BY dc.sample_index DESC
-            LIMIT 1
-            """.format(split_where=split_where).strip()
+        if next_idx is None and exclude_annotated and self.dsmetadata.get("allow_restart_annotation", False):
+            return self.get_next_sample(dbsession, sample_index, user_obj, splits, exclude_annotated=False)
 
-        params = {
-                "uid": user_obj.uid,
-                "dsid": self.dataset_id,
-                "req_sample_idx": sample_index
-                }
-        if splits is not None and len(splits) > 0:
-            params["splitlist"] = list(splits)
+        return next_idx, next_sample
 
-        logging.debug("DF_SQL_LOG %s\n%s\n%s", "get_prev_sample(excl=%s)" % exclude_annotated, sql_raw, params)
-        df = pd.read_sql(sql_raw,
-                         dbsession.bind,
-                         params=params)
+    def get_overview_statistics(self, dbsession):
+        """
+        Profiles all additional fields of the dataset in one streaming pass over its content (see `app.lib.colprofile`).
 
-        if df.shape[0] == 0 and exclude_annotated:
-            return self.get_prev_sample(dbsession, sample_index, user_obj, splits, exclude_annotated=False)
+        Returns the number of samples (`size`) and per field (`columns`) the inferred `dtype`, whether it is
+        `numeric`, the number of distinct values `nunique` (estimated unless `nunique_exact`), the number of
+        missing values `nulls`, the counts of JSON value `types` and for numeric fields the `min` and `max` value.
+        """
+        return colprofile.dataset_overview(dbsession, self.dataset_id)
+
+    def update_field_profiles(self, dbsession):
+        """
+        Profiles the additional fields of the dataset and stores the result in its metadata,
+        called whenever the dataset content changes through an import.
+        """
+        self.dsmetadata["field_profiles"] = self.get_overview_statistics(dbsession)
+        self.dsmetadata["field_profiles"]["updated"] = datetime.now().timestamp()
+        self.dirty(dbsession)
+        return self.dsmetadata["field_profiles"]
+
+    def field_profiles(self, dbsession):
+        """
+        Returns the field profiles stored with the dataset (see `get_overview_statistics`).
+
+        Profiles are stored on import and backfilled for existing datasets by a migration. A dataset without
+        stored profiles is not profiled within the request, no fields are reported for it instead.
+        """
+        stored_profiles = self.dsmetadata.get("field_profiles", None)
+        if stored_profiles is None:
+            logging.warning("no field profiles stored for %s", self)
+            return {"columns": {}, "size": self.get_size()}
+        return stored_profiles
+
+    def get_prev_sample(self, dbsession, sample_index, user_obj, splits, exclude_annotated=True, task_id=None):
+        if sample_index is None:
+            return None, None
 
-        if df.shape[0] > 0:
-            first_row = df.iloc[df.index[0]]
-            return first_row["sample_index"], first_row["sample"]
+        prev_idx, prev_sample = self._adjacent_sample(dbsession, sample_index, user_obj, splits, -1,
+                                                      exclude_annotated, task_id)
 
-        # empty dataset
-        return None, None
+        if prev_idx is None and exclude_annotated:
+            return self.get_prev_sample(dbsession, sample_index, user_obj, splits, exclude_annotated=False)
 
-    def setanno(self, dbsession, uid, sample_index, task_id, value):
-        user_obj = User.by_id(dbsession, uid) if not isinstance(uid, User) else uid
+        return prev_idx, prev_sample
 
-        if user_obj is None:
-            raise Exception("setanno() requires a user object or id")
+    def setanno(self, dbsession, uid, sample_index, task_id, value, commit=True):
+        """
+        Creates or updates the annotation of a single sample with one `INSERT ... ON CONFLICT DO UPDATE` statement.
 
+        Set `commit` to False if the surrounding session scope commits anyway and no other connection
+        needs to see the change before that.
+        """
         if isinstance(task_id, str):
             try:
                 task_id = int(task_id)
             except ValueError:
                 raise Exception("setanno() requires a task_id (int)")
 
-        if value is not None and isinstance(value, str):
-            value = value.strip()
-            if value.startswith("[") and value.endswith("]"):
-                try:
-                    value = json.loads(value)
-                except ValueError as ve:
-                    raise Exception(f"could not decode {value}: {ve}")
+        stored = self.setannos(dbsession, uid, [(sample_index, task_id, value)], commit=commit)
+        if stored[0]["status"] != "ok":
+            raise Exception("setanno() failed for sample %s in dataset %s: %s" %
+                            (sample_index, self.dataset_id, stored[0].get("message", stored[0]["status"])))
 
-        anno_data = {"updated": datetime.now().timestamp(), "value": value}
+        return stored[0]["data"]
 
-        sample_obj = self.content_query(dbsession).filter_by(
-                dataset_id=self.dataset_id,
-                sample_index=sample_index,
-                ).one()
+    def setannos(self, dbsession, uid, items, splits=None, commit=True):
+        """
+        Creates or updates annotations for a list of `(sample_index, task_id, value)` items
+        with a single multi-row upsert.
 
-        existing_anno = dbsession.query(Annotation).filter_by(
-                owner_id=user_obj.uid,
-                dataset_id=self.dataset_id,
-                sample=sample_obj.sample,
-                sample_index=sample_obj.sample_index,
-                task_id=task_id,
-                ).one_or_none()
-
-        if existing_anno is None:
-            newanno = Annotation(owner=user_obj,
-                                 dataset=self,
-                                 sample=sample_obj.sample,
-                                 sample_index=sample_obj.sample_index,
-                                 task_id=task_id,
-                                 data=anno_data)
-            dbsession.add(newanno)
-            logging.debug("created annotation %s for sample %s with value %s" % (newanno, sample_obj, value))
-        else:
-            existing_anno.data.update(anno_data)
-            flag_modified(existing_anno, "data")
+        If `splits` is given, only samples within these splits are annotated.
+        Returns one status entry per item, in the order of `items`. If an item is listed
+        more than once, the last value wins.
+        """
+        owner_id = uid.uid if isinstance(uid, User) else uid
+        if owner_id is None:
+            raise Exception("setannos() requires a user object or id")
+        owner_id = int(owner_id)
 
-            logging.debug("updated annotation %s for sample %s with value %s" % (existing_anno, sample_obj, value))
-            dbsession.merge(existing_anno)
+        results = []
+        upsert_items = {}
+        updated = datetime.now().timestamp()
 
-        # ensure this change is reflected in subsequent dataset loads
-        dbsession.flush()
-        dbsession.commit()
+        for sample_index, task_id, value in items:
+            item_result = {"sample_index": sample_index, "task_id": task_id, "status": "ok"}
+            results.append(item_result)
+
+            try:
+                item_key = (int(sample_index), int(task_id))
+            except (TypeError, ValueError):
+                item_result["status"] = "invalid"
+                item_result["message"] = "sample_index and task_id need to be integers"
+                continue
+
+            if self.task_by_id(item_key[1])[1] is None:
+                item_result["status"] = "invalid"
+                item_result["message"] = "unknown task %s" % item_key[1]
+                continue
+
+            try:
+                value = parse_anno_value(value)
+            except ValueError as ve:
+                item_result["status"] = "invalid"
+                item_result["message"] = str(ve)
+                continue
+
+            item_result["sample_index"], item_result["task_id"] = item_key
+            upsert_items[item_key] = {"updated": updated, "value": value}
+
+        stored = {}
+        if len(upsert_items) > 0:
+            params = {
+                    "owner_id": owner_id,
+                    "dataset_id": self.dataset_id,
+                    "sample_indices": [item_key[0] for item_key in upsert_items],
+                    "task_ids": [item_key[1] for item_key in upsert_items],
+                    "anno_data": [json.dumps(anno_data) for anno_data in upsert_items.values()],
+                    }
+
+            split_where = ""
+            if splits is not None:
+                split_where = "AND dc.split_id = ANY(:splitlist)"
+                params["splitlist"] = list(splits)
+
+            # annotated samples are no longer reserved for the user (see `SampleLease`), the annotation
+            # count of samples the user did not annotate before (in any task) increases and the user's
+            # resume position and revision move forward (see `AnnotationCursor`). The previous values and new
+            # annotation versions of the affected tasks are returned to update cached agreement statistics.
+            # The version is the sum of all cursor revisions of a task (see `DatasetTask.current_annotation_version`)
+            # as seen by this statement plus this statement's increment, so only the user's own cursor row is locked.
+            sql_raw = prep_sql("""
+            WITH items AS (
+                SELECT * FROM unnest(CAST(:sample_indices AS INTEGER[]),
+                                     CAST(:task_ids AS INTEGER[]),
+                                     CAST(:anno_data AS TEXT[])) AS item(sample_index, task_id, data)
+            ),
+            released AS (
+                DELETE FROM samplelease AS lease
+                WHERE lease.dataset_id = :dataset_id
+                    AND lease.owner_id = :owner_id
+                    AND lease.sample_index = ANY(CAST(:sample_indices AS INTEGER[]))
+            ),
+            counted AS (
+                UPDATE datasetcontent AS dc
+                    SET annotation_count = dc.annotation_count + 1
+                WHERE dc.dataset_id = :dataset_id
+                    AND dc.sample_index = ANY(CAST(:sample_indices AS INTEGER[]))
+                    {split_where}
+                    AND NOT EXISTS (
+                        SELECT 1 FROM annotations AS existing
+                        WHERE existing.dataset_id = dc.dataset_id
+                            AND existing.sample_index = dc.sample_index
+                            AND existing.owner_id = :owner_id
+                    )
+            ),
+            upserted AS (
+                INSERT INTO annotations AS anno (owner_id, dataset_id, sample, sample_index, task_id, data)
+                SELECT :owner_id, dc.dataset_id, dc.sample, dc.sample_index, items.task_id, CAST(items.data AS JSON)
+                FROM items
+                JOIN datasetcontent AS dc
+                    ON dc.dataset_id = :dataset_id
+                    AND dc.sample_index = items.sample_index
+                    {split_where}
+                ON CONFLICT (owner_id, dataset_id, sample, sample_index, task_id) DO UPDATE
+                    SET data = (COALESCE(anno.data::jsonb, '{{}}'::jsonb) || EXCLUDED.data::jsonb)::json
+                RETURNING anno.sample, anno.sample_index, anno.task_id, anno.data
+            ),
+            previous AS (
+                SELECT existing.sample_index, existing.task_id, existing.data->'value' AS previous_value
+                FROM annotations AS existing
+                JOIN items
+                    ON existing.sample_index = items.sample_index
+                    AND existing.task_id = items.task_id
+                WHERE existing.dataset_id = :dataset_id
+                    AND existing.owner_id = :owner_id
+            ),
+            versioned AS (
+                SELECT tasks.task_id,
+                    tasks.annotation_version + COALESCE(SUM(revisions.revision), 0) + 1 AS annotation_version
+                FROM tasks
+                LEFT JOIN annotationcursor AS revisions
+                    ON revisions.task_id = tasks.task_id
+                WHERE tasks.task_id = ANY(CAST(:task_ids AS INTEGER[]))
+                GROUP BY tasks.task_id, tasks.annotation_version
+            ),
+            cursor_update AS (
+                INSERT INTO annotationcursor AS resume (owner_id, dataset_id, task_id, sample_index, revision)
+                SELECT :owner_id, :dataset_id, upserted.task_id, MAX(upserted.sample_index), 1
+                FROM upserted
+                GROUP BY upserted.task_id
+                ON CONFLICT (owner_id, dataset_id, task_id) DO UPDATE
+                    SET sample_index = GREATEST(resume.sample_index, EXCLUDED.sample_index),
+                        revision = resume.revision + 1
+            )
+            SELECT upserted.sample, upserted.sample_index, upserted.task_id, upserted.data,
+                previous.sample_index IS NOT NULL AS existed, previous.previous_value, versioned.annotation_version
+            FROM upserted
+            LEFT JOIN previous
+                ON previous.sample_index = upserted.sample_index
+                AND previous.task_id = upserted.task_id
+            LEFT JOIN versioned
+                ON versioned.task_id = upserted.task_id
+            """.format(split_where=split_where))
+
+            logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+            task_changes = {}
+            annotated_items = []
+            for upserted in dbsession.execute(sql.text(sql_raw), params=params):
+                stored[(upserted["sample_index"], upserted["task_id"])] = upserted
+                task_version, changes = task_changes.setdefault(upserted["task_id"],
+                                                                (upserted["annotation_version"], []))
+                changes.append((upserted["sample_index"], upserted["existed"], upserted["previous_value"],
+                                (upserted["data"] or {}).get("value", None)))
+                annotated_items.append((upserted["task_id"], upserted["sample_index"]))
+
+                # the statement bypasses the ORM, make sure a previously loaded instance is refreshed on its next access
+                cached_anno = dbsession.identity_map.get(identity_key(Annotation, (owner_id,
+                                                                                   self.dataset_id,
+                                                                                   upserted["sample"],
+                                                                                   upserted["sample_index"],
+                                                                                   upserted["task_id"])))
+                if cached_anno is not None:
+                    dbsession.expire(cached_anno)
+
+            annobitmap.record_on_commit(dbsession, self.dataset_id, owner_id, annotated_items)
+            for task_id, (task_version, changes) in task_changes.items():
+                DatasetTask.apply_annotation_changes_on_commit(dbsession, task_id, task_version, changes)
+
+            logging.debug("stored %s of %s annotations for owner %s", len(stored), len(items), owner_id)
+
+        for item_result in results:
+            if item_result["status"] != "ok":
+                continue
+            upserted = stored.get((item_result["sample_index"], item_result["task_id"]), None)
+            if upserted is None:
+                item_result["status"] = "not_found"
+                item_result["message"] = "sample not found or not accessible"
+                continue
+            item_result["data"] = upserted["data"]
+
+        if commit:
+            dbsession.commit()
+
+        return results
 
     def annocount_today(self, dbsession, uid, splits=None):
         # TODO return counts by task ID or distinct
@@ -1363,27 +1734,34 @@ class Dataset(Base):
         return count_today
 
     def annocount(self, dbsession, uid, splits=None):
+        """
+        Number of distinct samples annotated by the user (in any task), optionally within the given splits.
+        Progress and task completion are based on this count, so it is always counted in the database
+        instead of on the per-process annotation bitmaps.
+        """
         if isinstance(uid, User):
             uid = uid.uid
-        query = dbsession.query(Annotation).filter_by(
-                dataset_id=self.dataset_id,
-                owner_id=uid)
+        params = {"dataset_id": self.dataset_id, "owner_id": uid}
 
+        split_join = ""
         if splits is not None:
-            if not isinstance(splits, list):
-                splits = list(splits)
-            query = query.join(DatasetContent, and_(DatasetContent.dataset_id == Annotation.dataset_id,
-                                                    DatasetContent.sample_index == Annotation.sample_index))
-            query = query.filter(DatasetContent.split_id.in_(splits))
+            split_join = """
+            JOIN datasetcontent AS dc
+                ON dc.dataset_id = anno.dataset_id
+                AND dc.sample_index = anno.sample_index
+                AND dc.split_id = ANY(:splitlist)
+            """
+            params["splitlist"] = list(splits)
 
-        idxset = set()
-        count = 0
-        for anno in query.all():
-            if anno.sample_index in idxset:
-                continue
-            idxset.add(anno.sample_index)
-            count += 1
-        return count
+        sql_raw = """
+        SELECT COUNT(DISTINCT anno.sample_index) FROM annotations AS anno
+        {split_join}
+        WHERE anno.dataset_id = :dataset_id
+            AND anno.owner_id = :owner_id
+        """.format(split_join=split_join)
+        sql_raw = prep_sql(sql_raw)
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+        return dbsession.execute(sql.text(sql_raw), params=params).scalar()
 
     def set_role(self, dbsession, uid, role, remove=False):
         if not User.is_valid_role(role):
@@ -1554,6 +1932,10 @@ class Dataset(Base):
                     dbsession.flush()
                     logging.debug("[import] %s, sample count after: %s", self, len(self.dscontent))
 
+                    if import_count > 0 or merge_count > 0:
+                        self.update_field_profiles(dbsession)
+                        self.refresh_split_sizes(dbsession)
+
                 else:
                     success = True
                     if len(errors) == 0:
@@ -1601,42 +1983,31 @@ class Dataset(Base):
         id_column = self.get_id_column()
         text_column = self.get_text_column()
         frame_data = {
-                "index": []
+                "index": [],
+                id_column: [],
+                text_column: [],
                 }
-        frame_data[id_column] = []
-        frame_data[text_column] = []
+        sample_data = []
 
-        sample_count = 0
         for sample in samples.all():
-            sample_count += 1
-
             frame_data["index"].append(sample.sample_index)
             frame_data[id_column].append(sample.sample)
             frame_data[text_column].append(sample.content)
-
-            if not extended:
-                continue
-
-            if sample.data is None:
-                for key in frame_data:
-                    if key in ["index", id_column, text_column]:
-                        continue
-                    frame_data[key].append(None)
-            else:
-                for key, value in sample.data.items():
-                    if key not in frame_data:
-                        frame_data[key] = []
-                        if len(frame_data["index"]) > 0:
-                            frame_data[key] = [None] * (len(frame_data["index"]) - 1)
-                    frame_data[key].append(value)
+            sample_data.append(sample.data)
 
         df = pd.DataFrame.from_dict(frame_data)
+        if extended:
+            df = pd.concat([df, expand_json_records(sample_data, exclude_columns=list(frame_data.keys()))], axis=1)
         df.set_index("index")
         return df
 
     def invalidate(self):
         self._cached_df = None
         DATASET_CONTENT_CACHE[self.dataset_id] = None
+        annobitmap.invalidate(self.dataset_id, samples=True)
+        # split membership may have changed, which is not reflected in the annotation version
+        analyticscache.invalidate(self.dataset_id)
+        DatasetTask.invalidate_agreement_intervals(self.dataset_id)
 
     def update_size(self):
         self.invalidate()
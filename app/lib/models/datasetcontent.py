@@ -2,7 +2,7 @@
 DatasetContent entity that holds information on imported samples.
 """
 
-from sqlalchemy import Column, Integer, String, JSON, ForeignKey
+from sqlalchemy import Column, Integer, String, JSON, ForeignKey, Index
 from sqlalchemy.orm import relationship
 
 from app.lib.database_internals import Base
@@ -24,8 +24,26 @@ class DatasetContent(Base):
 
     data = Column(JSON)
 
+    # number of distinct users that annotated this sample, maintained by `Dataset.setannos`
+    annotation_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    __table_args__ = (
+        # supports sample navigation within (optional) splits in sample_index order
+        Index("ix_datasetcontent_dataset_split_sample", dataset_id, split_id, sample_index),
+        # serves samples with the fewest annotations first, see `SampleLease.dispense`
+        Index("ix_datasetcontent_dataset_annocount_sample", dataset_id, annotation_count, sample_index),
+        {},
+    )
+
     def __repr__(self):
         return "<DatasetContent %s/%s (%s)>" % (self.dataset.get_name(), self.sample_index, self.sample)
 
+    @staticmethod
+    def activity_prefix():
+        return "SAMPLE:"
+
     def activity_target(self):
         return "SAMPLE:%s" % self.sample_index
+
+    def get_name(self):
+        return "%s/%s" % (self.dataset.get_name(), self.sample)
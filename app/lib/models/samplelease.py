@@ -0,0 +1,169 @@
+"""
+Sample lease entity.
+
+A lease reserves a sample for one annotator for a short time, so that annotators working on the same
+work package in sequential order are served different samples instead of all receiving the lowest
+unannotated one until somebody stores an annotation.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index, sql
+
+import app.lib.config as config
+from app.lib.database_internals import Base
+
+
+class SampleLease(Base):
+    __tablename__ = "samplelease"
+
+    dataset_id = Column(Integer, ForeignKey("datasets.dataset_id"), primary_key=True)
+    sample_index = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.uid"), primary_key=True)
+
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_samplelease_dataset_expires", dataset_id, expires_at),
+        {},
+    )
+
+    def __repr__(self):
+        return "<SampleLease (dataset: %s, sample_index: %s, owner: %s, expires: %s)>" % (
+            self.dataset_id,
+            self.sample_index,
+            self.owner_id,
+            self.expires_at,
+        )
+
+    @staticmethod
+    def lease_duration():
+        return timedelta(seconds=config.get_int("annotation_lease_seconds", 300))
+
+    @staticmethod
+    def renew(dbsession, dataset_id, owner_id, sample_index):
+        """
+        Creates or extends the lease of a user on a sample.
+        """
+        sql_raw = """
+        INSERT INTO samplelease (dataset_id, sample_index, owner_id, expires_at)
+        VALUES (:dataset_id, :sample_index, :owner_id, :expires_at)
+        ON CONFLICT (dataset_id, sample_index, owner_id) DO UPDATE
+            SET expires_at = EXCLUDED.expires_at
+        """
+        params = {"dataset_id": dataset_id,
+                  "sample_index": int(sample_index),
+                  "owner_id": owner_id,
+                  "expires_at": datetime.now() + SampleLease.lease_duration()}
+        dbsession.execute(sql.text(sql_raw), params=params)
+
+    @staticmethod
+    def active_lease(dbsession, dataset_id, owner_id, splits=None, exclude=None):
+        """
+        Returns the first sample the user holds an active lease on and has not annotated yet.
+        """
+        params = {"dataset_id": dataset_id,
+                  "owner_id": owner_id,
+                  "now": datetime.now(),
+                  "exclude": int(exclude) if exclude is not None else -1}
+
+        split_where = ""
+        if splits is not None and len(splits) > 0:
+            split_where = "AND dc.split_id = ANY(:splitlist)"
+            params["splitlist"] = list(splits)
+
+        sql_raw = """
+        SELECT dc.sample_index, dc.sample FROM samplelease AS lease
+        JOIN datasetcontent AS dc
+            ON dc.dataset_id = lease.dataset_id
+            AND dc.sample_index = lease.sample_index
+        WHERE lease.dataset_id = :dataset_id
+            AND lease.owner_id = :owner_id
+            AND lease.expires_at > :now
+            AND lease.sample_index != :exclude
+            {split_where}
+            AND NOT EXISTS (
+                SELECT 1 FROM annotations AS anno
+                WHERE anno.dataset_id = lease.dataset_id
+                    AND anno.sample_index = lease.sample_index
+                    AND anno.owner_id = lease.owner_id
+            )
+        ORDER BY dc.sample_index ASC
+        LIMIT 1
+        """.format(split_where=split_where)
+        row = dbsession.execute(sql.text(sql_raw), params=params).first()
+        if row is None:
+            return None, None
+        return row["sample_index"], row["sample"]
+
+    @staticmethod
+    def dispense(dbsession, dataset_id, owner_id, redundancy, splits=None, exclude=None):
+        """
+        Leases a sample that the user has not annotated and that has fewer than `redundancy` annotations
+        plus active leases of other users. Samples with the fewest annotations are served first (by `sample_index`
+        among equal counts), so annotation effort goes where it increases coverage.
+
+        Candidate rows are locked with `FOR UPDATE SKIP LOCKED`, concurrent requests therefore skip samples
+        that are being leased at the same time. A sample the user holds an active lease on is served again first.
+        Returns a tuple of sample index and sample id, or `(None, None)` if no sample is available.
+        """
+        leased_index, leased_sample = SampleLease.active_lease(dbsession, dataset_id, owner_id, splits, exclude)
+        if leased_index is not None:
+            SampleLease.renew(dbsession, dataset_id, owner_id, leased_index)
+            return leased_index, leased_sample
+
+        params = {"dataset_id": dataset_id,
+                  "owner_id": owner_id,
+                  "redundancy": int(redundancy),
+                  "now": datetime.now(),
+                  "expires_at": datetime.now() + SampleLease.lease_duration(),
+                  "exclude": int(exclude) if exclude is not None else -1}
+
+        split_where = ""
+        if splits is not None and len(splits) > 0:
+            split_where = "AND dc.split_id = ANY(:splitlist)"
+            params["splitlist"] = list(splits)
+
+        sql_raw = """
+        WITH expired AS (
+            DELETE FROM samplelease AS expired_lease
+            WHERE expired_lease.dataset_id = :dataset_id AND expired_lease.expires_at <= :now
+        ),
+        candidate AS (
+            SELECT dc.sample_index, dc.sample FROM datasetcontent AS dc
+            WHERE dc.dataset_id = :dataset_id
+                AND dc.sample_index != :exclude
+                {split_where}
+                AND NOT EXISTS (
+                    SELECT 1 FROM annotations AS anno
+                    WHERE anno.dataset_id = dc.dataset_id
+                        AND anno.sample_index = dc.sample_index
+                        AND anno.owner_id = :owner_id
+                )
+                AND dc.annotation_count + (
+                    SELECT COUNT(*) FROM samplelease AS lease
+                    WHERE lease.dataset_id = dc.dataset_id
+                        AND lease.sample_index = dc.sample_index
+                        AND lease.owner_id != :owner_id
+                        AND lease.expires_at > :now
+                ) < :redundancy
+            ORDER BY dc.annotation_count ASC, dc.sample_index ASC
+            LIMIT 1
+            FOR UPDATE OF dc SKIP LOCKED
+        ),
+        leased AS (
+            INSERT INTO samplelease (dataset_id, sample_index, owner_id, expires_at)
+            SELECT :dataset_id, candidate.sample_index, :owner_id, :expires_at FROM candidate
+            ON CONFLICT (dataset_id, sample_index, owner_id) DO UPDATE
+                SET expires_at = EXCLUDED.expires_at
+            RETURNING samplelease.sample_index
+        )
+        SELECT candidate.sample_index, candidate.sample FROM candidate
+        JOIN leased ON leased.sample_index = candidate.sample_index
+        """.format(split_where=split_where)
+
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+        row = dbsession.execute(sql.text(sql_raw), params=params).first()
+        if row is None:
+            return None, None
+        return row["sample_index"], row["sample"]
@@ -0,0 +1,186 @@
+"""
+Per-user sample order entity.
+
+Stores a seeded permutation of the sample indices of a dataset (restricted to the work packages a user
+can annotate) along with a cursor, so that samples can be served in a random but reproducible and
+resumable order without sorting the dataset on every request.
+"""
+import json
+import logging
+import random
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import Column, Integer, BigInteger, String, LargeBinary, ForeignKey, sql
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.orm.attributes import flag_modified
+
+import app.lib.annobitmap as annobitmap
+from app.lib.database_internals import Base
+
+# number of permutation entries checked against the annotation bitmap at once
+CANDIDATE_CHUNK_SIZE = 1024
+# number of decoded permutations kept in memory
+PERMUTATION_CACHE_SIZE = 32
+# how far ahead of the cursor a requested sample is looked up when advancing the cursor
+ADVANCE_WINDOW = 256
+
+_PERMUTATION_CACHE = OrderedDict()
+
+
+class SampleOrder(Base):
+    __tablename__ = "sampleorder"
+
+    owner_id = Column(Integer, ForeignKey("users.uid"), primary_key=True)
+    dataset_id = Column(Integer, ForeignKey("datasets.dataset_id"), primary_key=True)
+    dataset = relationship("Dataset", back_populates="dssampleorders")
+
+    seed = Column(BigInteger, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    # describes the set of samples the permutation was generated for, see `sample_signature`
+    signature = Column(String, nullable=False)
+    # little-endian int32 sample indices
+    permutation = deferred(Column(LargeBinary, nullable=False))
+
+    def __repr__(self):
+        return "<SampleOrder (dataset: %s, owner: %s, seed: %s, position: %s)>" % (
+            self.dataset_id,
+            self.owner_id,
+            self.seed,
+            self.position,
+        )
+
+    @staticmethod
+    def sample_signature(dbsession, dataset, splits):
+        """
+        Describes the samples an order is generated for, which changes whenever samples are added or removed
+        (size) or split membership changes (split version).
+        """
+        return json.dumps([dataset.dsmetadata.get("size", None),
+                           sorted(splits) if splits is not None else None,
+                           dataset.split_version(dbsession)])
+
+    @staticmethod
+    def for_user(dbsession, dataset, owner_id, splits=None):
+        """
+        Loads the sample order of a user, creating or regenerating it if the underlying samples changed.
+        The seed of an existing order is kept, so the order is stable as long as the samples are.
+        """
+        signature = SampleOrder.sample_signature(dbsession, dataset, splits)
+
+        sample_order = dbsession.query(SampleOrder).filter_by(owner_id=owner_id,
+                                                              dataset_id=dataset.dataset_id).one_or_none()
+        if sample_order is None:
+            sample_order = SampleOrder(owner_id=owner_id,
+                                       dataset_id=dataset.dataset_id,
+                                       seed=random.getrandbits(32))
+            dbsession.add(sample_order)
+        elif sample_order.signature == signature:
+            return sample_order
+
+        sample_order.signature = signature
+        sample_order.generate(dbsession, splits)
+        dbsession.flush()
+        return sample_order
+
+    def generate(self, dbsession, splits):
+        split_where = ""
+        params = {"dataset_id": self.dataset_id}
+        if splits is not None and len(splits) > 0:
+            split_where = "AND dc.split_id = ANY(:splitlist)"
+            params["splitlist"] = list(splits)
+
+        sql_raw = """
+        SELECT dc.sample_index FROM datasetcontent AS dc
+        WHERE dc.dataset_id = :dataset_id {split_where}
+        ORDER BY dc.sample_index
+        """.format(split_where=split_where)
+
+        sample_indices = np.fromiter((row[0] for row in dbsession.execute(sql.text(sql_raw), params=params)),
+                                     dtype=np.int32)
+        permutation = np.random.default_rng(self.seed).permutation(sample_indices)
+
+        logging.debug("generated sample order for dataset %s, owner %s (%s samples)",
+                      self.dataset_id, self.owner_id, permutation.shape[0])
+
+        self.permutation = permutation.astype("<i4").tobytes()
+        self.position = 0
+        flag_modified(self, "permutation")
+
+    def sample_indices(self):
+        cache_key = (self.owner_id, self.dataset_id, self.seed, self.signature)
+        if cache_key in _PERMUTATION_CACHE:
+            _PERMUTATION_CACHE.move_to_end(cache_key)
+            return _PERMUTATION_CACHE[cache_key]
+
+        sample_indices = np.frombuffer(self.permutation, dtype="<i4")
+        _PERMUTATION_CACHE[cache_key] = sample_indices
+        while len(_PERMUTATION_CACHE) > PERMUTATION_CACHE_SIZE:
+            _PERMUTATION_CACHE.popitem(last=False)
+        return sample_indices
+
+    def _find_unannotated(self, dbsession, start, end, exclude=None):
+        sample_indices = self.sample_indices()
+        candidate_chunks = (sample_indices[chunk_start:min(chunk_start + CANDIDATE_CHUNK_SIZE, end)]
+                            for chunk_start in range(start, end, CANDIDATE_CHUNK_SIZE))
+        position, sample_index, _ = annobitmap.first_unannotated(dbsession, self.dataset_id, self.owner_id,
+                                                                 candidate_chunks, exclude=exclude)
+        if position is None:
+            return None, None
+        return start + position, sample_index
+
+    def next_sample(self, dbsession, exclude=None, move_cursor=True):
+        """
+        Returns the next sample in this order that the user has not annotated yet, starting at the cursor.
+        Samples that were skipped before the cursor are revisited once the end of the order is reached.
+        """
+        size = self.sample_indices().shape[0]
+        position, sample_index = self._find_unannotated(dbsession, self.position, size, exclude)
+        if position is None:
+            position, sample_index = self._find_unannotated(dbsession, 0, min(self.position, size), exclude)
+
+        if position is not None and move_cursor:
+            self.position = position
+        return sample_index
+
+    def upcoming(self, dbsession, limit, exclude=None, position=None):
+        """
+        Returns up to `limit` upcoming samples in this order that are unannotated according to the
+        user's annotation bitmap, without moving the cursor. Starts at `position` if given, at the cursor otherwise.
+        """
+        sample_indices = self.sample_indices()
+        size = sample_indices.shape[0]
+        if position is None:
+            position = self.position
+        candidate_chunks = (sample_indices[chunk_start:min(chunk_start + CANDIDATE_CHUNK_SIZE, end)]
+                            for start, end in [(position, size), (0, min(position, size))]
+                            for chunk_start in range(start, end, CANDIDATE_CHUNK_SIZE))
+        return annobitmap.unannotated_candidates(dbsession, self.dataset_id, self.owner_id,
+                                                 candidate_chunks, limit, exclude=exclude)
+
+    def prev_sample(self):
+        sample_indices = self.sample_indices()
+        if self.position <= 0 or self.position > sample_indices.shape[0]:
+            return None
+        return int(sample_indices[self.position - 1])
+
+    def position_of(self, sample_index):
+        """
+        Position of `sample_index` in this order if it is the current or one of the upcoming samples, None otherwise.
+        """
+        sample_indices = self.sample_indices()
+        window = sample_indices[self.position:self.position + ADVANCE_WINDOW]
+        matches = np.flatnonzero(window == int(sample_index))
+        if matches.shape[0] == 0:
+            return None
+        return self.position + int(matches[0])
+
+    def advance_to(self, sample_index):
+        """
+        Moves the cursor to `sample_index` if it is the current or one of the upcoming samples in this order.
+        """
+        position = self.position_of(sample_index)
+        if position is None:
+            return False
+        self.position = position
+        return True
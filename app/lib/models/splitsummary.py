@@ -0,0 +1,117 @@
+"""
+Split summary entity.
+
+Keeps the number of samples per split of a dataset as a ledger of size changes: statements that move samples
+between splits record the moved counts (negative for the split a sample left) along with the move itself,
+see `SplitSummary.tracked_update`. The size of a split is the sum of its entries. Changes are serialized per
+dataset, so the newest entry of a dataset identifies the current split membership (see `SplitSummary.version`).
+Unlike sizes stored in the dataset metadata, entries are never overwritten by saving an outdated dataset object.
+"""
+import logging
+
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, sql
+
+from app.lib.database_internals import Base
+
+
+class SplitSummary(Base):
+    __tablename__ = "splitsummary"
+
+    summary_id = Column(Integer, primary_key=True, autoincrement=True)
+    dataset_id = Column(Integer, ForeignKey("datasets.dataset_id"), nullable=False)
+    split_id = Column(String, nullable=True)
+    # change of the number of samples in the split
+    size = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_splitsummary_dataset_summary", dataset_id, summary_id),
+        {},
+    )
+
+    def __repr__(self):
+        return "<SplitSummary (dataset: %s, split: %s, size: %s)>" % (
+            self.dataset_id,
+            self.split_id,
+            self.size,
+        )
+
+    @staticmethod
+    def sizes(dbsession, dataset_id):
+        """
+        Returns the number of samples per split as a list of `[split_id, size]` pairs (split ids can be NULL).
+        """
+        sql_raw = """
+        SELECT summary.split_id, SUM(summary.size) AS size
+        FROM splitsummary AS summary
+        WHERE summary.dataset_id = :dataset_id
+        GROUP BY summary.split_id
+        HAVING SUM(summary.size) > 0
+        """
+        return [[row["split_id"], int(row["size"])]
+                for row in dbsession.execute(sql.text(sql_raw), params={"dataset_id": dataset_id})]
+
+    @staticmethod
+    def version(dbsession, dataset_id):
+        """
+        Id of the newest entry of a dataset, which changes whenever samples are added to, moved between
+        or removed from its splits. None if the dataset has no samples.
+        """
+        sql_raw = "SELECT MAX(summary.summary_id) FROM splitsummary AS summary WHERE summary.dataset_id = :dataset_id"
+        return dbsession.execute(sql.text(sql_raw), params={"dataset_id": dataset_id}).scalar()
+
+    @staticmethod
+    def _lock(dbsession, dataset_id):
+        # serializes split changes of a dataset, so that entry ids increase in commit order and
+        # concurrent refreshes do not both insert a full count
+        lock_raw = "SELECT ds.dataset_id FROM datasets AS ds WHERE ds.dataset_id = :dataset_id FOR UPDATE"
+        dbsession.execute(sql.text(lock_raw), params={"dataset_id": dataset_id})
+
+    @staticmethod
+    def refresh(dbsession, dataset_id):
+        """
+        Replaces the entries of a dataset with the counted number of samples per split,
+        e.g. after samples were imported.
+        """
+        SplitSummary._lock(dbsession, dataset_id)
+        sql_raw = """
+        WITH replaced AS (
+            DELETE FROM splitsummary AS summary WHERE summary.dataset_id = :dataset_id
+        )
+        INSERT INTO splitsummary (dataset_id, split_id, size)
+        SELECT dc.dataset_id, dc.split_id, COUNT(*)
+        FROM datasetcontent AS dc
+        WHERE dc.dataset_id = :dataset_id
+        GROUP BY dc.dataset_id, dc.split_id
+        """
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, {"dataset_id": dataset_id})
+        dbsession.execute(sql.text(sql_raw), params={"dataset_id": dataset_id})
+
+    @staticmethod
+    def tracked_update(dbsession, dataset_id, update_raw, params):
+        """
+        Runs `update_raw`, an `UPDATE datasetcontent` statement that returns the new (`split_id`) and previous
+        (`previous_split_id`) split of each updated sample, and records the moved samples in the same statement.
+        Returns the number of updated samples.
+        """
+        sql_raw = """
+        WITH moved AS (
+            {update_raw}
+        ),
+        recorded AS (
+            INSERT INTO splitsummary (dataset_id, split_id, size)
+            SELECT :summary_dataset_id, moved.previous_split_id, -COUNT(*)
+            FROM moved
+            WHERE moved.previous_split_id IS DISTINCT FROM moved.split_id
+            GROUP BY moved.previous_split_id
+            UNION ALL
+            SELECT :summary_dataset_id, moved.split_id, COUNT(*)
+            FROM moved
+            WHERE moved.previous_split_id IS DISTINCT FROM moved.split_id
+            GROUP BY moved.split_id
+        )
+        SELECT COUNT(*) FROM moved
+        """.format(update_raw=update_raw)
+        SplitSummary._lock(dbsession, dataset_id)
+        params = dict(params, summary_dataset_id=dataset_id)
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+        return dbsession.execute(sql.text(sql_raw), params=params).scalar()
@@ -8,6 +8,7 @@ import random
 import os
 import os.path
 import re
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import List
 
@@ -20,11 +21,31 @@ import pandas as pd
 from pandas.api.types import is_numeric_dtype
 import numpy as np
 
-from app.lib.database_internals import Base
-from app.lib.npencoder import NpEncoder
+import app.lib.config as config
+import app.lib.analyticscache as analyticscache
+from app.lib.database_internals import Base, after_commit
 
 import app.lib.iaa as iaa
 
+# incrementally maintained Fleiss' kappa aggregates by task id, as (annotation_version, FleissAggregate).
+# Entries that missed annotations stored through other worker processes are dropped and rebuilt on next use.
+_FLEISS_AGGREGATES = {}
+# number of bootstrap confidence intervals kept per process
+AGREEMENT_INTERVALS_MAX_ENTRIES = 64
+# bootstrap confidence intervals by (dataset id, task id, split), least recently used first,
+# as ((annotation_version, split_version), result, running computation or None)
+_AGREEMENT_INTERVALS = OrderedDict()
+
+
+def anno_category(anno_value):
+    """
+    Category of an annotation value for agreement calculations, lists (multiselect) are compared by their JSON text.
+    """
+    if anno_value is None or isinstance(anno_value, str):
+        return anno_value
+    return json.dumps(anno_value)
+
+
 class DatasetTask(Base):
     __tablename__ = 'tasks'
 
@@ -35,13 +56,22 @@ class DatasetTask(Base):
 
     taskorder = Column(Integer, nullable=False, default=0)
     taskconfig = Column(JSON, nullable=False)
+    # incremented whenever annotations of this task are stored, see `Dataset.setannos`
+    annotation_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     def __repr__(self):
         return "<DatasetTask %s (%s)>" % (self.taskconfig.get("title", str(self.task_id)), self.taskorder)
 
+    @staticmethod
+    def activity_prefix():
+        return "TASK:"
+
     def activity_target(self):
         return "TASK:%s" % self.task_id
 
+    def get_name(self):
+        return "%s (%s)" % (self.name, self.dataset.get_name())
+
     @property
     def name(self):
         return self.taskconfig.get("title", f"Task #{self.task_id}")
@@ -124,14 +154,32 @@ class DatasetTask(Base):
         dbsession.add(self)
         return True
 
-    def annotation_counts(self, dbsession):
+    def annotation_counts(self, dbsession, split=None):
         """
-        TODO does not respect task yet
+        Number of annotations of this task per user and tag, and per tag over all users.
+        Results are cached until the annotation version of the task, its tags or the dataset's splits change.
         """
+        key = analyticscache.cache_key(self.dataset_id, self.task_id, split,
+                                       self.current_annotation_version(dbsession),
+                                       self.dataset.split_version(dbsession),
+                                       ("annotation_counts", tuple(self.get_taglist())))
+        return analyticscache.get(key, lambda: self._annotation_counts(dbsession, split))
+
+    def _annotation_counts(self, dbsession, split=None):
         params = {
                 "dataset_id": self.dataset_id,
-                "taskid": str(self.task_id)
+                "task_id": self.task_id
                 }
+        split_join = ""
+        if split is not None:
+            split_join = """
+            JOIN datasetcontent AS dc
+                ON dc.dataset_id = anno.dataset_id
+                AND dc.sample_index = anno.sample_index
+                AND dc.split_id = :split_id
+            """
+            params["split_id"] = split
+
         sql_raw = """
         SELECT users.uid,
             (CASE WHEN
@@ -139,29 +187,22 @@ class DatasetTask(Base):
                 THEN users.email
                 ELSE users.displayname
                 END) AS username,
-            anno.data->'value' #>> '{}' AS anno_tag,
+            anno.data->'value' #>> '{{}}' AS anno_tag,
             COUNT(anno.sample_index) AS cnt
         FROM annotations as anno
         LEFT JOIN users
             ON users.uid = anno.owner_id
+        {split_join}
         WHERE
-            anno.dataset_id = %(dataset_id)s
-            AND anno.task_id == %(taskid)s
+            anno.dataset_id = :dataset_id
+            AND anno.task_id = :task_id
         GROUP BY
-            users.uid, anno.task_id, anno.data->'value' #>> '{}'
-        """
+            users.uid, anno.task_id, anno.data->'value' #>> '{{}}'
+        """.format(split_join=split_join)
 
         sql_raw = prep_sql(sql_raw)
         logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
 
-        df = pd.read_sql(sql_raw,
-                         dbsession.bind,
-                         params=params)
-
-        result_data = df.replace(np.nan, "", regex=True).to_dict()
-        result_data = json.dumps(result_data, cls=NpEncoder)
-        result_data = json.loads(result_data)
-
         annotations_by_user = {}
         all_annotations = {}
         tags = self.get_taglist()
@@ -169,89 +210,470 @@ class DatasetTask(Base):
         for tag in tags:
             all_annotations[tag] = 0
 
-        if 'uid' in result_data:
-            for rowidx, uid in result_data['uid'].items():
-                row_username = result_data['username'].get(rowidx, str(uid))
-                row_tag = result_data['anno_tag'].get(rowidx, None)
+        for row in dbsession.execute(sql.text(sql_raw), params=params):
+            if row["anno_tag"] not in tags:
+                continue
 
-                if row_tag not in tags:
-                    continue
+            row_username = row["username"] if row["username"] is not None else ""
+            if row_username not in annotations_by_user:
+                annotations_by_user[row_username] = {}
+            annotations_by_user[row_username][row["anno_tag"]] = int(row["cnt"])
+            all_annotations[row["anno_tag"]] += int(row["cnt"])
 
-                row_cnt = result_data['cnt'].get(rowidx, 0)
+        return annotations_by_user, all_annotations
 
-                if row_username not in annotations_by_user:
-                    annotations_by_user[row_username] = {}
-                annotations_by_user[row_username][row_tag] = row_cnt
-                all_annotations[row_tag] += row_cnt
+    def current_annotation_version(self, dbsession):
+        """
+        The annotation version increases with every committed change to the annotations of this task.
+        It is the sum of the task's bulk change counter (see `bump_annotation_version`) and the revisions of
+        all annotation cursors of the task, which `Dataset.setannos` increments on the annotating user's own
+        cursor. Concurrent annotators therefore never wait for each other to update the version.
+        """
+        sql_raw = """
+        SELECT tasks.annotation_version + COALESCE((
+            SELECT SUM(revisions.revision) FROM annotationcursor AS revisions
+            WHERE revisions.task_id = tasks.task_id
+        ), 0)
+        FROM tasks WHERE tasks.task_id = :task_id
+        """
+        return dbsession.execute(sql.text(sql_raw), params={"task_id": self.task_id}).scalar()
 
-        return annotations_by_user, all_annotations
+    def bump_annotation_version(self, dbsession):
+        """
+        Increases the annotation version after bulk changes (e.g. annotations migrated between users).
+        """
+        sql_raw = "UPDATE tasks SET annotation_version = tasks.annotation_version + 1 WHERE tasks.task_id = :task_id"
+        dbsession.execute(sql.text(sql_raw), params={"task_id": self.task_id})
+        _FLEISS_AGGREGATES.pop(self.task_id, None)
 
+    def fleiss_aggregate(self, dbsession):
+        """
+        Returns the Fleiss' kappa aggregate of this task's annotations, built from the database on first use and
+        kept current by `apply_annotation_changes`.
 
-    def annotation_agreement(self, dbsession, exclude_insufficient=False, by_tag=False):
+        If annotations were stored through another worker process since, the aggregate is rebuilt from the
+        database at the current annotation version.
         """
-        calculates Fleiss' Kappa statistic on the annotations
-        for this dataset
+        annotation_version = self.current_annotation_version(dbsession)
+        cached = _FLEISS_AGGREGATES.get(self.task_id, None)
+        if cached is not None:
+            if cached[0] == annotation_version:
+                return cached[1]
+            logging.debug("task %s annotated through another process, rebuilding its aggregate", self.task_id)
+            _FLEISS_AGGREGATES.pop(self.task_id, None)
 
-        if exclude_insufficient is set, rows with annotations by only one user are excluded.
+        params = {
+                "dataset_id": self.dataset_id,
+                "task_id": self.task_id
+                }
+        sql_raw = """
+        SELECT anno.sample_index, anno.data->'value' AS anno_value
+        FROM annotations AS anno
+        WHERE anno.dataset_id = :dataset_id
+            AND anno.task_id = :task_id
         """
+        sql_raw = prep_sql(sql_raw)
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+
+        aggregate = iaa.FleissAggregate()
+        for row in dbsession.execute(sql.text(sql_raw), params=params):
+            aggregate.add_counts(row["sample_index"], anno_category(row["anno_value"]), 1)
+
+        _FLEISS_AGGREGATES[self.task_id] = (annotation_version, aggregate)
+        return aggregate
+
+    @staticmethod
+    def apply_annotation_changes(task_id, annotation_version, changes):
         """
-        TODO does not respect task yet
+        Applies annotations stored with `Dataset.setannos` to a cached Fleiss' kappa aggregate.
+
+        `changes` is a list of `(sample_index, existed, previous_value, new_value)` tuples that raised the
+        task's annotation version to `annotation_version`. If the cached aggregate does not reflect the
+        version right before, other writes were missed and the aggregate is dropped, to be rebuilt on next use.
         """
+        cached = _FLEISS_AGGREGATES.get(task_id, None)
+        if cached is None:
+            return
+        if annotation_version is None or cached[0] != annotation_version - 1:
+            _FLEISS_AGGREGATES.pop(task_id, None)
+            return
+
+        aggregate = cached[1]
+        for sample_index, existed, previous_value, new_value in changes:
+            aggregate.update(sample_index,
+                             removed_category=anno_category(previous_value),
+                             added_category=anno_category(new_value),
+                             removed=existed,
+                             added=True)
+        _FLEISS_AGGREGATES[task_id] = (annotation_version, aggregate)
 
-        tags = self.get_taglist()
+    @staticmethod
+    def apply_annotation_changes_on_commit(dbsession, task_id, annotation_version, changes):
+        """
+        Applies the changes with `apply_annotation_changes` once the current transaction is committed,
+        so a rolled back transaction leaves the aggregate untouched.
+        """
+        after_commit(dbsession, lambda: DatasetTask.apply_annotation_changes(task_id, annotation_version, changes))
 
+    def agreement_counts(self, dbsession, split=None):
+        """
+        Number of annotations per sample and tag of this task, optionally restricted to a split.
+        """
         params = {
-                "dataset_id": self.dataset_id
+                "dataset_id": self.dataset_id,
+                "task_id": self.task_id
                 }
+        split_where = ""
+        if split is not None:
+            split_where = "AND dc.split_id = %(split_id)s"
+            params["split_id"] = split
+
         sql_raw = """
         SELECT
             anno.sample_index,
-            anno.data->'value' #>> '{}' AS anno_tag,
+            anno.data->'value' #>> '{{}}' AS anno_tag,
             COUNT(anno.owner_id) AS cnt
         FROM
             annotations as anno
+        JOIN datasetcontent AS dc
+            ON dc.dataset_id = anno.dataset_id
+            AND dc.sample_index = anno.sample_index
         WHERE
             anno.dataset_id = %(dataset_id)s
+            AND anno.task_id = %(task_id)s
+            {split_where}
         GROUP BY
-            anno.sample_index, anno.data->'value' #>> '{}'
-        """
+            anno.sample_index, anno.data->'value' #>> '{{}}'
+        """.format(split_where=split_where)
 
         sql_raw = prep_sql(sql_raw)
         logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
 
-        df = pd.read_sql(sql_raw,
-                         dbsession.bind,
-                         params=params)
+        return pd.read_sql(sql_raw, dbsession.bind, params=params)
+
+    def fleiss_components(self, dbsession, exclude_insufficient=False, split=None):
+        """
+        Computes the quantities Fleiss' kappa is based on (see `iaa.fleiss_components`) in the database,
+        so only one row per category is transferred instead of one row per sample and tag.
+
+        Returns None if there are no (sufficient) annotations.
+        """
+        params = {
+                "dataset_id": self.dataset_id,
+                "task_id": self.task_id
+                }
+        split_join = ""
+        if split is not None:
+            split_join = """
+            JOIN datasetcontent AS dc
+                ON dc.dataset_id = anno.dataset_id
+                AND dc.sample_index = anno.sample_index
+                AND dc.split_id = :split_id
+            """
+            params["split_id"] = split
+
+        # sample_totals holds the number of annotations (r_i) and the sum of squared counts (S_i) per sample
+        sql_raw = """
+        WITH cell_counts AS (
+            SELECT anno.sample_index, anno.data->'value' #>> '{{}}' AS anno_tag, COUNT(anno.owner_id) AS cnt
+            FROM annotations AS anno
+            {split_join}
+            WHERE anno.dataset_id = :dataset_id
+                AND anno.task_id = :task_id
+            GROUP BY anno.sample_index, anno.data->'value' #>> '{{}}'
+        ),
+        sample_totals AS (
+            SELECT cell_counts.sample_index,
+                SUM(cell_counts.cnt)::float AS total,
+                SUM(cell_counts.cnt * cell_counts.cnt)::float AS squares
+            FROM cell_counts
+            GROUP BY cell_counts.sample_index
+        ),
+        totals AS (
+            SELECT COUNT(*) AS samples,
+                MAX(sample_totals.total) AS max_total,
+                SUM(sample_totals.squares / (sample_totals.total * sample_totals.total)) AS agreement_sum,
+                COUNT(*) FILTER (WHERE sample_totals.total > 1) AS sufficient_samples,
+                SUM((sample_totals.squares - sample_totals.total) / (sample_totals.total * (sample_totals.total - 1)))
+                    FILTER (WHERE sample_totals.total > 1) AS sufficient_agreement_sum
+            FROM sample_totals
+        ),
+        categories AS (
+            SELECT cell_counts.anno_tag,
+                SUM(cell_counts.cnt / sample_totals.total) AS ratio_sum,
+                COALESCE(SUM(cell_counts.cnt) FILTER (WHERE sample_totals.total > 1), 0) AS sufficient_count
+            FROM cell_counts
+            JOIN sample_totals ON sample_totals.sample_index = cell_counts.sample_index
+            GROUP BY cell_counts.anno_tag
+        )
+        SELECT totals.*, categories.anno_tag, categories.ratio_sum, categories.sufficient_count
+        FROM totals CROSS JOIN categories
+        """.format(split_join=split_join)
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+
+        rows = dbsession.execute(sql.text(sql_raw), params=params).fetchall()
+        if len(rows) == 0:
+            return None
+
+        n = rows[0]["max_total"]
+        if not exclude_insufficient:
+            sample_count = rows[0]["samples"]
+            # rows normalized to n annotations contribute n^2 * S_i / r_i^2 to the sum of squares
+            p_avg = 1.0 if n <= 1 else (n * rows[0]["agreement_sum"] / sample_count - 1.0) / (n - 1.0)
+            p_j = [row["ratio_sum"] / sample_count for row in rows]
+        else:
+            sample_count = rows[0]["sufficient_samples"]
+            if sample_count == 0:
+                return None
+            p_avg = rows[0]["sufficient_agreement_sum"] / sample_count
+            p_j = [float(row["sufficient_count"]) / (sample_count * n) for row in rows]
+
+        return {
+                "N": sample_count,
+                "n": n,
+                "p_avg": p_avg,
+                "p_j": np.asarray(p_j, dtype=np.float64),
+                }
+
+    def agreement_intervals(self, dbsession, split=None, confidence=0.95):
+        """
+        Bootstrap confidence intervals of the overall and per-tag Fleiss' kappa, optionally restricted to a split.
+
+        Replicates are never computed within the request: they are computed in parallel in the batch job pool
+        if this process holds it, in a background thread otherwise. Until they are done, the previous result
+        is returned with `"status": "stale"`, or `{"status": "pending"}` if there is none.
+        Results are cached until the annotation version of the task or the split version of the dataset
+        (see `Dataset.split_version`) changes, for at most `AGREEMENT_INTERVALS_MAX_ENTRIES` tasks and splits.
+        At most one computation runs per task and split, so annotations stored in the meantime are picked up
+        by the next computation once the running one is done.
+        """
+        import app.lib.batchjobs as batchjobs
+
+        annotation_version = self.current_annotation_version(dbsession)
+        task_id = self.task_id
+        cache_key = (self.dataset_id, task_id, split)
+        cache_version = (annotation_version, self.dataset.split_version(dbsession))
+
+        previous_version, previous, running = _AGREEMENT_INTERVALS.get(cache_key, (None, None, None))
+        if cache_key in _AGREEMENT_INTERVALS:
+            _AGREEMENT_INTERVALS.move_to_end(cache_key)
+        if previous is not None and previous_version == cache_version:
+            return previous
+        # served until the running (or to be started) computation is done
+        interim = dict(previous, status="stale") if previous is not None else {"status": "pending"}
+        if running is not None:
+            return interim
+
+        tags = self.get_taglist()
+        _, categories, counts = iaa.count_matrix(self.agreement_counts(dbsession, split))
+        replicates = config.get_int("agreement_bootstrap_replicates", 1000)
+
+        def store_intervals(replicate_kappas):
+            result = {
+                    "status": "done",
+                    "fleiss": iaa.bootstrap_interval(replicate_kappas[:, 0], confidence),
+                    "tags": {},
+                    }
+            for tag_idx, tag in enumerate(tags):
+                result["tags"][tag] = iaa.bootstrap_interval(replicate_kappas[:, 1 + tag_idx], confidence)
+
+            if _AGREEMENT_INTERVALS.get(cache_key, (None, None, None))[2] is computation:
+                _AGREEMENT_INTERVALS[cache_key] = (cache_version, result, None)
+
+        def bootstrap_failed():
+            logging.error("bootstrapping agreement of task %s failed", task_id)
+            if _AGREEMENT_INTERVALS.get(cache_key, (None, None, None))[2] is computation:
+                if previous is None:
+                    del _AGREEMENT_INTERVALS[cache_key]
+                else:
+                    _AGREEMENT_INTERVALS[cache_key] = (previous_version, previous, None)
+
+        computation = object()
+        _AGREEMENT_INTERVALS[cache_key] = (previous_version, previous, computation)
+        _AGREEMENT_INTERVALS.move_to_end(cache_key)
+        while len(_AGREEMENT_INTERVALS) > AGREEMENT_INTERVALS_MAX_ENTRIES:
+            _AGREEMENT_INTERVALS.popitem(last=False)
+
+        if not batchjobs.accepts_jobs():
+            def thread_done(future):
+                if future.cancelled() or future.exception() is not None:
+                    bootstrap_failed()
+                    return
+                store_intervals(future.result())
+
+            future = batchjobs.background_thread().submit(iaa.bootstrap_fleiss_kappa, counts, categories, tags,
+                                                          replicates, [task_id, annotation_version])
+            future.add_done_callback(thread_done)
+            return interim
+
+        job_count = max(1, min(config.get_int("batch_max_workers", 1), replicates))
+        jobs = []
+
+        def job_done(_):
+            if not all(job.done() for job in jobs):
+                return
+            failed = [job for job in jobs if job.future.cancelled() or job.exception() is not None]
+            if len(failed) > 0:
+                bootstrap_failed()
+                return
+            store_intervals(np.concatenate([job.result() for job in jobs]))
+
+        for job_idx in range(job_count):
+            job_replicates = replicates // job_count + (1 if job_idx < replicates % job_count else 0)
+            jobs.append(batchjobs.BatchJob("iaa_bootstrap",
+                                           {"task_id": task_id, "split": split, "version": annotation_version},
+                                           counts, categories, tags, job_replicates,
+                                           [task_id, annotation_version, job_idx]))
+        for job in jobs:
+            job.add_done_callback(job_done)
+        return interim
+
+    @staticmethod
+    def invalidate_agreement_intervals(dataset_id):
+        """
+        Drops the cached confidence intervals of all tasks of a dataset, e.g. after split edits.
+        """
+        for cache_key in list(_AGREEMENT_INTERVALS.keys()):
+            if cache_key[0] == dataset_id:
+                del _AGREEMENT_INTERVALS[cache_key]
+
+    def annotation_agreement(self, dbsession, exclude_insufficient=False, by_tag=False, split=None):
+        """
+        calculates Fleiss' Kappa statistic on the annotations
+        of this task, optionally restricted to a split
+
+        if exclude_insufficient is set, rows with annotations by only one user are excluded.
+        Results are cached until the annotation version of the task or the dataset's splits change.
+        """
+        key = analyticscache.cache_key(self.dataset_id, self.task_id, split,
+                                       self.current_annotation_version(dbsession),
+                                       self.dataset.split_version(dbsession),
+                                       ("annotation_agreement", exclude_insufficient, by_tag,
+                                        tuple(self.get_taglist())))
+        return analyticscache.get(key, lambda: self._annotation_agreement(dbsession, exclude_insufficient,
+                                                                          by_tag, split))
+
+    def _annotation_agreement(self, dbsession, exclude_insufficient=False, by_tag=False, split=None):
+
+        tags = self.get_taglist()
 
         if not by_tag:
-            # return overall IAA
-            return iaa.fleiss_kappa(df, tags, exclude_insufficient=exclude_insufficient)
+            if not exclude_insufficient and split is None:
+                # served from the incrementally maintained aggregate of this task's annotations
+                return self.fleiss_aggregate(dbsession).kappa()
+            return iaa.fleiss_kappa_components(self.fleiss_components(dbsession,
+                                                                      exclude_insufficient=exclude_insufficient,
+                                                                      split=split))
+
+        df = self.agreement_counts(dbsession, split)
 
         iaa_result = {}
-        iaa_result['__overall'] = iaa.fleiss_kappa(df, tags, exclude_insufficient=False)
+        if df.shape[0] == 0:
+            iaa_result['__overall'] = iaa.fleiss_kappa(df, tags)
+            for tag in tags:
+                iaa_result[tag] = iaa.fleiss_kappa(df, tags)
+            return iaa_result
 
-        for tag in tags:
-            not_tag = "!%s" % tag
-            cur_tags = [tag, not_tag]
-            cur_df = df.copy()
+        # overall and one-vs-rest agreement per tag from a single count matrix
+        _, categories, counts = iaa.count_matrix(df)
+        iaa_result['__overall'] = iaa.fleiss_kappa_counts(counts, exclude_insufficient=False)
+        iaa_result.update(iaa.fleiss_kappa_one_vs_rest(counts, categories, tags))
 
-            cur_df.loc[cur_df.anno_tag != tag, 'anno_tag'] = not_tag
+        return iaa_result
 
-            cur_df = cur_df.groupby(["sample_index", "anno_tag"], as_index=False)[["cnt"]].sum()
+    def annotator_agreement(self, dbsession, split=None):
+        """
+        Calculates the pairwise Cohen's kappa between all annotators of this task and Krippendorff's alpha
+        over all annotations, optionally restricted to a split. Alpha uses the Jaccard distance between tag
+        sets for multiselect tasks and the nominal distance otherwise. Results are cached until the annotation
+        version of the task or the dataset's splits change.
+        """
+        key = analyticscache.cache_key(self.dataset_id, self.task_id, split,
+                                       self.current_annotation_version(dbsession),
+                                       self.dataset.split_version(dbsession),
+                                       "annotator_agreement")
+        return analyticscache.get(key, lambda: self._annotator_agreement(dbsession, split))
 
-            cols = ["sample_index", "anno_tag"]
-            midf = pd.MultiIndex.from_product([cur_df.sample_index, [tag, not_tag]], names=cols)
-            cur_df = cur_df.reset_index()
-            cur_df = cur_df.set_index(cols).reindex(midf, fill_value=0).reset_index().drop(columns=["index"])
-            cur_df.drop_duplicates(inplace=True)
+    def _annotator_agreement(self, dbsession, split=None):
+        params = {
+                "dataset_id": self.dataset_id,
+                "task_id": self.task_id
+                }
+        split_join = ""
+        if split is not None:
+            split_join = """
+            JOIN datasetcontent AS dc
+                ON dc.dataset_id = anno.dataset_id
+                AND dc.sample_index = anno.sample_index
+                AND dc.split_id = :split_id
+            """
+            params["split_id"] = split
 
-            logging.debug("FLEISS %s\n%s\n%s", tag, cur_df, cur_df.shape)
-            iaa_result[tag] = iaa.fleiss_kappa(cur_df,
-                                               cur_tags,
-                                               filter_target=tag,
-                                               exclude_insufficient=False)
+        sql_raw = """
+        SELECT
+            anno.sample_index,
+            anno.owner_id,
+            (CASE WHEN
+                (users.displayname IS NULL OR users.displayname = '')
+                THEN users.email
+                ELSE users.displayname
+                END) AS username,
+            anno.data->'value' AS anno_value
+        FROM
+            annotations AS anno
+        LEFT JOIN users
+            ON users.uid = anno.owner_id
+        {split_join}
+        WHERE
+            anno.dataset_id = :dataset_id
+            AND anno.task_id = :task_id
+            AND anno.data->'value' #>> '{{}}' IS NOT NULL
+        """.format(split_join=split_join)
 
-        return iaa_result
+        sql_raw = prep_sql(sql_raw)
+        logging.debug("DB_SQL_LOG %s %s", sql_raw, params)
+        rows = dbsession.execute(sql.text(sql_raw), params=params).fetchall()
+
+        set_valued = self.taskconfig.get("multiselect", False)
+
+        def value_key(anno_value):
+            if isinstance(anno_value, list):
+                return frozenset(str(element) for element in anno_value)
+            if set_valued:
+                return frozenset([str(anno_value)])
+            return str(anno_value)
+
+        sample_codes, _ = pd.factorize(np.array([row["sample_index"] for row in rows], dtype=np.int64))
+        annotator_codes, annotator_ids = pd.factorize(np.array([row["owner_id"] for row in rows], dtype=np.int64))
+        value_keys = np.empty(len(rows), dtype=object)
+        value_keys[:] = [value_key(row["anno_value"]) for row in rows]
+        value_codes, values = pd.factorize(value_keys)
+
+        usernames = {row["owner_id"]: row["username"] or str(row["owner_id"]) for row in rows}
+        annotators = [usernames[annotator_id] for annotator_id in annotator_ids]
+
+        kappa, shared = iaa.cohen_kappa_matrix(sample_codes, annotator_codes, value_codes,
+                                               len(annotators), len(values))
+        kappa = np.round(kappa, 4)
+
+        if set_valued:
+            distance = iaa.jaccard_distance([value if isinstance(value, frozenset) else frozenset([value])
+                                             for value in values])
+        else:
+            distance = iaa.nominal_distance(len(values))
+        alpha = iaa.krippendorff_alpha(sample_codes, annotator_codes, value_codes, distance)
+        alpha["metric"] = "jaccard" if set_valued else "nominal"
+
+        return {
+                "cohen": {
+                    "type": "cohen",
+                    "annotators": annotators,
+                    "kappa": [[None if np.isnan(pair_kappa) else float(pair_kappa) for pair_kappa in kappa_row]
+                              for kappa_row in kappa],
+                    "n": shared.astype(int).tolist(),
+                    },
+                "krippendorff": alpha,
+                }
 
 
 def prep_sql(sql_raw):
@@ -0,0 +1,28 @@
+"""sample navigation indices
+
+Revision ID: 124dfa924e4e
+Revises: f5f00a6a45ea
+Create Date: 2026-10-19 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '124dfa924e4e'
+down_revision = 'f5f00a6a45ea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_datasetcontent_dataset_split_sample', 'datasetcontent',
+                    ['dataset_id', 'split_id', 'sample_index'], unique=False)
+    op.create_index('ix_annotations_dataset_owner_sample', 'annotations',
+                    ['dataset_id', 'owner_id', 'sample_index', 'task_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_annotations_dataset_owner_sample', table_name='annotations')
+    op.drop_index('ix_datasetcontent_dataset_split_sample', table_name='datasetcontent')
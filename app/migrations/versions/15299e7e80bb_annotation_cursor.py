@@ -0,0 +1,38 @@
+"""annotation cursor
+
+Revision ID: 15299e7e80bb
+Revises: 1e7bb0e446fc
+Create Date: 2026-10-19 12:41:09.106357
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '15299e7e80bb'
+down_revision = '1e7bb0e446fc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('annotationcursor',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('task_id', sa.Integer(), nullable=False),
+    sa.Column('sample_index', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.dataset_id'], ),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.uid'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'dataset_id', 'task_id')
+    )
+    op.execute("""
+    INSERT INTO annotationcursor (owner_id, dataset_id, task_id, sample_index)
+    SELECT anno.owner_id, anno.dataset_id, anno.task_id, MAX(anno.sample_index)
+    FROM annotations AS anno
+    GROUP BY anno.owner_id, anno.dataset_id, anno.task_id
+    """)
+
+
+def downgrade():
+    op.drop_table('annotationcursor')
@@ -0,0 +1,38 @@
+"""sample annotation count
+
+Revision ID: 1e7bb0e446fc
+Revises: d0bbca489a8d
+Create Date: 2026-10-19 12:04:51.772930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e7bb0e446fc'
+down_revision = 'd0bbca489a8d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('datasetcontent', sa.Column('annotation_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute("""
+    UPDATE datasetcontent AS dc
+        SET annotation_count = counts.annotation_count
+    FROM (
+        SELECT anno.dataset_id, anno.sample_index, COUNT(DISTINCT anno.owner_id) AS annotation_count
+        FROM annotations AS anno
+        GROUP BY anno.dataset_id, anno.sample_index
+    ) AS counts
+    WHERE dc.dataset_id = counts.dataset_id
+        AND dc.sample_index = counts.sample_index
+    """)
+    op.create_index('ix_datasetcontent_dataset_annocount_sample', 'datasetcontent',
+                    ['dataset_id', 'annotation_count', 'sample_index'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_datasetcontent_dataset_annocount_sample', table_name='datasetcontent')
+    op.drop_column('datasetcontent', 'annotation_count')
@@ -0,0 +1,34 @@
+"""sample order
+
+Revision ID: 20242dde82d4
+Revises: 124dfa924e4e
+Create Date: 2026-10-19 10:03:17.552690
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '20242dde82d4'
+down_revision = '124dfa924e4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sampleorder',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('seed', sa.BigInteger(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('signature', sa.String(), nullable=False),
+    sa.Column('permutation', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.dataset_id'], ),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.uid'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'dataset_id')
+    )
+
+
+def downgrade():
+    op.drop_table('sampleorder')
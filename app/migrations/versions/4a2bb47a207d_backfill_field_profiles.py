@@ -0,0 +1,49 @@
+"""backfill field profiles
+
+Revision ID: 4a2bb47a207d
+Revises: 4c60e6088048
+Create Date: 2026-10-19 17:10:49.249975
+
+"""
+from datetime import datetime
+import json
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from app.lib import colprofile
+from app.lib.npencoder import NpEncoder
+
+
+# revision identifiers, used by Alembic.
+revision = '4a2bb47a207d'
+down_revision = '4c60e6088048'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # profiles are stored on import, datasets imported before that are profiled once here
+    # instead of within the first request that needs them
+    dbsession = orm.Session(bind=op.get_bind())
+    dataset_ids = [row[0] for row in dbsession.execute(sa.text("""
+    SELECT dataset_id FROM datasets
+    WHERE json_typeof(dsmetadata) = 'object' AND dsmetadata->'field_profiles' IS NULL
+    ORDER BY dataset_id
+    """))]
+
+    for dataset_id in dataset_ids:
+        field_profiles = colprofile.dataset_overview(dbsession, dataset_id)
+        field_profiles["updated"] = datetime.now().timestamp()
+        dbsession.execute(sa.text("""
+        UPDATE datasets
+            SET dsmetadata = jsonb_set(dsmetadata::jsonb, '{field_profiles}', CAST(:field_profiles AS jsonb))::json
+        WHERE dataset_id = :dataset_id
+        """), {"dataset_id": dataset_id, "field_profiles": json.dumps(field_profiles, cls=NpEncoder)})
+    dbsession.close()
+
+
+def downgrade():
+    # stored profiles are kept, they are not tied to a schema change
+    pass
@@ -0,0 +1,38 @@
+"""annotation cursor revision
+
+Revision ID: 4c60e6088048
+Revises: 59defcd64418
+Create Date: 2026-10-19 16:02:37.215980
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c60e6088048'
+down_revision = '59defcd64418'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('annotationcursor', sa.Column('revision', sa.Integer(), server_default='0', nullable=False))
+    op.create_index('ix_annotationcursor_task_revision', 'annotationcursor',
+                    ['task_id', 'revision'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_annotationcursor_task_revision', table_name='annotationcursor')
+    # fold the cursor revisions into the task versions, so that versions keep increasing
+    op.execute("""
+    UPDATE tasks
+        SET annotation_version = tasks.annotation_version + revisions.revision + 1
+    FROM (
+        SELECT resume.task_id, SUM(resume.revision) AS revision
+        FROM annotationcursor AS resume
+        GROUP BY resume.task_id
+    ) AS revisions
+    WHERE tasks.task_id = revisions.task_id
+    """)
+    op.drop_column('annotationcursor', 'revision')
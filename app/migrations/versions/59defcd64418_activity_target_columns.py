@@ -0,0 +1,35 @@
+"""activity target columns
+
+Revision ID: 59defcd64418
+Revises: bea4c5b43cd5
+Create Date: 2026-10-19 15:21:09.604713
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '59defcd64418'
+down_revision = 'bea4c5b43cd5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('activity', sa.Column('target_type', sa.String(), nullable=True))
+    op.add_column('activity', sa.Column('target_id', sa.Integer(), nullable=True))
+    op.execute("""
+    UPDATE activity
+        SET target_type = split_part(target, ':', 1),
+            target_id = CAST(split_part(target, ':', 2) AS INTEGER)
+    WHERE target ~ '^[^:]+:[0-9]+$'
+    """)
+    op.create_index('ix_activity_target_scope_event', 'activity',
+                    ['target_type', 'target_id', 'scope', sa.text('event_id DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_activity_target_scope_event', table_name='activity')
+    op.drop_column('activity', 'target_id')
+    op.drop_column('activity', 'target_type')
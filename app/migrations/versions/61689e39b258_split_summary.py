@@ -0,0 +1,46 @@
+"""split summary
+
+Revision ID: 61689e39b258
+Revises: 4a2bb47a207d
+Create Date: 2026-10-19 17:48:12.530184
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '61689e39b258'
+down_revision = '4a2bb47a207d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('splitsummary',
+    sa.Column('summary_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('split_id', sa.String(), nullable=True),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.dataset_id'], ),
+    sa.PrimaryKeyConstraint('summary_id')
+    )
+    op.create_index('ix_splitsummary_dataset_summary', 'splitsummary', ['dataset_id', 'summary_id'], unique=False)
+    op.execute("""
+    INSERT INTO splitsummary (dataset_id, split_id, size)
+    SELECT dc.dataset_id, dc.split_id, COUNT(*)
+    FROM datasetcontent AS dc
+    GROUP BY dc.dataset_id, dc.split_id
+    """)
+    # sizes and versions are no longer kept in the dataset metadata
+    op.execute("""
+    UPDATE datasets
+        SET dsmetadata = (dsmetadata::jsonb - 'split_sizes' - 'split_version')::json
+    WHERE json_typeof(dsmetadata) = 'object'
+    """)
+
+
+def downgrade():
+    # split sizes are counted again on first use
+    op.drop_index('ix_splitsummary_dataset_summary', table_name='splitsummary')
+    op.drop_table('splitsummary')
@@ -0,0 +1,24 @@
+"""task annotation version
+
+Revision ID: bea4c5b43cd5
+Revises: 15299e7e80bb
+Create Date: 2026-10-19 13:05:42.518337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bea4c5b43cd5'
+down_revision = '15299e7e80bb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tasks', sa.Column('annotation_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('tasks', 'annotation_version')
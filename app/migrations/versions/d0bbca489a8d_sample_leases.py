@@ -0,0 +1,34 @@
+"""sample leases
+
+Revision ID: d0bbca489a8d
+Revises: 20242dde82d4
+Create Date: 2026-10-19 11:27:05.308412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd0bbca489a8d'
+down_revision = '20242dde82d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('samplelease',
+    sa.Column('dataset_id', sa.Integer(), nullable=False),
+    sa.Column('sample_index', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['dataset_id'], ['datasets.dataset_id'], ),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.uid'], ),
+    sa.PrimaryKeyConstraint('dataset_id', 'sample_index', 'owner_id')
+    )
+    op.create_index('ix_samplelease_dataset_expires', 'samplelease', ['dataset_id', 'expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_samplelease_dataset_expires', table_name='samplelease')
+    op.drop_table('samplelease')
@@ -4,11 +4,12 @@ Annotation routes
 
 from flask import request, session, abort, flash, render_template, url_for, redirect
 
+import app.lib.config as config
 from app.lib.viewhelpers import login_required, get_session_user
 from app.web import app, BASEURI, db
 
 
-def handle_set_annotation(dbsession, dataset):
+def handle_set_annotation(dbsession, dataset, session_user=None):
 
     set_sample_idx = None
     set_sample_value = None
@@ -28,7 +29,11 @@ def handle_set_annotation(dbsession, dataset):
         set_sample_value = request.args.get("set_value", "")[:1000]
 
     if set_sample_idx is not None and set_sample_value is not None and set_task_id is not None:
-        dataset.setanno(dbsession, get_session_user(dbsession), set_sample_idx, set_task_id, set_sample_value)
+        # the annotation view reads back through the same session, committing is left to the session scope
+        if session_user is None:
+            session_user = get_session_user(dbsession)
+        dataset.setanno(dbsession, session_user, set_sample_idx, set_task_id, set_sample_value,
+                        commit=False)
 
 
 def get_votes_disabled(dbsession, dataset, user_roles, session_user, sample_id):
@@ -47,24 +52,33 @@ def get_votes_disabled(dbsession, dataset, user_roles, session_user, sample_id):
     return anno_votes
 
 
-def get_random_sample(df, id_column):
-    no_anno = df[~(df.annotations != '')]
-    # make sure to randomly select a sample that has not been annotated yet (if any are left)
-    if not no_anno.empty:
-        df = no_anno
-    if df.empty:
-        return None, None
+def get_additional_content(dataset, sample_data):
+    additional_content = None
+    additional_content_fields = dataset.dsmetadata.get("additional_column", None)
+    if additional_content_fields is not None:
+        if isinstance(additional_content_fields, str):
+            if additional_content_fields.strip() != "":
+                additional_content_fields = [additional_content_fields]
+            else:
+                additional_content_fields = []
 
-    sample_row = df.sample(n=1)
-    sample_idx = sample_row.index.values.astype(int)[0]
-    sample_id = sample_row[id_column].values[0]
-    return sample_idx, sample_id
+        additional_content = {}
+        for additional_content_field in additional_content_fields:
+            additional_content[additional_content_field] = None
 
+            if sample_data is None:
+                continue
+            if additional_content_field in sample_data:
+                additional_content[additional_content_field] = str(sample_data[additional_content_field])
+    return additional_content
+
+
+def uses_random_order(dataset):
+    return dataset.dsmetadata.get("annoorder", "sequential") == "random"
 
-def get_annotation_dataframe(dbsession, task, session_user, min_sample_idx=None, random_order=False):
+
+def get_annotation_dataframe(dbsession, task, session_user, min_sample_idx=None):
     order_by = "o.sample_index, usercol_value ASC NULLS LAST"
-    if random_order:
-        order_by = "random()"
 
     no_anno_df, annotation_columns, total = task.dataset.annotations(dbsession,
                                                                      foruser=session_user,
@@ -89,46 +103,46 @@ def get_annotation_dataframe(dbsession, task, session_user, min_sample_idx=None,
     return no_anno_df, annotation_columns, total
 
 
-def get_sample_index(dbsession, task, session_user, random_order=False):
+def get_sample_index(dbsession, task, session_user):
     sample_idx = None
     sample_id = None
 
-    if not random_order:
-        try:
-            if not request.args.get("sample_idx", None) is None:
-                sample_idx = int(request.args.get("sample_idx", None))
+    try:
+        if not request.args.get("sample_idx", None) is None:
+            sample_idx = int(request.args.get("sample_idx", None))
 
-        except ValueError:
-            pass
+    except ValueError:
+        pass
 
-        no_anno_df, annotation_columns, total = get_annotation_dataframe(dbsession,
-                                                                         task,
-                                                                         session_user,
-                                                                         min_sample_idx=sample_idx,
-                                                                         random_order=False)
-    else:
-        no_anno_df, annotation_columns, total = get_annotation_dataframe(dbsession,
-                                                                         task,
-                                                                         session_user,
-                                                                         random_order=True)
+    if sample_idx is not None:
+        return sample_idx, sample_id, False
 
-    if no_anno_df.empty:
-        return sample_idx, sample_id, no_anno_df, annotation_columns, total
+    if uses_random_order(task.dataset):
+        # continue with the next unannotated sample in the user's persisted random order
+        sample_order = task.dataset.sample_order(dbsession, session_user, task.splits)
+        sample_idx = sample_order.next_sample(dbsession)
+    else:
+        if task.dataset.uses_sample_leases():
+            # serve a sample that is not reserved by other annotators
+            sample_idx, _ = task.dataset.lease_sample(dbsession, session_user, task.splits)
+        if sample_idx is None:
+            # continue after the furthest sample the user annotated
+            sample_idx, _ = task.dataset.resume_sample(dbsession, session_user, task.splits)
 
-    requires_redirect = False
     if sample_idx is None:
-        requires_redirect = True
-        if task.dataset.dsmetadata.get("annoorder", "sequential") == 'random':
-            sample_idx, sample_id = get_random_sample(no_anno_df, task.dataset.get_id_column())
-        else:
-            first_row = no_anno_df.iloc[no_anno_df.index[0]]
-            sample_idx = first_row['sample_index']
-            sample_id = first_row[task.dataset.get_id_column()]
-    return sample_idx, sample_id, no_anno_df, annotation_columns, total, requires_redirect
+        # no unannotated sample left, this only yields samples if re-annotating them is allowed
+        no_anno_df, _, _ = get_annotation_dataframe(dbsession, task, session_user)
+        if no_anno_df.empty:
+            return None, None, False
 
+        first_row = no_anno_df.iloc[no_anno_df.index[0]]
+        sample_idx = first_row['sample_index']
+        sample_id = first_row[task.dataset.get_id_column()]
+    return sample_idx, sample_id, True
 
-def increment_task_states(df, task, annotation_tasks):
-    if "set_sample_idx" in request.args and df is not None and not df.empty:
+
+def increment_task_states(sample_idx, task, annotation_tasks):
+    if "set_sample_idx" in request.args and sample_idx is not None:
         if task.annos < task.size:
             task.annos += 1
         if task.annos_today < task.size:
@@ -155,7 +169,7 @@ def generate_task_complete_activity(dbsession, activity_owner, dataset, task):
 
     qry = dbsession.query(db.Activity)
     qry = qry.filter(db.Activity.owner == activity_owner,
-                     db.Activity.target == dataset.activity_target(),
+                     db.Activity.target_filter(dataset),
                      db.Activity.scope == "task_complete",
                      db.Activity.content == activity_content)
     existing = qry.one_or_none()
@@ -182,38 +196,35 @@ def annotate(dsid=None, sample_idx=None, prev_sample_ptr=None):
 
         task = dataset.get_task(dbsession, session_user)
 
-        sample_idx, sample_id, df, _, _, redirect_to_sample = get_sample_index(dbsession, task, session_user)
+        sample_idx, sample_id, redirect_to_sample = get_sample_index(dbsession, task, session_user)
 
         if redirect_to_sample:
             return redirect(url_for("annotate", dsid=dsid, sample_idx=sample_idx))
 
-        handle_set_annotation(dbsession, dataset)
+        handle_set_annotation(dbsession, dataset, session_user)
 
         sample = dataset.sample_by_index(dbsession, sample_idx) if sample_idx is not None else None
         sample_id = sample.sample if sample is not None else None
 
-        additional_content = None
-        additional_content_fields = dataset.dsmetadata.get("additional_column", None)
-        if additional_content_fields is not None:
-            if isinstance(additional_content_fields, str):
-                if additional_content_fields.strip() != "":
-                    additional_content_fields = [additional_content_fields]
-                else:
-                    additional_content_fields = []
-
-            additional_content = {}
-            for additional_content_field in additional_content_fields:
-                additional_content[additional_content_field] = None
-
-                if sample is None or sample.data is None:
-                    continue
-                if additional_content_field in sample.data:
-                    additional_content[additional_content_field] = str(sample.data[additional_content_field])
+        additional_content = get_additional_content(dataset, sample.data if sample is not None else None)
 
         sample_prev = prev_sample_ptr
-        if sample_prev is None:
-            sample_prev, _ = dataset.get_prev_sample(dbsession, sample_idx, session_user, task.splits)
-        sample_next, _ = dataset.get_next_sample(dbsession, sample_idx, session_user, task.splits)
+        if uses_random_order(dataset) and sample_idx is not None:
+            sample_order = dataset.sample_order(dbsession, session_user, task.splits)
+            sample_order.advance_to(sample_idx)
+
+            if sample_prev is None:
+                sample_prev = sample_order.prev_sample()
+            sample_next = sample_order.next_sample(dbsession, exclude=int(sample_idx), move_cursor=False)
+        else:
+            if sample_prev is None:
+                sample_prev, _ = dataset.get_prev_sample(dbsession, sample_idx, session_user, task.splits)
+            sample_next = None
+            if dataset.uses_sample_leases() and sample_idx is not None:
+                dataset.renew_lease(dbsession, session_user, sample_idx)
+                sample_next, _ = dataset.lease_sample(dbsession, session_user, task.splits, exclude=int(sample_idx))
+            if sample_next is None:
+                sample_next, _ = dataset.get_next_sample(dbsession, sample_idx, session_user, task.splits)
 
         curanno_data = dataset.getanno(dbsession, session_user, "*", sample_id) if sample_id is not None else None
         curanno = None
@@ -221,13 +232,11 @@ def annotate(dsid=None, sample_idx=None, prev_sample_ptr=None):
             curanno = curanno_data
 
         annotation_tasks = db.datasets.annotation_tasks(dbsession, session_user)
-        increment_task_states(df, task, annotation_tasks)
+        increment_task_states(sample_idx, task, annotation_tasks)
 
         task.calculate_progress()
 
-        all_done = sample_idx is None or df is None or df.empty
-        if not all_done:
-            all_done = task.progress >= 100.0
+        all_done = sample_idx is None or task.progress >= 100.0
         if all_done:
             flash("Task complete! You have annotated all samples in this task", "success")
             generate_task_complete_activity(dbsession, session_user, dataset, task)
@@ -252,3 +261,61 @@ def annotate(dsid=None, sample_idx=None, prev_sample_ptr=None):
                                sample_prev=sample_prev,
                                sample_next=sample_next,
                                curanno=curanno)
+
+
+@app.route(BASEURI + "/dataset/<dsid>/annotate.json", methods=["GET", "POST"])
+@login_required
+def annotate_queue(dsid=None):
+    """
+    Returns the current sample along with a queue of prefetched upcoming samples, so a client can annotate
+    from a local queue and refill it in the background. Accepts the same `set_sample_idx`, `set_taskid`
+    and `set_value` arguments as the annotation view to store an annotation in the same request.
+
+    Plain GET requests (e.g. prefetching) do not move the user's position in the annotation order,
+    only POST requests and requests that store an annotation do.
+    """
+    with db.session_scope() as dbsession:
+        session_user = db.User.by_id(dbsession, session['user'])
+        dataset = db.datasets.get_accessible_dataset(dbsession, dsid, "annotator")
+
+        if dataset is None:
+            return abort(404, description="Forbidden. User does not have annotation access to the requested dataset.")
+
+        handle_set_annotation(dbsession, dataset, session_user)
+
+        sample_idx = None
+        max_prefetch = config.get_int("annotate_prefetch_max", 50)
+        prefetch = config.get_int("annotate_prefetch", 5)
+        try:
+            if request.args.get("sample_idx", None) is not None:
+                sample_idx = int(request.args.get("sample_idx", None))
+            if request.args.get("prefetch", None) is not None:
+                prefetch = int(request.args.get("prefetch", None))
+        except ValueError:
+            return abort(400, description="sample_idx and prefetch need to be integers.")
+        prefetch = max(0, min(prefetch, max_prefetch))
+
+        task = dataset.get_task(dbsession, session_user)
+        move_cursor = request.method == "POST" or request.args.get("set_sample_idx", None) is not None
+        queue = dataset.annotation_queue(dbsession, session_user, task.splits, sample_index=sample_idx, size=prefetch,
+                                         move_cursor=move_cursor)
+
+        for queued_sample in queue:
+            queued_sample["additional_content"] = get_additional_content(dataset, queued_sample["data"])
+            del queued_sample["data"]
+
+        all_done = len(queue) == 0 or (sample_idx is None and task.progress >= 100.0)
+        if dataset.dsmetadata.get("allow_restart_annotation", False) or sample_idx is not None:
+            all_done = False
+
+        return {
+                "dataset": dataset.dataset_id,
+                "progress": {
+                    "size": task.size,
+                    "annotations": task.annos,
+                    "annotations_today": task.annos_today,
+                    "progress": task.progress,
+                    },
+                "all_done": all_done,
+                "samples": queue,
+                }
@@ -18,6 +18,7 @@ from flask_smorest import Api, Blueprint, abort
 from app.lib.viewhelpers import get_session_user
 from app.lib import config
 from app.lib import crypto
+from app.lib import analyticscache
 from app.lib import api_schemas as schemas
 from app import __version__ as app_version
 from app.web import app, BASEURI, db
@@ -180,4 +181,59 @@ class APIDatasets(MethodView):
             return [schemas.DatasetSchema.to_api(dataset) for dataset in datasets.values()]
 
 
+@api.route("/datasets/<int:dataset_id>/annotations")
+class APIDatasetAnnotations(MethodView):
+
+    @api.arguments(schemas.AnnotationBatch)
+    @api.response(200, schemas.AnnotationBatchResult)
+    def post(self, annotation_batch, dataset_id):
+        """
+        Store a batch of annotations for the authenticated user in a single transaction.
+        """
+        with db.session_scope() as dbsession:
+            _, session_user = api_get_auth_info(dbsession)
+
+            dataset = db.Dataset.by_id(dbsession, dataset_id, no_error=True)
+            if dataset is None or "annotator" not in dataset.get_roles(dbsession, session_user):
+                return abort(404, message="Dataset not found or user does not have annotation access.")
+
+            items = annotation_batch.get("annotations", [])
+            max_batch_size = config.get_int("api_annotation_batch_max", 1000)
+            if len(items) > max_batch_size:
+                return abort(400, message="Batch exceeds the maximum of %s annotations." % max_batch_size)
+
+            items = [(item["sample_index"],
+                      item["task_id"],
+                      item["value"][:1000] if isinstance(item["value"], str) else item["value"])
+                     for item in items]
+
+            results = dataset.setannos(dbsession,
+                                       session_user,
+                                       items,
+                                       splits=dataset.get_annotation_splits(dbsession, session_user),
+                                       commit=False)
+
+            return {
+                    "dataset": dataset.dataset_id,
+                    "stored": len([result for result in results if result["status"] == "ok"]),
+                    "items": results
+                    }
+
+
+@api.route("/status/analyticscache")
+class APIAnalyticsCacheStatus(MethodView):
+
+    @api.response(200, schemas.AnalyticsCacheStatus)
+    def get(self):
+        """
+        Hit, miss and eviction counters of the analytics cache of the worker process serving the request.
+        Restricted to administrators if `ADMIN_USERS` is configured.
+        """
+        with db.session_scope() as dbsession:
+            _, session_user = api_get_auth_info(dbsession)
+            if not session_user.can_create():
+                return abort(403, message="Forbidden.")
+            return analyticscache.status()
+
+
 flask_api.register_blueprint(api)
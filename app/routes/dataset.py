@@ -10,7 +10,6 @@ from io import StringIO
 
 from werkzeug.utils import secure_filename
 from flask import flash, redirect, render_template, request, url_for, session, Response, abort
-import numpy as np
 
 import app.lib.config as config
 from app.lib.viewhelpers import login_required, get_session_user
@@ -29,7 +28,8 @@ def download(dsid=None):
     with db.session_scope() as dbsession:
         cur_dataset = datasets.get_accessible_dataset(dbsession, dsid)
 
-        df, _, _ = cur_dataset.annotations(dbsession, foruser=db.User.system_user(dbsession), page_size=-1)
+        df, _, _ = cur_dataset.annotations(dbsession, foruser=db.User.system_user(dbsession), page_size=-1,
+                                           with_data=True)
 
         s = StringIO()
         df.to_csv(s)
@@ -260,11 +260,7 @@ def dataset_field_overview(dsid, fieldid):
         field_overview = {}
 
         dataset = datasets.get_accessible_dataset(dbsession, dsid)
-        dataset_overview = dataset.get_overview_statistics(dbsession)['columns']
-        for _, column_info in dataset_overview.items():
-            column_type = column_info.get("dtype", None)
-            if isinstance(column_type, np.dtype):
-                column_info['dtype'] = str(column_type)
+        dataset_overview = dataset.field_profiles(dbsession)['columns']
 
         field_overview['fields'] = list(dataset_overview.keys())
         if fieldid not in dataset_overview.keys():
@@ -273,12 +269,32 @@ def dataset_field_overview(dsid, fieldid):
         for k, v in dataset_overview[fieldid].items():
             field_overview[k] = v
 
-        if field_overview['numeric']:
-            field_overview['min'], field_overview['max'] = dataset.get_field_minmax(dbsession, fieldid)
-
         return field_overview
 
 
+@app.route(BASEURI + "/dataset/<dsid>/field/<fieldid>/histogram.json", methods=["GET"])
+def dataset_field_histogram(dsid, fieldid):
+    """
+    Histogram, quartiles and equal-size split suggestions of a numeric field, optionally within a split.
+    """
+    with db.session_scope() as dbsession:
+        dataset = datasets.get_accessible_dataset(dbsession, dsid)
+        if dataset is None:
+            return abort(404)
+
+        try:
+            bins = min(int(request.args.get("bins", 20)), config.get_int("field_histogram_max_bins", 200))
+            parts = min(int(request.args.get("parts", 2)), 100)
+        except ValueError:
+            return abort(400, description="bins and parts need to be integers.")
+
+        histogram = dataset.field_histogram(dbsession, fieldid, bins=bins, parts=parts,
+                                            targetsplit=request.args.get("split", None))
+        if histogram is None:
+            return abort(404, description="Field not found or not numeric.")
+        return histogram
+
+
 @app.route(BASEURI + "/dataset/<dsid>/<taskid>/overview.json", methods=["GET"])
 def dataset_overview_json(dsid, taskid):
     dataset = None
@@ -293,9 +309,12 @@ def dataset_overview_json(dsid, taskid):
         tag_metadata = task.get_taglist(include_metadata=True)
         ds_total = dataset.get_size()
 
-        annotations_by_user, all_annotations = task.annotation_counts(dbsession)
+        split = request.args.get("split", None)
+        annotations_by_user, all_annotations = task.annotation_counts(dbsession, split=split)
 
-        agreement_fleiss = task.annotation_agreement(dbsession, by_tag=False)
+        agreement_fleiss = task.annotation_agreement(dbsession, by_tag=False, split=split)
+        agreement_annotators = task.annotator_agreement(dbsession, split=split)
+        agreement_intervals = task.agreement_intervals(dbsession, split=split)
 
         dsoverview = {
                 "dataset": dataset.dataset_id,
@@ -306,6 +325,9 @@ def dataset_overview_json(dsid, taskid):
                 "tags": tags,
                 "tag_metadata": tag_metadata,
                 "fleiss": agreement_fleiss,
+                "fleiss_interval": agreement_intervals,
+                "cohen": agreement_annotators["cohen"],
+                "krippendorff": agreement_annotators["krippendorff"],
                 }
 
         return dsoverview
@@ -409,6 +431,12 @@ def editdataset_form_action_metadata(dbsession, dataset, formaction):
         dataset.dsmetadata["quotechar"] = newquot
         dataset.invalidate()
 
+    if formaction == "change_target_redundancy":
+        try:
+            dataset.dsmetadata["target_redundancy"] = max(0, int(request.form.get("target_redundancy", 0) or 0))
+        except ValueError:
+            flash("Invalid value for the target number of annotations per sample.", "error")
+
     for metadatakey in ["textcol", "idcolumn", "annoorder"]:
         if formaction == "change_%s" % metadatakey and not request.form.get(metadatakey, None) is None:
             dataset.dsmetadata[metadatakey] = request.form.get(metadatakey, None)
@@ -722,7 +750,7 @@ def dataset_admin(dsid=None):
                                dataset_task=dataset_task,
                                can_import=can_import,
                                has_upload_content=has_upload_content,
-                               sample_stats=dataset.get_overview_statistics(dbsession),
+                               sample_stats=dataset.field_profiles(dbsession),
                                userroles=dataset.get_roles(dbsession, userobj),
                                default_dataset_delimiter=get_default_dataset_delimiter(),
                                comments=comments)
@@ -195,7 +195,7 @@ def inspect_handle_action(dbsession, cur_dataset, session_user, ds_filters, task
                         break
 
         if new_value is not None:
-            cur_dataset.setanno(dbsession, system_user, bulk_sample, task.task_id, new_value)
+            cur_dataset.setanno(dbsession, system_user, bulk_sample, task.task_id, new_value, commit=False)
             bulk_action_result['applied'] += 1
 
     db.Activity.create(dbsession,
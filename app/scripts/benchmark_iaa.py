@@ -0,0 +1,85 @@
+"""
+Benchmark for the Fleiss' kappa calculation in `app.lib.iaa`.
+
+Compares the pivot based reference implementation (`fleiss_kappa_pandas`) against the
+count matrix based `fleiss_kappa` on synthetic annotation counts and checks that both return
+identical results. Does not require a database.
+
+Usage:
+
+    python -m app.scripts.benchmark_iaa --samples 100000 --tags 5 --annotators 3
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+import pandas as pd
+
+import app.lib.iaa as iaa
+
+
+def synthetic_counts(sample_count, tag_count, annotator_count, seed):
+    """
+    Annotation counts in the format returned by `DatasetTask.agreement_counts`
+    (one row per sample and tag), with annotators agreeing on a "true" tag most of the time.
+    """
+    rng = np.random.default_rng(seed)
+    tags = ["tag-%s" % tag_idx for tag_idx in range(tag_count)]
+
+    true_tags = rng.integers(0, tag_count, size=sample_count)
+    votes = np.where(rng.random((sample_count, annotator_count)) < 0.7,
+                     true_tags[:, np.newaxis],
+                     rng.integers(0, tag_count, size=(sample_count, annotator_count)))
+    # not every annotator labels every sample
+    votes = np.where(rng.random((sample_count, annotator_count)) < 0.8, votes, -1)
+
+    df = pd.DataFrame({"sample_index": np.repeat(np.arange(sample_count), annotator_count),
+                       "tag_idx": votes.ravel()})
+    df = df[df.tag_idx >= 0]
+    df = df.groupby(["sample_index", "tag_idx"], as_index=False).size().rename(columns={"size": "cnt"})
+    df["anno_tag"] = [tags[tag_idx] for tag_idx in df.tag_idx]
+    return df[["sample_index", "anno_tag", "cnt"]], tags
+
+
+def timed(fn, repeat):
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append((time.perf_counter() - start) * 1000.0)
+    return result, statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleiss' kappa benchmark")
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--annotators", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    df, tags = synthetic_counts(args.samples, args.tags, args.annotators, args.seed)
+    print("%s samples, %s tags, %s annotators, %s count rows" %
+          (args.samples, args.tags, args.annotators, df.shape[0]))
+    print("%-28s %-12s %-12s %-8s" % ("variant", "pandas (ms)", "numpy (ms)", "speedup"))
+
+    variants = [("overall", {}),
+                ("exclude_insufficient", {"exclude_insufficient": True}),
+                ("filter_target=%s" % tags[0], {"filter_target": tags[0]})]
+
+    for variant_name, kwargs in variants:
+        reference, pandas_ms = timed(lambda: iaa.fleiss_kappa_pandas(df.copy(), tags, **kwargs), args.repeat)
+        result, numpy_ms = timed(lambda: iaa.fleiss_kappa(df, tags, **kwargs), args.repeat)
+
+        if reference != result:
+            raise Exception("results differ for %s: %s != %s" % (variant_name, reference, result))
+
+        print("%-28s %-12.2f %-12.2f %-8s" % (variant_name, pandas_ms, numpy_ms,
+                                              "%.1fx" % (pandas_ms / numpy_ms if numpy_ms > 0 else float("inf"))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Benchmark for the sample navigation queries used by the annotation view.
+
+Compares the former LEFT JOIN / GROUP BY lookup of the next unannotated sample against the NOT EXISTS
+anti-join (with and without the navigation indices, which are dropped within a rolled back savepoint)
+and `Dataset.get_next_sample`, which uses the per-user annotation bitmaps (see `app.lib.annobitmap`) and
+confirms candidates with the anti-join. The first repetition of each position includes loading the bitmap.
+
+Usage (inside the application container):
+
+    python -m app.scripts.benchmark_navigation --populate 1000000
+    python -m app.scripts.benchmark_navigation --dataset 42 --user 3
+
+`--populate N` creates a synthetic dataset with N samples (owned by and partially
+annotated by the given or system user) before running the benchmark.
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import sql, exc
+
+import app.web as web
+import app.lib.database as db
+from app.lib.models.dataset import prep_sql
+
+LEGACY_NEXT_SAMPLE_SQL = """
+SELECT
+    dc.sample_index, dc.sample, COUNT(anno.owner_id) AS annocount
+FROM
+    datasetcontent AS dc
+LEFT JOIN annotations AS anno
+    ON anno.sample_index = dc.sample_index AND anno.dataset_id = dc.dataset_id
+WHERE 1=1
+    AND dc.dataset_id = :dsid
+    AND (anno.owner_id != :uid
+    OR anno.owner_id IS NULL)
+    AND dc.sample_index > :req_sample_idx
+GROUP BY dc.sample_index, dc.sample
+ORDER BY dc.sample_index ASC
+LIMIT 1
+"""
+
+ANTI_JOIN_NEXT_SAMPLE_SQL = """
+SELECT
+    dc.sample_index, dc.sample
+FROM
+    datasetcontent AS dc
+WHERE
+    dc.dataset_id = :dsid
+    AND dc.sample_index > :req_sample_idx
+    AND NOT EXISTS (
+        SELECT 1 FROM annotations AS anno
+        WHERE anno.dataset_id = dc.dataset_id
+            AND anno.sample_index = dc.sample_index
+            AND anno.owner_id = :uid
+    )
+ORDER BY dc.sample_index ASC
+LIMIT 1
+"""
+
+NAVIGATION_INDICES = ["ix_datasetcontent_dataset_split_sample", "ix_annotations_dataset_owner_sample"]
+# the legacy query and the anti-join without indices probe the annotations with a scan per candidate sample
+STATEMENT_TIMEOUT_MS = 30000
+
+
+def populate(dbsession, owner, sample_count):
+    dataset = db.Dataset()
+    dataset.owner = owner
+    dataset.dsmetadata = {"name": "navigation benchmark (%s samples)" % sample_count,
+                          "idcolumn": "id", "textcol": "text", "hasdata": True,
+                          "size": sample_count}
+    dbsession.add(dataset)
+    dbsession.flush()
+
+    dbsession.execute(sql.text(prep_sql("""
+    INSERT INTO datasetcontent (dataset_id, sample, content, split_id, data)
+    SELECT :dsid, 'sample-' || g, 'benchmark content ' || g, 'WP ' || (g % 4), '{}'
+    FROM generate_series(1, :samplecount) AS g
+    """)), params={"dsid": dataset.dataset_id, "samplecount": sample_count})
+
+    # the benchmark user annotated the first half of the dataset,
+    # the system user curated every third sample across the whole dataset
+    dbsession.execute(sql.text(prep_sql("""
+    INSERT INTO annotations (owner_id, dataset_id, sample, sample_index, task_id, data)
+    SELECT :uid, dc.dataset_id, dc.sample, dc.sample_index, -1, '{"value": "a"}'
+    FROM datasetcontent AS dc
+    WHERE dc.dataset_id = :dsid AND dc.sample_index < (
+        SELECT MIN(sample_index) + :samplecount / 2 FROM datasetcontent WHERE dataset_id = :dsid)
+    """)), params={"dsid": dataset.dataset_id, "uid": owner.uid, "samplecount": sample_count})
+
+    system_user = db.User.system_user(dbsession)
+    if system_user.uid != owner.uid:
+        dbsession.execute(sql.text(prep_sql("""
+        INSERT INTO annotations (owner_id, dataset_id, sample, sample_index, task_id, data)
+        SELECT :uid, dc.dataset_id, dc.sample, dc.sample_index, -1, '{"value": "b"}'
+        FROM datasetcontent AS dc
+        WHERE dc.dataset_id = :dsid AND dc.sample_index % 3 = 0
+        """)), params={"dsid": dataset.dataset_id, "uid": system_user.uid})
+
+    dbsession.commit()
+    return dataset
+
+
+def timed(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000.0)
+    return statistics.median(durations), max(durations)
+
+
+def timed_sql(dbsession, fn, repeat, drop_indices=()):
+    """
+    Times `fn` within a savepoint that is rolled back afterwards, optionally without the given indices.
+    Returns None if a statement exceeds `STATEMENT_TIMEOUT_MS`.
+    """
+    savepoint = dbsession.begin_nested()
+    dbsession.execute("SET LOCAL statement_timeout = %d" % STATEMENT_TIMEOUT_MS)
+    for index_name in drop_indices:
+        dbsession.execute("DROP INDEX IF EXISTS %s" % index_name)
+    try:
+        return timed(fn, repeat)
+    except exc.OperationalError:
+        return None
+    finally:
+        savepoint.rollback()
+
+
+def run_benchmark(dbsession, dataset, user_obj, repeat):
+    min_idx, max_idx = dbsession.execute(sql.text(
+        "SELECT MIN(sample_index), MAX(sample_index) FROM datasetcontent WHERE dataset_id = :dsid"),
+        params={"dsid": dataset.dataset_id}).first()
+
+    if min_idx is None:
+        print("dataset %s is empty" % dataset.dataset_id)
+        return
+
+    # plans depend on the statistics, which may not reflect recently imported samples and annotations yet
+    dbsession.execute("ANALYZE datasetcontent")
+    dbsession.execute("ANALYZE annotations")
+
+    legacy_statement = sql.text(prep_sql(LEGACY_NEXT_SAMPLE_SQL))
+    anti_join_statement = sql.text(prep_sql(ANTI_JOIN_NEXT_SAMPLE_SQL))
+
+    print("dataset %s, user %s, sample_index range %s - %s, %s repetitions, median / max ms" %
+          (dataset.dataset_id, user_obj.uid, min_idx, max_idx, repeat))
+    columns = ["legacy", "anti-join", "anti-join (no idx)", "bitmap"]
+    print("%-10s" % "position" + "".join("%-22s" % column for column in columns))
+
+    for position in [0.0, 0.25, 0.5, 0.75, 0.99]:
+        req_idx = int(min_idx + (max_idx - min_idx) * position)
+        params = {"dsid": dataset.dataset_id, "uid": user_obj.uid, "req_sample_idx": req_idx}
+
+        def legacy():
+            return dbsession.execute(legacy_statement, params=params).first()
+
+        def anti_join():
+            return dbsession.execute(anti_join_statement, params=params).first()
+
+        def bitmap():
+            return dataset.get_next_sample(dbsession, req_idx, user_obj, None)
+
+        timings = [timed_sql(dbsession, legacy, repeat),
+                   timed_sql(dbsession, anti_join, repeat),
+                   timed_sql(dbsession, anti_join, repeat, drop_indices=NAVIGATION_INDICES),
+                   timed(bitmap, repeat)]
+        print("%-10s" % ("%d%%" % (position * 100)) +
+              "".join("%-22s" % ("%.2f / %.2f" % timing if timing is not None else "> %d" % STATEMENT_TIMEOUT_MS)
+                      for timing in timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sample navigation benchmark")
+    parser.add_argument("--dataset", type=int, default=None, help="existing dataset to benchmark")
+    parser.add_argument("--user", type=int, default=None, help="annotating user, defaults to the system user")
+    parser.add_argument("--populate", type=int, default=None, help="create a synthetic dataset of N samples")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with web.app.app_context():
+        with db.session_scope() as dbsession:
+            user_obj = db.User.by_id(dbsession, args.user) if args.user is not None \
+                    else db.User.system_user(dbsession)
+
+            if args.populate is not None:
+                dataset = populate(dbsession, user_obj, args.populate)
+            elif args.dataset is not None:
+                dataset = db.Dataset.by_id(dbsession, args.dataset)
+            else:
+                parser.error("either --dataset or --populate is required")
+
+            run_benchmark(dbsession, dataset, user_obj, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -45,9 +45,10 @@ function updateSplits(split_action, action_payload) {
 
 
     if (action_payload.splitmethod === "value") {
-        // http://localhost:5000/omen/dataset/8/field/user_statuses_count.json
-        const field_info_target = API_TARGET_FIELDINFO.replace("{field}", 
-                                                               encodeURIComponent(action_payload.splitcolumn));
+        // http://localhost:5000/omen/dataset/8/field/user_statuses_count/histogram.json?split=
+        const field_info_target = API_TARGET_FIELDHISTOGRAM.replace("{field}",
+                                                                    encodeURIComponent(action_payload.splitcolumn)) +
+                                  "?split=" + encodeURIComponent(action_payload.target || "");
 
         fetch(field_info_target, {
             method: 'GET',
@@ -65,7 +66,9 @@ function updateSplits(split_action, action_payload) {
             console.log("got fieldinfo", fieldinfo);
             const valuePrompt = bootbox.prompt({
                 title: "Split at value:",
-                message: "Minimum value: " + fieldinfo.min + "<br> Maximum value: " + fieldinfo.max,
+                message: "Minimum value: " + fieldinfo.min + "<br> Maximum value: " + fieldinfo.max +
+                         (fieldinfo.suggested_splits && fieldinfo.suggested_splits[0] !== null ?
+                          "<br> Median (equal halves): ~" + fieldinfo.suggested_splits[0] : ""),
                 inputType: 'number',
                 callback: function (result) {
                     if (!result) { 
@@ -85,6 +88,9 @@ function updateSplits(split_action, action_payload) {
                 if (fieldinfo && fieldinfo.max !== undefined) {
                     targetInput.attr("max", fieldinfo.max);
                 }
+                if (fieldinfo && fieldinfo.suggested_splits && fieldinfo.suggested_splits[0] !== null) {
+                    targetInput.val(fieldinfo.suggested_splits[0]);
+                }
                 console.log(targetInput);
             });
 
@@ -232,6 +238,7 @@ function initializeSplitEditor() {
                 splitaction: split_action,
                 splitmethod: $btn.data("splitmethod") || null,
                 splitcolumn: $btn.data("splitcolumn") || null,
+                splittask: $btn.data("splittask") || null,
                 splitratio: $btn.data("splitratio") || null,
                 splitcount: $btn.data("splitcount") || null,
                 mergeinto: $btn.data("mergeinto") || null,
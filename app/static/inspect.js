@@ -127,8 +127,85 @@ function updateAnnotatorAgreement(overviewData) {
         value_target.parentNode.style.backgroundColor = `hsl(${kappa_hue}, 100%, 50%)`;
     }
 
-    document.getElementById("anno_fleiss_text").textContent = `(${overviewData.fleiss.interpretation})`;
+    let fleiss_text = overviewData.fleiss.interpretation;
+    const interval = overviewData.fleiss_interval;
+    if (interval && (interval.status === "done" || interval.status === "stale") && interval.fleiss.lower !== null) {
+        fleiss_text += `, ${Math.round(interval.fleiss.confidence * 100)}% CI ${interval.fleiss.lower} – ${interval.fleiss.upper}`;
+        if (interval.status === "stale") {
+            fleiss_text += " (updating)";
+        }
+    }
+    document.getElementById("anno_fleiss_text").textContent = `(${fleiss_text})`;
+
+    updateKrippendorffAlpha(overviewData);
+    updateCohenMatrix(overviewData);
+}
+
+function updateKrippendorffAlpha(overviewData) {
+    if (!overviewData || !overviewData.krippendorff) {
+        return;
+    }
+
+    const value_target = document.getElementById("anno_krippendorff_value");
+    if (!value_target) { return; }
+    const alpha_val = overviewData.krippendorff.alpha;
+    value_target.textContent = alpha_val === null ? "unavailable" : alpha_val;
+    if (alpha_val !== null && alpha_val >= 0.0 && alpha_val <= 1.0) {
+        const alpha_hue = (alpha_val * 120).toString(10);
+        value_target.parentNode.style.backgroundColor = `hsl(${alpha_hue}, 100%, 50%)`;
+    }
+
+    document.getElementById("anno_krippendorff_text").textContent = `(${overviewData.krippendorff.interpretation}, ${overviewData.krippendorff.metric})`;
+}
+
+function updateCohenMatrix(overviewData) {
+    const matrix_target = document.getElementById("anno_cohen_matrix");
+    if (!matrix_target || !overviewData || !overviewData.cohen) {
+        return;
+    }
 
+    const annotators = overviewData.cohen.annotators;
+    if (annotators.length < 2) {
+        return;
+    }
+
+    matrix_target.innerHTML = "";
+
+    const header_row = matrix_target.insertRow();
+    header_row.appendChild(document.createElement("th"));
+    annotators.forEach((annotator) => {
+        const header_cell = document.createElement("th");
+        header_cell.textContent = annotator;
+        header_row.appendChild(header_cell);
+    });
+
+    annotators.forEach((annotator, row_idx) => {
+        const matrix_row = matrix_target.insertRow();
+        const row_header = document.createElement("th");
+        row_header.textContent = annotator;
+        matrix_row.appendChild(row_header);
+
+        annotators.forEach((_, col_idx) => {
+            const matrix_cell = matrix_row.insertCell();
+            if (row_idx === col_idx) {
+                matrix_cell.textContent = "-";
+                return;
+            }
+
+            const kappa_val = overviewData.cohen.kappa[row_idx][col_idx];
+            const shared = overviewData.cohen.n[row_idx][col_idx];
+            if (kappa_val === null) {
+                matrix_cell.textContent = shared > 0 ? `n/a (${shared})` : "-";
+                return;
+            }
+
+            matrix_cell.textContent = `${kappa_val} (${shared})`;
+            if (kappa_val >= 0.0 && kappa_val <= 1.0) {
+                const kappa_hue = (kappa_val * 120).toString(10);
+                matrix_cell.style.backgroundColor = `hsl(${kappa_hue}, 100%, 50%)`;
+            }
+        });
+    });
 }
 
 function updateOverviewChart(overviewChart, overviewData, config, mode)  {
@@ -0,0 +1,41 @@
+"""
+Fixtures for tests that need a database.
+
+Tests run against the database configured through `OMEN_DBCONNECTION` (migrated to the current revision,
+e.g. with `./bin/flaskdb upgrade`) and are skipped if it is not set. Entities created by fixtures are
+committed, so that queries on separate connections (e.g. `pd.read_sql`) see them, and removed afterwards.
+"""
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def web():
+    if not os.environ.get("OMEN_DBCONNECTION", None):
+        pytest.skip("OMEN_DBCONNECTION is not set")
+
+    try:
+        import app.web as web_module  # pylint: disable=import-outside-toplevel
+    except SystemExit:
+        pytest.skip("database is not available")
+
+    yield web_module
+
+
+@pytest.fixture
+def db(web):
+    import app.lib.database as db_module  # pylint: disable=import-outside-toplevel
+
+    with web.app.app_context():
+        yield db_module
+
+
+@pytest.fixture
+def dbsession(db):
+    dbsession = db.flask_db.session
+    try:
+        yield dbsession
+    finally:
+        dbsession.rollback()
+        dbsession.close()
@@ -0,0 +1,153 @@
+"""
+Fleiss' kappa computed in the database (`DatasetTask.fleiss_components`) and from the per-sample annotation counts
+of a task, compared to the count matrix based and the pandas based reference implementations in `app.lib.iaa`.
+"""
+import uuid
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import sql
+
+from app.lib import iaa
+from app.lib.models.task import DatasetTask
+
+TAGS = ["A", "B", "C"]
+# annotated values that are not part of the task's tag list form a category of their own
+VALUES = TAGS + ["D"]
+SAMPLE_COUNT = 60
+ANNOTATOR_COUNT = 4
+
+
+def reference_counts(annotations, sample_indices=None):
+    """
+    Annotation counts per sample and tag (as returned by `DatasetTask.agreement_counts`) of a list
+    of `(owner_id, sample_index, value)` annotations, built without the database.
+    """
+    counts = Counter((sample_index, value) for _, sample_index, value in annotations
+                     if sample_indices is None or sample_index in sample_indices)
+    return pd.DataFrame([{"sample_index": sample_index, "anno_tag": value, "cnt": cnt}
+                         for (sample_index, value), cnt in sorted(counts.items())])
+
+
+def one_vs_rest_counts(df, tag):
+    """
+    Counts of `df` with all categories other than `tag` merged into a single "!tag" category.
+    """
+    df = df.assign(anno_tag=np.where(df["anno_tag"] == tag, tag, "!" + tag))
+    return df.groupby(["sample_index", "anno_tag"], as_index=False)["cnt"].sum()
+
+
+def assert_same_kappa(result, expected):
+    assert result["n"] == expected["n"]
+    assert result["kappa"] == pytest.approx(expected["kappa"], abs=1e-4)
+
+
+@pytest.fixture
+def annotated_task(db, dbsession):
+    """
+    A tags task with random annotations by several annotators (not every sample is annotated by everyone,
+    so some samples have a single annotation) on a dataset with a "train" and a "test" split.
+
+    Yields the dataset, the task, the list of `(owner_id, sample_index, value)` annotations
+    and the split of each sample index.
+    """
+    rng = np.random.default_rng(40)
+    fixture_id = uuid.uuid4().hex
+
+    dataset = db.Dataset()
+    dataset.owner = db.User.system_user(dbsession)
+    dataset.dsmetadata = {"name": "iaa %s" % fixture_id, "idcolumn": "id", "textcol": "text", "hasdata": True}
+    dbsession.add(dataset)
+
+    # inserting users commits the dataset as well, everything else is removed with it
+    annotators = []
+    for annotator_idx in range(ANNOTATOR_COUNT):
+        _, annotator = db.User.insert_user(dbsession, "annotator-%s-%s@iaa.test" % (annotator_idx, fixture_id),
+                                           "disabled")
+        annotators.append(annotator)
+
+    try:
+        splits = {}
+        for sample_idx in range(SAMPLE_COUNT):
+            split_id = "test" if sample_idx % 3 == 0 else "train"
+            sample_index = dbsession.execute(sql.text("""
+            INSERT INTO datasetcontent (dataset_id, sample, content, split_id, data)
+            VALUES (:dataset_id, :sample, :content, :split_id, CAST(:data AS JSON))
+            RETURNING sample_index
+            """), {"dataset_id": dataset.dataset_id, "sample": "sample-%s" % sample_idx,
+                   "content": "content %s" % sample_idx, "split_id": split_id, "data": "{}"}).scalar()
+            splits[sample_index] = split_id
+        dataset.refresh_split_sizes(dbsession)
+
+        task = DatasetTask()
+        task.taskconfig = {"type": "tags", "title": "iaa", "taglist": TAGS}
+        dataset.dstasks.append(task)
+        dbsession.flush()
+
+        annotations = []
+        for annotator in annotators:
+            items = []
+            for sample_index in splits:
+                if rng.random() > 0.7:
+                    continue
+                # annotators mostly agree on a per-sample tag
+                value = VALUES[sample_index % len(VALUES)] if rng.random() < 0.6 else str(rng.choice(VALUES))
+                items.append((sample_index, task.task_id, value))
+                annotations.append((annotator.uid, sample_index, value))
+            dataset.setannos(dbsession, annotator, items, commit=False)
+        dbsession.commit()
+
+        yield dataset, task, annotations, splits
+    finally:
+        dbsession.rollback()
+        dbsession.delete(dataset)
+        for annotator in annotators:
+            dbsession.delete(annotator)
+        dbsession.commit()
+
+
+@pytest.mark.parametrize("exclude_insufficient", [False, True])
+@pytest.mark.parametrize("split", [None, "train"])
+def test_fleiss_components(dbsession, annotated_task, exclude_insufficient, split):
+    _, task, annotations, splits = annotated_task
+
+    sample_indices = None
+    if split is not None:
+        sample_indices = {sample_index for sample_index, split_id in splits.items() if split_id == split}
+    df = reference_counts(annotations, sample_indices)
+    _, _, counts = iaa.count_matrix(df)
+    expected = iaa.fleiss_kappa_pandas(df, TAGS, exclude_insufficient=exclude_insufficient)
+
+    components = task.fleiss_components(dbsession, exclude_insufficient=exclude_insufficient, split=split)
+    expected_components = iaa.fleiss_components(counts, exclude_insufficient=exclude_insufficient)
+    assert components["N"] == expected_components["N"]
+    assert components["n"] == expected_components["n"]
+    assert components["p_avg"] == pytest.approx(expected_components["p_avg"])
+    assert sorted(components["p_j"]) == pytest.approx(sorted(expected_components["p_j"]))
+
+    assert_same_kappa(iaa.fleiss_kappa_components(components), expected)
+    assert_same_kappa(iaa.fleiss_kappa_counts(counts, exclude_insufficient=exclude_insufficient), expected)
+    assert_same_kappa(task.annotation_agreement(dbsession, exclude_insufficient=exclude_insufficient, split=split),
+                      expected)
+
+
+@pytest.mark.parametrize("split", [None, "train"])
+def test_fleiss_one_vs_rest(dbsession, annotated_task, split):
+    _, task, annotations, splits = annotated_task
+
+    sample_indices = None
+    if split is not None:
+        sample_indices = {sample_index for sample_index, split_id in splits.items() if split_id == split}
+    df = reference_counts(annotations, sample_indices)
+    _, categories, counts = iaa.count_matrix(df)
+
+    results = task.annotation_agreement(dbsession, by_tag=True, split=split)
+    one_vs_rest = iaa.fleiss_kappa_one_vs_rest(counts, categories, TAGS)
+
+    assert_same_kappa(results["__overall"], iaa.fleiss_kappa_pandas(df, TAGS))
+    for tag in TAGS:
+        expected = iaa.fleiss_kappa_pandas(one_vs_rest_counts(df, tag), [tag, "!" + tag], filter_target=tag)
+        assert_same_kappa(results[tag], expected)
+        assert_same_kappa(one_vs_rest[tag], expected)